@@ -0,0 +1,325 @@
+import os
+import json
+import asyncio
+
+import aiosqlite
+from starlette.datastructures import Headers
+
+ADMISSION_PATH = '/run_tasks'
+ADMISSION_MAX_PENDING = int(os.getenv('ADMISSION_MAX_PENDING', '20000'))  # незавершенных задач всего
+ADMISSION_CLIENT_MAX_PENDING = int(os.getenv('ADMISSION_CLIENT_MAX_PENDING', '5000'))  # незавершенных задач клиента
+ADMISSION_GROUP_MAX_TASKS = int(os.getenv('ADMISSION_GROUP_MAX_TASKS', '5000'))  # охватов в загрузке (0 - без лимита)
+ADMISSION_MAX_QUEUE = int(os.getenv('ADMISSION_MAX_QUEUE', '10000'))  # сообщений в очереди Celery
+ADMISSION_MAX_UPLOAD_MB = int(os.getenv('ADMISSION_MAX_UPLOAD_MB', '2048'))  # размер одного запроса, МБ
+ADMISSION_MAX_INGEST_MB = int(os.getenv('ADMISSION_MAX_INGEST_MB', '8192'))  # неразобранных загрузок всего, МБ
+ADMISSION_CLIENT_MAX_INGEST_MB = int(os.getenv('ADMISSION_CLIENT_MAX_INGEST_MB', '4096'))  # то же для клиента, МБ
+ADMISSION_MIN_FREE_MB = int(os.getenv('ADMISSION_MIN_FREE_MB', '2048'))  # свободное место на диске, МБ
+ADMISSION_MAX_INGEST = int(os.getenv('ADMISSION_MAX_INGEST', '2'))  # загрузок, разбираемых одновременно
+ADMISSION_MAX_WAITING = int(os.getenv('ADMISSION_MAX_WAITING', '20'))  # загрузок в очереди ожидания
+ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', '30'))  # Retry-After и период проверки ожидания, сек
+# прокси, которым разрешено указывать клиента в X-Client-Id и X-Forwarded-For
+ADMISSION_TRUSTED_PROXIES = {ip.strip() for ip in os.getenv('ADMISSION_TRUSTED_PROXIES', '').split(',') if ip.strip()}
+
+DATABASE_URL = "data/database/database.db"
+MB = 1024 * 1024
+
+PENDING_STATES = ('PREPARING', 'IN_PROGRESS')
+ACTIVE_JOB_STATES = ('QUEUED', 'WAITING', 'RUNNING')
+
+_ingest_slots = None
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, detail: str, status_code: int = 429, retry_after: int | None = ADMISSION_RETRY_AFTER):
+        super().__init__(detail)
+        self.detail = detail
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def client_id(scope) -> str:
+    """
+    Идентификатор клиента для лимитов: IP-адрес подключения.
+    Заголовкам X-Client-Id и X-Forwarded-For верим, только если запрос пришел от доверенного прокси
+    (ADMISSION_TRUSTED_PROXIES), иначе клиент мог бы обойти лимиты, меняя заголовок.
+
+    :param scope: ASGI scope запроса (request.scope).
+    """
+    client = scope.get('client')
+    address = client[0] if client else 'unknown'
+    if address not in ADMISSION_TRUSTED_PROXIES:
+        return address
+
+    headers = Headers(scope=scope)
+    if headers.get('x-client-id'):
+        return headers['x-client-id']
+
+    # ближайший к прокси адрес, добавленный не доверенным прокси
+    for forwarded in reversed(headers.get('x-forwarded-for', '').split(',')):
+        forwarded = forwarded.strip()
+        if forwarded and forwarded not in ADMISSION_TRUSTED_PROXIES:
+            return forwarded
+    return address
+
+
+def free_disk_mb(path: str = 'data') -> float:
+    stat = os.statvfs(path if os.path.exists(path) else '/')
+    return stat.f_bsize * stat.f_bavail / MB
+
+
+def queue_depth() -> int | None:
+    """
+    Длина очередей Celery или None, если брокер недоступен.
+    """
+    from .autoscale import queue_backlog
+
+    try:
+        return sum(queue_backlog().values())
+    except Exception as e:
+        print(f"Admission (queue_depth): Не удалось получить длину очереди: {e}")
+        return None
+
+
+async def load(db, client: str) -> dict:
+    """
+    Текущая нагрузка: незавершенные задачи, неразобранные загрузки (всего и клиента).
+    Логические задачи охватов, разбитых на тайлы, не учитываются: их выполняют задачи тайлов.
+    """
+    states = ','.join('?' * len(PENDING_STATES))
+    job_states = ','.join('?' * len(ACTIVE_JOB_STATES))
+
+    query = f"""
+    SELECT
+        COUNT(*),
+        COALESCE(SUM(g.client = ?), 0)
+    FROM ngw_tasks t
+    LEFT JOIN ngw_task_groups g ON g.id = t.group_id
+    WHERE t.state IN ({states}) AND t.celery_task IS NOT NULL
+    """
+    cursor = await db.execute(query, (client, *PENDING_STATES))
+    pending, client_pending = await cursor.fetchone()
+
+    # принятые, но еще не разбираемые загрузки (QUEUED, WAITING) ждут обработчика
+    query = f"""
+    SELECT
+        COALESCE(SUM(size), 0),
+        COALESCE(SUM(CASE WHEN client = ? THEN size ELSE 0 END), 0),
+        COALESCE(SUM(state != 'RUNNING'), 0),
+        COALESCE(SUM(state = 'RUNNING'), 0)
+    FROM ngw_ingest_jobs
+    WHERE state IN ({job_states})
+    """
+    cursor = await db.execute(query, (client, *ACTIVE_JOB_STATES))
+    ingest_bytes, client_ingest_bytes, waiting, running = await cursor.fetchone()
+
+    return {
+        'pending': pending,
+        'client_pending': client_pending,
+        'ingest_bytes': ingest_bytes,
+        'client_ingest_bytes': client_ingest_bytes,
+        'waiting': waiting,
+        'running': running,
+    }
+
+
+def is_overloaded(state: dict, queue: int | None) -> str | None:
+    """
+    Причина перегрузки системы в целом или None. При перегрузке загрузки ждут в очереди ожидания.
+    """
+    if state['pending'] >= ADMISSION_MAX_PENDING:
+        return f"незавершенных задач {state['pending']} (лимит {ADMISSION_MAX_PENDING})"
+    if queue is not None and queue >= ADMISSION_MAX_QUEUE:
+        return f"очередь {queue} (лимит {ADMISSION_MAX_QUEUE})"
+    return None
+
+
+async def overload_reason() -> str | None:
+    async with aiosqlite.connect(DATABASE_URL) as db:
+        state = await load(db, '')
+    return is_overloaded(state, await asyncio.to_thread(queue_depth))
+
+
+async def admission_status(client: str) -> dict:
+    """
+    Нагрузка, причина перегрузки и лимиты приема загрузок (для /admin/admission).
+    """
+    async with aiosqlite.connect(DATABASE_URL) as db:
+        state = await load(db, client)
+    queue = await asyncio.to_thread(queue_depth)
+
+    return {
+        'client': client,
+        **state,
+        'queue': queue,
+        'free_mb': int(free_disk_mb()),
+        'overloaded': is_overloaded(state, queue),
+        'limits': {
+            'max_pending': ADMISSION_MAX_PENDING,
+            'client_max_pending': ADMISSION_CLIENT_MAX_PENDING,
+            'group_max_tasks': ADMISSION_GROUP_MAX_TASKS,
+            'max_queue': ADMISSION_MAX_QUEUE,
+            'max_upload_mb': ADMISSION_MAX_UPLOAD_MB,
+            'max_ingest_mb': ADMISSION_MAX_INGEST_MB,
+            'client_max_ingest_mb': ADMISSION_CLIENT_MAX_INGEST_MB,
+            'min_free_mb': ADMISSION_MIN_FREE_MB,
+            'max_ingest': ADMISSION_MAX_INGEST,
+            'max_waiting': ADMISSION_MAX_WAITING,
+        },
+    }
+
+
+def check_limits(state: dict, size: int, queue: int | None):
+    """
+    Проверка лимитов по текущей нагрузке.
+    Лимиты клиента и объема отклоняют запрос сразу, общая перегрузка и занятые обработчики -
+    только когда заполнена очередь ожидания.
+
+    :raises AdmissionRejected: Загрузку принять нельзя.
+    """
+    if state['client_pending'] >= ADMISSION_CLIENT_MAX_PENDING:
+        raise AdmissionRejected(
+            f"Превышен лимит незавершенных задач клиента: {state['client_pending']} "
+            f"(лимит {ADMISSION_CLIENT_MAX_PENDING})"
+        )
+
+    if state['client_ingest_bytes'] + size > ADMISSION_CLIENT_MAX_INGEST_MB * MB:
+        raise AdmissionRejected(
+            f"Превышен объем неразобранных загрузок клиента ({ADMISSION_CLIENT_MAX_INGEST_MB} МБ)"
+        )
+
+    if state['ingest_bytes'] + size > ADMISSION_MAX_INGEST_MB * MB:
+        raise AdmissionRejected(f"Превышен общий объем неразобранных загрузок ({ADMISSION_MAX_INGEST_MB} МБ)")
+
+    # при перегрузке все новые загрузки ждут, иначе ждут только те, кому не хватило обработчика
+    reason = is_overloaded(state, queue)
+    if reason and state['waiting'] >= ADMISSION_MAX_WAITING:
+        raise AdmissionRejected(f"Сервис перегружен: {reason}, очередь ожидания заполнена")
+    if state['waiting'] + state['running'] >= ADMISSION_MAX_INGEST + ADMISSION_MAX_WAITING:
+        raise AdmissionRejected('Сервис перегружен: все обработчики заняты, очередь ожидания заполнена')
+
+
+async def admit(client: str, size: int) -> int:
+    """
+    Проверка, можно ли принять загрузку, и резервирование места под нее.
+    Проверка лимитов и создание задачи загрузки выполняются в одной транзакции
+    под блокировкой базы на запись, поэтому одновременные запросы не превысят лимиты вместе.
+
+    :param client: Идентификатор клиента.
+    :param size: Размер запроса в байтах (Content-Length).
+    :return:
+        ID созданной задачи загрузки (QUEUED), которую заполняет обработчик запроса.
+    :raises AdmissionRejected: Загрузку принять нельзя.
+    """
+    if size > ADMISSION_MAX_UPLOAD_MB * MB:
+        raise AdmissionRejected(f"Размер загрузки превышает {ADMISSION_MAX_UPLOAD_MB} МБ", 413, None)
+
+    if free_disk_mb() - size / MB < ADMISSION_MIN_FREE_MB:
+        raise AdmissionRejected('Недостаточно места на диске для приема файлов')
+
+    # длина очереди запрашивается до блокировки, чтобы не держать базу во время запроса к брокеру
+    queue = await asyncio.to_thread(queue_depth)
+
+    async with aiosqlite.connect(DATABASE_URL) as db:
+        await db.execute('BEGIN IMMEDIATE')
+        try:
+            check_limits(await load(db, client), size, queue)
+            cursor = await db.execute(
+                "INSERT INTO ngw_ingest_jobs (state, client, size, parts_total, parts_done, tasks_created, errors) "
+                "VALUES ('QUEUED', ?, ?, 0, 0, 0, '[]')",
+                (client, size),
+            )
+            await db.commit()
+            return cursor.lastrowid
+        except BaseException:
+            await db.rollback()
+            raise
+
+
+async def release(job_id: int):
+    """
+    Освобождает место, зарезервированное admit, если запрос не дошел до постановки загрузки
+    (ошибка проверки параметров, обрыв соединения).
+    """
+    async with aiosqlite.connect(DATABASE_URL) as db:
+        await db.execute(
+            "UPDATE ngw_ingest_jobs SET state = 'FAILED', errors = ? WHERE id = ? AND group_id IS NULL",
+            (json.dumps(['Загрузка не принята'], ensure_ascii=False), job_id),
+        )
+        await db.commit()
+
+
+async def wait_for_capacity(job_id: int, update_job) -> asyncio.Semaphore:
+    """
+    Ожидание свободного обработчика и снижения нагрузки перед разбором загрузки.
+    Пока загрузка ждет, она находится в состоянии WAITING.
+
+    :param job_id: ID задачи загрузки.
+    :param update_job: Функция обновления задачи загрузки.
+    :return:
+        Семафор обработчиков, который нужно освободить после разбора.
+    """
+    global _ingest_slots
+    if _ingest_slots is None:
+        _ingest_slots = asyncio.Semaphore(ADMISSION_MAX_INGEST)
+
+    waiting = _ingest_slots.locked()
+    if waiting:
+        await asyncio.to_thread(update_job, job_id, state='WAITING')
+    await _ingest_slots.acquire()
+
+    try:
+        while reason := await overload_reason():
+            if not waiting:
+                await asyncio.to_thread(update_job, job_id, state='WAITING')
+                waiting = True
+            print(f"Admission: загрузка {job_id} ожидает: {reason}")
+            await asyncio.sleep(ADMISSION_RETRY_AFTER)
+    except BaseException:
+        _ingest_slots.release()
+        raise
+
+    return _ingest_slots
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware, проверяющий лимиты до чтения тела запроса загрузки,
+    чтобы при перегрузке отвечать 429 сразу, не принимая файлы.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'POST' or scope['path'] != ADMISSION_PATH:
+            return await self.app(scope, receive, send)
+
+        client = client_id(scope)
+        try:
+            # без Content-Length (chunked) размер загрузки неизвестен и лимиты объема не проверить
+            size = int(Headers(scope=scope)['content-length'])
+            if size < 0:
+                raise ValueError(size)
+        except (KeyError, ValueError):
+            size = None
+
+        try:
+            if size is None:
+                raise AdmissionRejected('Не указан размер загрузки (Content-Length)', 411, None)
+            job_id = await admit(client, size)
+        except AdmissionRejected as e:
+            print(f"Admission: загрузка клиента {client} отклонена: {e.detail}")
+            response_headers = [(b'content-type', b'application/json')]
+            if e.retry_after:
+                response_headers.append((b'retry-after', str(e.retry_after).encode()))
+            body = json.dumps({'detail': e.detail}, ensure_ascii=False).encode('utf-8')
+            await send({'type': 'http.response.start', 'status': e.status_code, 'headers': response_headers})
+            await send({'type': 'http.response.body', 'body': body})
+            return
+
+        # обработчик запроса заполняет зарезервированную задачу загрузки (request.state.ingest_job_id)
+        scope.setdefault('state', {})['ingest_job_id'] = job_id
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            await release(job_id)
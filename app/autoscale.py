@@ -0,0 +1,166 @@
+import os
+import time
+
+from celery.worker import state
+from celery.worker.autoscale import Autoscaler
+
+from .breaker import toolbox_breaker
+from .db import DBTask, SessionLocal
+
+AUTOSCALE_MIN = int(os.getenv('AUTOSCALE_MIN', '0'))  # минимум процессов (0 - из --autoscale)
+AUTOSCALE_MAX = int(os.getenv('AUTOSCALE_MAX', '0'))  # максимум процессов (0 - из --autoscale)
+AUTOSCALE_INTERVAL = float(os.getenv('AUTOSCALE_INTERVAL', '5'))  # период пересчета целевого числа процессов, сек
+AUTOSCALE_QUEUES = [queue.strip() for queue in os.getenv('AUTOSCALE_QUEUES', 'celery').split(',') if queue.strip()]
+AUTOSCALE_TOOLBOX_BUDGET = int(os.getenv('AUTOSCALE_TOOLBOX_BUDGET', '0'))  # одновременных задач NG Toolbox (0 - без лимита)
+AUTOSCALE_MAX_LOAD = float(os.getenv('AUTOSCALE_MAX_LOAD', '0.8'))  # загрузка CPU (load average на ядро) для роста
+AUTOSCALE_MIN_FREE_MB = int(os.getenv('AUTOSCALE_MIN_FREE_MB', '2048'))  # свободное место на диске для роста, МБ
+
+BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0")
+
+_redis = None
+
+
+def get_redis():
+    global _redis
+    if _redis is None:
+        import redis
+
+        _redis = redis.Redis.from_url(BROKER_URL, socket_timeout=5, socket_connect_timeout=5)
+    return _redis
+
+
+def queue_backlog(queues=AUTOSCALE_QUEUES) -> dict:
+    """
+    Количество сообщений, ожидающих в очередях брокера Redis.
+    Сообщения с ETA воркеры забирают из очереди сразу (префетч для них увеличивается)
+    и держат в таймере до наступления ETA, поэтому в очереди они почти не задерживаются.
+    """
+    pipe = get_redis().pipeline()
+    for queue in queues:
+        pipe.llen(queue)
+    return dict(zip(queues, pipe.execute()))
+
+
+def toolbox_inflight() -> int:
+    """
+    Количество задач, выполняющихся на NG Toolbox (по всем воркерам).
+    """
+    db = SessionLocal()
+    try:
+        return db.query(DBTask).filter(DBTask.state == 'IN_PROGRESS', DBTask.celery_task.isnot(None)).count()
+    finally:
+        db.close()
+
+
+def cpu_load() -> float:
+    """
+    Load average за минуту в пересчете на одно ядро.
+    """
+    return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+
+def free_disk_mb(path: str = '/') -> float:
+    stat = os.statvfs(path)
+    return stat.f_bsize * stat.f_bavail / 1024 / 1024
+
+
+class QueueAutoscaler(Autoscaler):
+    """
+    Автомасштабирование пула воркера по длине очереди.
+    Подключается через worker_autoscaler и включается параметром --autoscale=MAX,MIN.
+
+    Целевое число процессов - задачи, готовые к выполнению на воркере, и сообщения в очереди, в пределах MIN..MAX.
+    Рост ограничивается бюджетом одновременных задач NG Toolbox, загрузкой CPU, свободным местом
+    на диске и предохранителем запросов. Уменьшение происходит не раньше AUTOSCALE_KEEPALIVE
+    секунд после последнего роста (стандартное поведение Celery).
+    """
+
+    def __init__(self, pool, max_concurrency, min_concurrency=0, *args, worker=None, **kwargs):
+        initial_max = max_concurrency
+        max_concurrency = AUTOSCALE_MAX or max_concurrency
+        min_concurrency = min(AUTOSCALE_MIN or min_concurrency, max_concurrency)
+        if worker is not None:
+            # префетч потребителя считается от max_concurrency воркера (потребитель создается после
+            # автомасштабирования), иначе он остался бы рассчитан на значение --autoscale
+            worker.max_concurrency, worker.min_concurrency = max_concurrency, min_concurrency
+            consumer = getattr(worker, 'consumer', None)
+            qos = getattr(consumer, 'qos', None)
+            if qos is not None and max_concurrency != initial_max:
+                change = (max_concurrency - initial_max) * consumer.prefetch_multiplier
+                if change > 0:
+                    qos.increment_eventually(change)
+                else:
+                    qos.decrement_eventually(-change)
+        super().__init__(pool, max_concurrency, min_concurrency, *args, worker=worker, **kwargs)
+        self.target = min_concurrency
+        self.checked = 0.0
+        self.metrics = {}
+
+    def _maybe_scale(self, req=None):
+        if time.monotonic() - self.checked >= AUTOSCALE_INTERVAL:
+            self.checked = time.monotonic()
+            self.update_target()
+
+        procs = self.processes
+        if self.target > procs:
+            self.scale_up(self.target - procs)
+            return True
+        if self.target < procs:
+            self.scale_down(procs - self.target)
+            return True
+
+    def update_target(self):
+        procs = self.processes
+        try:
+            target, metrics = self.compute_target(procs)
+        except Exception as e:
+            # без метрик ориентируемся только на задачи самого воркера, как стандартный Autoscaler
+            print(f"Autoscaler: Не удалось получить метрики: {e}")
+            target, metrics = max(min(self.qty, self.max_concurrency), self.min_concurrency), {'error': str(e)}
+
+        if target != self.target:
+            print(f"Autoscaler: процессов {procs} -> {target} ({metrics})")
+        self.target = target
+        self.metrics = metrics
+
+    def compute_target(self, procs: int) -> tuple[int, dict]:
+        # задачи с ETA попадают в reserved_requests только когда наступает их время (до этого
+        # они ждут в таймере потребителя), поэтому отложенные повторы процессов не требуют
+        metrics = {
+            'reserved': len(state.reserved_requests),
+            'backlog': sum(queue_backlog().values()),
+            'load': round(cpu_load(), 2),
+            'free_mb': int(free_disk_mb()),
+        }
+
+        demand = metrics['reserved'] + metrics['backlog']
+        target = max(min(demand, self.max_concurrency), self.min_concurrency)
+
+        if metrics['free_mb'] < AUTOSCALE_MIN_FREE_MB:
+            # задачи скачивают результаты на диск, при нехватке места новые процессы только навредят
+            metrics['limit'] = 'disk'
+            return self.min_concurrency, metrics
+
+        if target <= procs:
+            return target, metrics
+
+        if metrics['load'] > AUTOSCALE_MAX_LOAD:
+            metrics['limit'] = 'cpu'
+            return procs, metrics
+
+        if toolbox_breaker.status().get('tripped'):
+            metrics['limit'] = 'breaker'
+            return procs, metrics
+
+        if AUTOSCALE_TOOLBOX_BUDGET:
+            # задачи этого воркера уже учтены в общем числе выполняющихся
+            metrics['inflight'] = toolbox_inflight()
+            available = AUTOSCALE_TOOLBOX_BUDGET - metrics['inflight'] + len(state.active_requests)
+            if target > available:
+                metrics['limit'] = 'toolbox'
+                target = max(available, procs, self.min_concurrency)
+
+        return target, metrics
+
+    def info(self):
+        return {**super().info(), 'target': self.target, 'metrics': self.metrics}
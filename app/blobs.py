@@ -0,0 +1,261 @@
+import os
+import time
+import gzip
+import shutil
+import hashlib
+import tempfile
+from collections import Counter
+from contextlib import contextmanager
+
+from sqlalchemy import or_
+from sqlalchemy.dialects.sqlite import insert
+
+from .db import DBTask, DBBlobLease, SessionLocal
+from .storage import get_storage
+from .tracing import trace
+
+BLOBS_DIR = 'data/blobs'
+BLOB_COMPRESS = [ext.strip() for ext in os.getenv('BLOB_COMPRESS', '.csv,.geojson,.json').split(',') if ext.strip()]
+BLOB_COMPRESS_LEVEL = int(os.getenv('BLOB_COMPRESS_LEVEL', '6'))  # уровень сжатия gzip (1-9)
+BLOB_LEASE_TTL = int(os.getenv('BLOB_LEASE_TTL', '86400'))  # защита сохраненного блоба без ссылок от удаления, сек
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_blob(key: str | None) -> bool:
+    return bool(key) and key.startswith(BLOBS_DIR + '/')
+
+
+def is_compressed(key: str) -> bool:
+    return is_blob(key) and key.endswith('.gz')
+
+
+def blob_extension(key: str) -> str:
+    """
+    Расширение исходного файла (без .gz сжатого блоба).
+    """
+    name = os.path.basename(key)
+    if is_compressed(key):
+        name = name[: -len('.gz')]
+    return os.path.splitext(name)[1]
+
+
+def blob_filename(key: str, name: str | None = None) -> str:
+    """
+    Имя файла для скачивания или архива. У блобов имя берется из задачи, расширение - из ключа.
+    """
+    if not is_blob(key):
+        return os.path.basename(key)
+    return (name or os.path.basename(key).split('.')[0]) + blob_extension(key)
+
+
+def lease_blob(key: str):
+    """
+    Защищает блоб от удаления до записи ссылки на него в задачу (см. claim_blobs).
+    Запись в базу ждет завершения идущей проверки release_blob, поэтому после нее
+    блоб либо уже удален, либо не будет удален.
+    """
+    db = SessionLocal()
+    try:
+        with trace('db.lease_blob', table='ngw_blob_leases'):
+            query = insert(DBBlobLease).values(key=key, count=1, updated=time.time())
+            db.execute(
+                query.on_conflict_do_update(
+                    index_elements=[DBBlobLease.key],
+                    set_={'count': DBBlobLease.count + 1, 'updated': query.excluded.updated},
+                )
+            )
+            db.commit()
+    finally:
+        db.close()
+
+
+def claim_blobs(*keys: str):
+    """
+    Снимает защиту с блобов после записи ссылок на них в задачи.
+    Вызывается для каждого ключа, полученного из put_blob.
+    """
+    counts = Counter(key for key in keys if is_blob(key))
+    if not counts:
+        return
+
+    db = SessionLocal()
+    try:
+        with trace('db.claim_blobs', table='ngw_blob_leases', blobs=len(counts)):
+            for key, count in counts.items():
+                db.query(DBBlobLease).filter(DBBlobLease.key == key).update(
+                    {'count': DBBlobLease.count - count}, synchronize_session=False
+                )
+            db.query(DBBlobLease).filter(DBBlobLease.key.in_(counts), DBBlobLease.count <= 0).delete(
+                synchronize_session=False
+            )
+            db.commit()
+    finally:
+        db.close()
+
+
+def discard_blobs(*keys: str):
+    """
+    Снимает защиту с блобов, ссылка на которые так и не была записана в задачу
+    (ошибка создания задачи, отмена, пропуск охвата), и удаляет блобы, которые больше никому не нужны.
+    """
+    claim_blobs(*keys)
+    for key in set(keys):
+        if is_blob(key):
+            release_blob(key)
+
+
+def sweep_blob_leases() -> int:
+    """
+    Удаление защиты, которая не была снята дольше BLOB_LEASE_TTL (например, процесс разбора
+    был прерван перезапуском), и блобов, на которые так и не сослалась ни одна задача.
+
+    :return:
+        Количество снятых защит.
+    """
+    db = SessionLocal()
+    try:
+        expired = [
+            row.key
+            for row in db.query(DBBlobLease.key).filter(DBBlobLease.updated < time.time() - BLOB_LEASE_TTL)
+        ]
+    finally:
+        db.close()
+
+    for key in expired:
+        release_blob(key)
+    if expired:
+        print(f"Blobs (sweep_blob_leases): Снята просроченная защита блобов: {len(expired)}")
+    return len(expired)
+
+
+def put_blob(path: str) -> str:
+    """
+    Помещает локальный файл в хранилище по хешу содержимого.
+    Если такой файл уже есть, повторно он не сохраняется. Текстовые файлы (BLOB_COMPRESS) сжимаются.
+    Локальный файл после сохранения удаляется.
+    Блоб защищен от удаления, пока ссылка на него не записана в задачу и не вызван claim_blobs.
+
+    :return:
+        Ключ блоба в хранилище.
+    """
+    storage = get_storage()
+    digest = file_hash(path)
+    extension = os.path.splitext(path)[1].lower()
+    compress = extension in BLOB_COMPRESS
+    key = f"{BLOBS_DIR}/{digest[:2]}/{digest}{extension}{'.gz' if compress else ''}"
+
+    # защита ставится до проверки наличия, иначе блоб могли бы удалить сразу после нее
+    lease_blob(key)
+    if storage.exists(key):
+        print(f"Blobs (put_blob): {os.path.basename(path)} уже сохранен как {key}")
+        os.remove(path)
+        return key
+
+    if not compress:
+        return storage.put_file(path, key)
+
+    # сжатый файл создается рядом с исходным, чтобы перемещение в локальное хранилище было атомарным
+    compressed_path = path + '.gz'
+    with open(path, 'rb') as source, gzip.open(compressed_path, 'wb', compresslevel=BLOB_COMPRESS_LEVEL) as target:
+        shutil.copyfileobj(source, target, CHUNK_SIZE)
+
+    size, compressed_size = os.path.getsize(path), os.path.getsize(compressed_path)
+    print(f"Blobs (put_blob): {os.path.basename(path)} сжат {size} -> {compressed_size} байт")
+    os.remove(path)
+    return storage.put_file(compressed_path, key)
+
+
+@contextmanager
+def open_blob(key: str):
+    """
+    Чтение файла из хранилища с распаковкой сжатых блобов.
+    """
+    with get_storage().open(key) as raw:
+        if is_compressed(key):
+            with gzip.GzipFile(fileobj=raw, mode='rb') as f:
+                yield f
+        else:
+            yield raw
+
+
+@contextmanager
+def blob_file(key: str):
+    """
+    Локальный путь к распакованному файлу (для библиотек и запросов, которым нужен файл на диске).
+    Временный файл удаляется после выхода из блока.
+    """
+    storage = get_storage()
+    if storage.is_local and not is_compressed(key):
+        yield key
+        return
+
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, os.path.basename(key)[: -len('.gz')] if is_compressed(key) else os.path.basename(key))
+    try:
+        with open_blob(key) as source, open(path, 'wb') as target:
+            shutil.copyfileobj(source, target, CHUNK_SIZE)
+        yield path
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def blob_refs(key: str, db=None) -> int:
+    """
+    Количество ссылок на файл из задач (охват, КПТ, геометрия).
+    """
+    session = db or SessionLocal()
+    try:
+        return (
+            session.query(DBTask)
+            .filter(or_(DBTask.cover_file == key, DBTask.kpt_file == key, DBTask.kad_file == key))
+            .count()
+        )
+    finally:
+        if db is None:
+            session.close()
+
+
+def release_blob(key: str) -> bool:
+    """
+    Удаляет блоб, если на него больше не ссылается ни одна задача и он не защищен lease_blob.
+    Вызывается после удаления или изменения ссылающихся задач.
+
+    Проверка и удаление выполняются под блокировкой базы на запись,
+    поэтому параллельное сохранение такого же файла (put_blob) дождется их завершения.
+
+    :return:
+        True, если блоб удален.
+    """
+    db = SessionLocal()
+    try:
+        with trace('db.release_blob', table='ngw_blob_leases'):
+            # первый запрос на запись берет блокировку, заодно снимается защита сохранений, не дошедших до задач
+            db.query(DBBlobLease).filter(
+                DBBlobLease.key == key, DBBlobLease.updated < time.time() - BLOB_LEASE_TTL
+            ).delete(synchronize_session=False)
+
+            refs = blob_refs(key, db)
+            leased = db.query(DBBlobLease).filter(DBBlobLease.key == key).count()
+            if refs or leased:
+                db.commit()
+                print(f"Blobs (release_blob): {key} используется в задачах ({refs}) или сохраняется, файл сохранен")
+                return False
+
+            print(f"Blobs (release_blob): Удаление {key}")
+            get_storage().delete(key)
+            db.commit()
+            return True
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
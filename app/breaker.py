@@ -0,0 +1,126 @@
+import os
+import time
+
+BREAKER_REDIS_URL = os.getenv('BREAKER_REDIS_URL') or os.getenv('CELERY_BROKER_URL', 'redis://localhost:6379/0')
+BREAKER_THRESHOLD = int(os.getenv('BREAKER_THRESHOLD', '5'))  # временных ошибок за окно для размыкания
+BREAKER_WINDOW = int(os.getenv('BREAKER_WINDOW', '120'))  # окно подсчета ошибок, сек
+BREAKER_COOLDOWN = int(os.getenv('BREAKER_COOLDOWN', '120'))  # пауза перед пробным запросом, сек
+
+
+class CircuitBreaker:
+    """
+    Общий для всех воркеров предохранитель запросов к внешнему сервису (состояние хранится в Redis).
+
+    - closed: запросы выполняются, временные ошибки считаются;
+    - open: после BREAKER_THRESHOLD ошибок запросы не выполняются BREAKER_COOLDOWN секунд;
+    - half-open: после паузы пропускается один пробный запрос, успех замыкает предохранитель.
+
+    При недоступности Redis предохранитель пропускает все запросы.
+    """
+
+    def __init__(self, name: str, url: str = BREAKER_REDIS_URL):
+        self.name = name
+        self.url = url
+        self._client = None
+        self._on_close = []
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis
+
+            self._client = redis.Redis.from_url(self.url, socket_timeout=5, socket_connect_timeout=5)
+        return self._client
+
+    def key(self, suffix: str) -> str:
+        return f"breaker:{self.name}:{suffix}"
+
+    def on_close(self, callback):
+        """
+        Регистрирует функцию, которая вызывается после замыкания предохранителя успешным пробным запросом
+        (например, чтобы сразу запустить задачи, ожидающие восстановления сервиса).
+        """
+        self._on_close.append(callback)
+
+    def remaining_cooldown(self) -> float:
+        """
+        Оставшееся время паузы разомкнутого предохранителя, сек. 0 - предохранитель не разомкнут.
+        """
+        try:
+            ttl = self.client.pttl(self.key('open'))
+            return ttl / 1000 if ttl and ttl > 0 else 0.0
+        except Exception as e:
+            print(f"CircuitBreaker ({self.name}): Redis недоступен, проверка пропущена: {e}")
+            return 0.0
+
+    def retry_after(self) -> float:
+        """
+        Через сколько секунд можно выполнять запросы. 0 - запрос можно выполнить сейчас.
+        """
+        try:
+            ttl = self.client.pttl(self.key('open'))
+            if ttl and ttl > 0:
+                return ttl / 1000
+
+            if not self.client.exists(self.key('tripped')):
+                return 0.0
+
+            # half-open: пропускаем только один пробный запрос
+            if self.client.set(self.key('probe'), time.time(), nx=True, ex=BREAKER_COOLDOWN):
+                print(f"CircuitBreaker ({self.name}): пробный запрос")
+                return 0.0
+
+            ttl = self.client.pttl(self.key('probe'))
+            return max(ttl / 1000, 1.0) if ttl and ttl > 0 else 1.0
+        except Exception as e:
+            print(f"CircuitBreaker ({self.name}): Redis недоступен, проверка пропущена: {e}")
+            return 0.0
+
+    def record_success(self):
+        try:
+            # ключ tripped удаляет только один из одновременных успешных запросов
+            closed = self.client.delete(self.key('tripped'))
+            self.client.delete(self.key('failures'), self.key('open'), self.key('probe'))
+        except Exception as e:
+            print(f"CircuitBreaker ({self.name}): Redis недоступен: {e}")
+            return
+
+        if closed:
+            print(f"CircuitBreaker ({self.name}): сервис восстановлен")
+            for callback in self._on_close:
+                try:
+                    callback()
+                except Exception as e:
+                    print(f"CircuitBreaker ({self.name}): Ошибка обработчика замыкания: {e}")
+
+    def record_failure(self):
+        try:
+            pipe = self.client.pipeline()
+            pipe.incr(self.key('failures'))
+            pipe.expire(self.key('failures'), BREAKER_WINDOW)
+            pipe.exists(self.key('tripped'))
+            failures, _, tripped = pipe.execute()
+
+            if failures >= BREAKER_THRESHOLD or tripped:
+                pipe = self.client.pipeline()
+                pipe.set(self.key('open'), time.time(), ex=BREAKER_COOLDOWN)
+                pipe.set(self.key('tripped'), time.time())
+                pipe.delete(self.key('probe'))
+                pipe.execute()
+                print(f"CircuitBreaker ({self.name}): запросы приостановлены на {BREAKER_COOLDOWN} сек")
+        except Exception as e:
+            print(f"CircuitBreaker ({self.name}): Redis недоступен: {e}")
+
+    def status(self) -> dict:
+        try:
+            return {
+                'name': self.name,
+                'open': bool(self.client.exists(self.key('open'))),
+                'tripped': bool(self.client.exists(self.key('tripped'))),
+                'failures': int(self.client.get(self.key('failures')) or 0),
+            }
+        except Exception as e:
+            return {'name': self.name, 'error': str(e)}
+
+
+toolbox_breaker = CircuitBreaker('ngtoolbox')
@@ -0,0 +1,91 @@
+import os
+import json
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '64'))  # количество кешируемых ответов
+
+
+class VersionedCache:
+    """
+    Небольшой LRU-кеш сериализованных ответов.
+    Запись действительна, пока не изменилась версия данных, из которых она построена.
+    """
+
+    def __init__(self, max_size=RESPONSE_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def get(self, key: str, version: int) -> bytes | None:
+        entry = self.entries.get(key)
+        if not entry or entry[0] != version:
+            return None
+
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: str, version: int, body: bytes):
+        self.entries[key] = (version, body)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+response_cache = VersionedCache()
+
+
+async def get_version(db, scope: str = 'global') -> tuple[int, float | None]:
+    """
+    Версия изменений (global или group:<id>) и время последнего изменения.
+    """
+    cursor = await db.execute("SELECT version, modified FROM ngw_change_versions WHERE scope = ?", (scope,))
+    row = await cursor.fetchone()
+    return (row[0], row[1]) if row else (0, None)
+
+
+def is_not_modified(request: Request, etag: str, modified: float | None) -> bool:
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match:
+        return etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since and modified:
+        try:
+            return int(modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+
+async def conditional_json(request: Request, db, key: str, scope: str, build) -> Response:
+    """
+    Ответ JSON с поддержкой условных запросов (ETag, Last-Modified).
+    Без изменений данных возвращается 304, а тело ответа строится только при смене версии.
+
+    :param request: Запрос.
+    :param db: Соединение aiosqlite.
+    :param key: Ключ кеша (эндпоинт и параметры запроса).
+    :param scope: Область версии изменений (global или group:<id>).
+    :param build: Асинхронная функция, формирующая данные ответа.
+    """
+    version, modified = await get_version(db, scope)
+
+    etag = f'W/"{scope}-{version}"'
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if modified:
+        headers['Last-Modified'] = formatdate(modified, usegmt=True)
+
+    if is_not_modified(request, etag, modified):
+        return Response(status_code=304, headers=headers)
+
+    body = response_cache.get(key, version)
+    if body is None:
+        data = jsonable_encoder(await build())
+        body = json.dumps(data, ensure_ascii=False, allow_nan=False, separators=(',', ':')).encode('utf-8')
+        response_cache.set(key, version, body)
+
+    return Response(content=body, media_type='application/json', headers=headers)
@@ -1,4 +1,7 @@
-from sqlalchemy import create_engine, Column, JSON, String, Integer, DateTime, ForeignKey
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import create_engine, event, inspect, text, Column, JSON, String, Integer, Float, Boolean, DateTime, ForeignKey, Index
 from sqlalchemy.orm import DeclarativeBase, sessionmaker
 
 DATABASE_URL = "sqlite:///data/database/database.db"
@@ -22,14 +25,71 @@ class DBTask(Base):
     kad_task_id = Column(String, unique=True, index=True)
     ngw_resource_id = Column(Integer, unique=True, index=True)
 
-    cover_file = Column(String)
-    kpt_file = Column(String)
-    kad_file = Column(String)
+    # ключи файлов в хранилище (блобы по хешу содержимого, см. blobs.py), индексы для подсчета ссылок
+    cover_file = Column(String, index=True)
+    kpt_file = Column(String, index=True)
+    kad_file = Column(String, index=True)
 
     kpt_status = Column(JSON, default={"state": "PREPARING"})
     kad_status = Column(JSON, default={"state": "PREPARING"})
 
     group_id = Column(Integer, ForeignKey("ngw_task_groups.id"))
+    parent_id = Column(Integer, ForeignKey("ngw_tasks.id"), index=True)  # логическая задача, если это тайл охвата
+    cancel_requested = Column(Boolean, default=False)  # запрошена отмена, воркер завершает задачу сам
+    heartbeat = Column(Float)  # время последней отметки воркера, выполняющего задачу (unix time)
+    trace_id = Column(String, index=True)  # трасса последнего запуска задачи (см. tracing.py)
+
+    # состояние задачи, синхронизируется с kpt_status и kad_status (см. sync_task_state)
+    kpt_state = Column(String, default="PREPARING")
+    kad_state = Column(String, default="PREPARING")
+    stage = Column(String, default="kpt")  # текущий этап: kpt, kad
+    state = Column(String, default="PREPARING")  # PREPARING, IN_PROGRESS, SUCCESS, FAILED, CANCELLED
+    error = Column(String)
+    updated = Column(DateTime)
+    finished = Column(DateTime)
+
+    __table_args__ = (
+        Index("ix_ngw_tasks_group_state", "group_id", "state"),
+        Index("ix_ngw_tasks_state_added", "state", "added"),
+    )
+
+
+def task_state(kpt_state: str, kad_state: str) -> str:
+    """
+    Общее состояние задачи по состояниям этапов.
+    """
+    if kpt_state == 'FAILED' or kad_state == 'FAILED':
+        return 'FAILED'
+    if kpt_state == 'CANCELLED' or kad_state == 'CANCELLED':
+        return 'CANCELLED'
+    if kpt_state == 'SUCCESS' and kad_state == 'SUCCESS':
+        return 'SUCCESS'
+    if kpt_state != 'PREPARING' or kad_state != 'PREPARING':
+        return 'IN_PROGRESS'
+    return 'PREPARING'
+
+
+@event.listens_for(DBTask, "before_insert")
+@event.listens_for(DBTask, "before_update")
+def sync_task_state(mapper, connection, target):
+    """
+    Обновляет колонки состояния по JSON-статусам этапов при каждой записи задачи.
+    """
+    kpt_status = target.kpt_status or {}
+    kad_status = target.kad_status or {}
+
+    target.kpt_state = kpt_status.get('state') or 'PREPARING'
+    target.kad_state = kad_status.get('state') or 'PREPARING'
+    target.stage = 'kad' if target.kpt_state == 'SUCCESS' else 'kpt'
+    target.state = task_state(target.kpt_state, target.kad_state)
+    target.error = kpt_status.get('error') or kad_status.get('error') or None
+
+    now = datetime.now(ZoneInfo("Europe/Moscow"))
+    target.updated = now
+    if target.state in ('SUCCESS', 'FAILED', 'CANCELLED'):
+        target.finished = target.finished or now
+    else:
+        target.finished = None
 
 
 class DBTasksGroup(Base):
@@ -38,10 +98,175 @@ class DBTasksGroup(Base):
     id = Column(Integer, primary_key=True, index=True)
     added = Column(DateTime)
     name = Column(String, index=True)
+    client = Column(String, index=True)  # IP-адрес или X-Client-Id от доверенного прокси (см. admission.py)
+
+
+class DBIngestJob(Base):
+    __tablename__ = "ngw_ingest_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    added = Column(DateTime)
+    finished = Column(DateTime)
+    group_id = Column(Integer, ForeignKey("ngw_task_groups.id"), index=True)
+    state = Column(String, default="QUEUED", index=True)  # QUEUED, WAITING, RUNNING, SUCCESS, FAILED
+    client = Column(String, index=True)
+    size = Column(Integer, default=0)  # размер загруженных файлов, байт
+    parts_total = Column(Integer, default=0)  # количество слоев (GeoJSON, SHP) для разбора
+    parts_done = Column(Integer, default=0)
+    tasks_created = Column(Integer, default=0)
+    errors = Column(JSON, default=[])
+    stats = Column(JSON, default={})  # вершины и байты геометрий до/после, размер файлов (см. preprocess.py)
+
+
+class DBBlobLease(Base):
+    __tablename__ = "ngw_blob_leases"
+
+    # блоб сохранен, но ссылка на него еще не записана в задачу, удалять его нельзя (см. blobs.py)
+    key = Column(String, primary_key=True)
+    count = Column(Integer, default=0)  # сохранений, ожидающих записи ссылки
+    updated = Column(Float)  # время последнего сохранения (unix time)
+
+
+class DBChangeVersion(Base):
+    __tablename__ = "ngw_change_versions"
+
+    scope = Column(String, primary_key=True)  # global или group:<id>
+    version = Column(Integer, default=0)
+    modified = Column(Float)  # время последнего изменения (unix time)
+
+
+class DBJobStat(Base):
+    __tablename__ = "ngw_job_stats"
+
+    id = Column(Integer, primary_key=True, index=True)
+    added = Column(DateTime, index=True)
+    operation = Column(String, index=True)  # egrn_kvartals_cover, cadnums_to_geodata
+    size = Column(Float)  # размер файла охвата или списка КПТ, КБ
+    hour = Column(Integer)  # час запуска задачи
+    duration = Column(Float)  # время выполнения задачи на сервере, сек
+    polls = Column(Integer)  # количество запросов статуса
+    detection_delay = Column(Float)  # время от завершения задачи до его обнаружения, сек
+
+
+# расчет колонок состояния по JSON-статусам в SQL, как в sync_task_state:
+# {where} ограничивает обновляемые строки, {now} - время изменения
+STATE_QUERIES = [
+    """
+    UPDATE ngw_tasks SET
+        kpt_state = COALESCE(json_extract(kpt_status, '$.state'), 'PREPARING'),
+        kad_state = COALESCE(json_extract(kad_status, '$.state'), 'PREPARING'),
+        error = COALESCE(NULLIF(json_extract(kpt_status, '$.error'), ''), NULLIF(json_extract(kad_status, '$.error'), '')),
+        updated = {now}
+    {where}
+    """,
+    """
+    UPDATE ngw_tasks SET
+        stage = CASE WHEN kpt_state = 'SUCCESS' THEN 'kad' ELSE 'kpt' END,
+        state = CASE
+            WHEN kpt_state = 'FAILED' OR kad_state = 'FAILED' THEN 'FAILED'
+            WHEN kpt_state = 'CANCELLED' OR kad_state = 'CANCELLED' THEN 'CANCELLED'
+            WHEN kpt_state = 'SUCCESS' AND kad_state = 'SUCCESS' THEN 'SUCCESS'
+            WHEN kpt_state != 'PREPARING' OR kad_state != 'PREPARING' THEN 'IN_PROGRESS'
+            ELSE 'PREPARING'
+        END
+    {where}
+    """,
+    """
+    UPDATE ngw_tasks SET
+        finished = CASE WHEN state IN ('SUCCESS', 'FAILED', 'CANCELLED') THEN COALESCE(finished, updated) END
+    {where}
+    """,
+]
+
+# заполнение новых колонок в существующих базах: (таблица, колонка) -> запросы
+BACKFILLS = {
+    ("ngw_tasks", "state"): [query.format(now="added", where="") for query in STATE_QUERIES],
+}
+
+
+def state_triggers() -> list[str]:
+    """
+    Триггеры, пересчитывающие колонки состояния задачи при записи статусов в обход ORM (aiosqlite в API).
+    Записи через ORM уже согласованы (см. sync_task_state), для них триггеры не срабатывают.
+    """
+    # время по Москве, как в sync_task_state
+    now = "datetime('now', '+3 hours')"
+    stale = (
+        "NEW.kpt_state IS NOT COALESCE(json_extract(NEW.kpt_status, '$.state'), 'PREPARING') "
+        "OR NEW.kad_state IS NOT COALESCE(json_extract(NEW.kad_status, '$.state'), 'PREPARING') "
+        "OR NEW.error IS NOT COALESCE(NULLIF(json_extract(NEW.kpt_status, '$.error'), ''), NULLIF(json_extract(NEW.kad_status, '$.error'), ''))"
+    )
+    body = " ".join(query.format(now=now, where="WHERE id = NEW.id").strip() + ";" for query in STATE_QUERIES)
+
+    triggers = []
+    for name, event_name in (("insert", "INSERT"), ("update", "UPDATE OF kpt_status, kad_status")):
+        triggers.append(
+            f"CREATE TRIGGER IF NOT EXISTS ngw_tasks_state_{name} "
+            f"AFTER {event_name} ON ngw_tasks WHEN {stale} BEGIN {body} END"
+        )
+    return triggers
+
+
+def version_triggers() -> list[str]:
+    """
+    Триггеры, увеличивающие версию изменений (общую и группы) при любой записи задач и групп.
+    Срабатывают и для запросов в обход ORM (aiosqlite в API).
+    """
+    now = "(julianday('now') - 2440587.5) * 86400.0"
+    bump = (
+        "INSERT INTO ngw_change_versions (scope, version, modified) VALUES ({scope}, 1, {now}) "
+        "ON CONFLICT(scope) DO UPDATE SET version = version + 1, modified = excluded.modified;"
+    )
+
+    triggers = []
+    for table, group_column in (("ngw_tasks", "group_id"), ("ngw_task_groups", "id")):
+        for event_name, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+            global_bump = bump.format(scope="'global'", now=now)
+            group_bump = bump.format(scope=f"'group:' || IFNULL({row}.{group_column}, 0)", now=now)
+            triggers.append(
+                f"CREATE TRIGGER IF NOT EXISTS {table}_version_{event_name.lower()} "
+                f"AFTER {event_name} ON {table} BEGIN {global_bump} {group_bump} END"
+            )
+    return triggers
+
+
+def migrate():
+    """
+    Добавляет в существующую базу колонки и индексы, появившиеся в моделях,
+    и заполняет новые колонки по существующим данным.
+    """
+    inspector = inspect(engine)
+    added = []
+
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                    print(f"Миграция: добавлена колонка {table.name}.{column.name}")
+                    added.append((table.name, column.name))
+
+            for index in table.indexes:
+                index.create(bind=connection, checkfirst=True)
+
+        for trigger in state_triggers() + version_triggers():
+            connection.execute(text(trigger))
+
+        for key, queries in BACKFILLS.items():
+            if key in added:
+                for query in queries:
+                    connection.execute(text(query))
+                print(f"Миграция: заполнены колонки состояния {key[0]}")
 
 
 async def create_tables():
     Base.metadata.create_all(bind=engine)
+    migrate()
 
 
 async def drop_tables():
@@ -0,0 +1,411 @@
+import os
+import shutil
+import asyncio
+import zipfile
+import multiprocessing
+from queue import Empty
+from uuid import uuid4
+from pathlib import Path
+from datetime import datetime
+from zoneinfo import ZoneInfo
+from concurrent.futures import ProcessPoolExecutor
+
+from .db import DBTask, DBIngestJob, SessionLocal
+from .uploader import TaskUploader
+from .worker import CollectKadTask
+from . import profiler
+from .tracing import trace, trace_headers, current_trace_id
+from .blobs import claim_blobs, discard_blobs, sweep_blob_leases
+from .preprocess import merge_stats
+from .admission import wait_for_capacity, ADMISSION_GROUP_MAX_TASKS
+
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', '0')) or os.cpu_count()  # процессы для разбора файлов
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', '20'))  # охватов в порции, передаваемой из пула
+INGEST_TMP = 'data/tmp'
+INGEST_DEST = 'data/uploaded'
+
+SOURCE_EXTENSIONS = ('.geojson', '.shp')
+MEMBER_EXTENSIONS = ('.geojson', '.cpg', '.dbf', '.prj', '.shp', '.shx')
+UPLOAD_EXTENSIONS = ('.zip', '.geojson')
+
+_executor = None
+_manager = None
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """
+    Пул процессов для разбора файлов (создается при первой загрузке).
+    Процессы запускаются через spawn: при fork в них копировались бы цикл событий,
+    соединения с базой и другие ресурсы процесса API.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=INGEST_WORKERS, mp_context=multiprocessing.get_context('spawn')
+        )
+    return _executor
+
+
+def get_manager():
+    """
+    Процесс-менеджер очередей, через которые пул передает порции охватов.
+    """
+    global _manager
+    if _manager is None:
+        _manager = multiprocessing.get_context('spawn').Manager()
+    return _manager
+
+
+def shutdown_executor():
+    global _executor, _manager
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+    if _manager is not None:
+        _manager.shutdown()
+        _manager = None
+
+
+def moscow_now():
+    return datetime.now(ZoneInfo("Europe/Moscow"))
+
+
+def job_dir(job_id: int) -> str:
+    return os.path.join(INGEST_TMP, f'ingest_{job_id}')
+
+
+def parse_dir(job_id: int) -> str:
+    return os.path.join(INGEST_DEST, f'job_{job_id}')
+
+
+def save_upload(content, filename: str, job_id: int) -> str:
+    """
+    Сохраняет загруженный файл во временную папку задачи загрузки без чтения его целиком в память.
+    """
+    folder = job_dir(job_id)
+    os.makedirs(folder, exist_ok=True)
+
+    path = TaskUploader.find_path(os.path.join(folder, os.path.basename(filename)))
+    with open(path, 'wb') as f:
+        shutil.copyfileobj(content.file, f, 1024 * 1024)
+
+    return path
+
+
+def split_upload(path: str, filename: str) -> list[str]:
+    """
+    Получение слоев для разбора из загруженного файла.
+    ZIP-архив распаковывается с сохранением структуры, чтобы SHP оставались рядом со своими DBF, PRJ и SHX.
+
+    :return:
+        Список путей к GeoJSON и SHP файлам.
+    """
+    if Path(filename).suffix != '.zip':
+        return [path]
+
+    members_dir = TaskUploader.find_path(os.path.splitext(path)[0] + '_members')
+    sources = []
+
+    with zipfile.ZipFile(path, 'r') as zip_ref:
+        for zip_info in zip_ref.infolist():
+            if zip_info.is_dir() or Path(zip_info.filename).suffix not in MEMBER_EXTENSIONS:
+                continue
+
+            member_path = zip_ref.extract(zip_info, members_dir)
+            if Path(member_path).suffix in SOURCE_EXTENSIONS:
+                sources.append(member_path)
+
+    return sources
+
+
+def count_features(source: str) -> int:
+    """
+    Количество объектов в слое (выполняется в пуле процессов, чтобы не загружать GDAL в процесс API).
+    """
+    import pyogrio
+
+    return pyogrio.read_info(source, force_feature_count=True)['features']
+
+
+def parse_source(
+    source: str, dest: str, filename: str, queue, number: int, profile=False, limit: int | None = None
+) -> tuple[int, dict]:
+    """
+    Разбор одного слоя в отдельном процессе.
+    Охваты передаются в очередь порциями по INGEST_BATCH_SIZE по мере сохранения,
+    чтобы задачи ставились в очередь Celery, не дожидаясь разбора всего слоя.
+
+    :param queue: Очередь порций (номер слоя, [(имя охвата, ключ охвата, [(имя тайла, ключ тайла)])]).
+    :param number: Номер слоя в задаче загрузки.
+    :param profile: Профилировать разбор слоя.
+    :param limit: Максимальное количество объектов слоя для разбора.
+
+    :return:
+        Количество охватов слоя и статистика подготовки геометрий.
+    """
+    os.makedirs(dest, exist_ok=True)
+    batch = []
+    total = 0
+    stats = {}
+
+    with profiler.profile('ingest', f'parse_{os.path.basename(source)}', enabled=profile):
+        try:
+            for cover in TaskUploader.make_parts(dest, source, filename, stats=stats, limit=limit):
+                batch.append(cover)
+                total += 1
+                if len(batch) >= INGEST_BATCH_SIZE:
+                    queue.put((number, batch))
+                    batch = []
+        except Exception:
+            # охваты неотправленной порции сохранены, но задач для них не будет
+            discard_blobs(*cover_keys(batch))
+            raise
+
+        if batch:
+            queue.put((number, batch))
+
+    return total, stats
+
+
+def cover_keys(covers: list) -> list[str]:
+    """
+    Ключи файлов охватов и их тайлов.
+
+    :param covers: Список (имя охвата, ключ охвата, [(имя тайла, ключ тайла)]).
+    """
+    return [key for _, path, tiles in covers for key in (path, *(tile for _, tile in tiles))]
+
+
+async def plan_sources(loop, sources: list[tuple[str, str]], errors: list) -> list[tuple[str, str, int | None]]:
+    """
+    Распределение лимита охватов одной загрузки (ADMISSION_GROUP_MAX_TASKS) между слоями до их разбора,
+    чтобы объекты сверх лимита не разбирались и не сохранялись.
+
+    :param sources: Список (путь к слою, исходное имя файла).
+    :param errors: Список ошибок загрузки, в который добавляются пропущенные объекты.
+    :return:
+        Список (путь к слою, исходное имя файла, количество объектов для разбора или None без лимита).
+    """
+    if ADMISSION_GROUP_MAX_TASKS <= 0:
+        return [(source, filename, None) for source, filename in sources]
+
+    counts = await asyncio.gather(
+        *(loop.run_in_executor(get_executor(), count_features, source) for source, _ in sources),
+        return_exceptions=True,
+    )
+
+    budget = ADMISSION_GROUP_MAX_TASKS
+    planned = []
+    for (source, filename), count in zip(sources, counts):
+        if isinstance(count, Exception):
+            errors.append(f"{filename}: {count}")
+            continue
+
+        limit = min(count, budget)
+        if count > limit:
+            errors.append(
+                f"{filename}: Превышен лимит охватов в одной загрузке ({ADMISSION_GROUP_MAX_TASKS}), "
+                f"пропущено объектов: {count - limit}"
+            )
+        if limit:
+            planned.append((source, filename, limit))
+            budget -= limit
+
+    return planned
+
+
+def enqueue_cover(db_group, name, path, tiles, added, profile=False):
+    """
+    Создает задачу для охвата и отправляет ее в очередь.
+    Если охват разбит на тайлы, создается логическая задача без Celery-задачи,
+    а в очередь параллельно отправляются задачи тайлов.
+
+    :param name: Имя охвата.
+    :param path: Ключ файла охвата в хранилище.
+    :param tiles: Список (имя тайла, ключ тайла).
+    """
+    with trace('ingest.enqueue', cover=name, tiles=len(tiles)) as span:
+        db_task = TaskUploader.create_or_update(
+            model=DBTask,
+            params={
+                'name': name,
+                'cover_file': path,
+                'added': added,
+                'group_id': db_group.id,
+                'celery_task': None if tiles else str(uuid4()),
+                'trace_id': current_trace_id(),
+            },
+        )
+
+        sub_tasks = [db_task] if not tiles else [
+            TaskUploader.create_or_update(
+                model=DBTask,
+                params={
+                    'name': tile_name,
+                    'cover_file': tile,
+                    'added': added,
+                    'group_id': db_group.id,
+                    'parent_id': db_task.id,
+                    'celery_task': str(uuid4()),
+                    'trace_id': current_trace_id(),
+                },
+            )
+            for tile_name, tile in tiles
+        ]
+        if span:
+            span.set(task_id=db_task.id)
+        claim_blobs(path, *(tile for _, tile in tiles))
+
+        if tiles:
+            # количество тайлов видно в статусе логической задачи сразу после постановки в очередь
+            db_task = TaskUploader.update_parent(db_task.id)
+
+        for sub_task in sub_tasks:
+            CollectKadTask().apply_async(
+                args=(sub_task.id,), kwargs={'profile': profile}, task_id=sub_task.celery_task, headers=trace_headers()
+            )
+
+    return db_task
+
+
+async def parse_traced(
+    loop, source: str, dest: str, filename: str, queue, number: int, profile=False, limit: int | None = None
+) -> tuple[int, dict]:
+    with trace('ingest.parse', source=os.path.basename(source)):
+        return await loop.run_in_executor(
+            get_executor(), parse_source, source, dest, filename, queue, number, profile, limit
+        )
+
+
+async def run_ingest_job(
+    job_id: int, uploads: list[tuple[str, str]], db_group, added, profile=False, traceparent=None
+):
+    """
+    Разбор загруженных файлов в пуле процессов.
+    Задачи отправляются в очередь порциями по мере разбора слоев.
+
+    :param job_id: ID задачи загрузки.
+    :param uploads: Список (путь к сохраненному файлу, исходное имя файла).
+    :param db_group: Группа задач.
+    :param added: Время добавления задач.
+    :param profile: Профилировать разбор файлов и созданные задачи.
+    :param traceparent: Контекст трассы запроса загрузки.
+    """
+    with trace('ingest', traceparent=traceparent, root=True, job_id=job_id, group_id=db_group.id):
+        with trace('ingest.wait'):
+            slots = await wait_for_capacity(job_id, update_job)
+        try:
+            await ingest(job_id, uploads, db_group, added, profile)
+        finally:
+            slots.release()
+
+
+async def ingest(job_id: int, uploads: list[tuple[str, str]], db_group, added, profile=False):
+    loop = asyncio.get_running_loop()
+    errors = []
+    tasks_created = 0
+    parts_done = 0
+    job_stats = {}
+
+    try:
+        sources = []
+        for path, filename in uploads:
+            try:
+                layers = await asyncio.to_thread(split_upload, path, filename)
+                sources.extend((layer, filename) for layer in layers)
+            except Exception as e:
+                errors.append(f"{filename}: {e}")
+
+        sources = await plan_sources(loop, sources, errors)
+        await asyncio.to_thread(update_job, job_id, state='RUNNING', parts_total=len(sources), errors=errors)
+
+        # у каждого слоя своя папка, чтобы параллельные процессы не выбирали одинаковые имена файлов
+        queue = await asyncio.to_thread(get_manager().Queue)
+        pending = {
+            asyncio.ensure_future(
+                parse_traced(loop, source, f"{parse_dir(job_id)}/{number}/", filename, queue, number, profile, limit)
+            )
+            for number, (source, filename, limit) in enumerate(sources)
+        }
+
+        while pending:
+            # порции, отправленные слоем, попадают в очередь до завершения его разбора
+            done, pending = await asyncio.wait(pending, timeout=0.5, return_when=asyncio.FIRST_COMPLETED)
+            batches = await asyncio.to_thread(drain_queue, queue)
+
+            for _, covers in batches:
+                for name, path, tiles in covers:
+                    if ADMISSION_GROUP_MAX_TASKS > 0 and tasks_created >= ADMISSION_GROUP_MAX_TASKS:
+                        # лимит распределяется между слоями до разбора (plan_sources), но если слой
+                        # содержит больше объектов, чем насчитано, лишний охват уже сохранен и задачи для него не будет
+                        errors.append(f"{name}: Превышен лимит охватов в одной загрузке ({ADMISSION_GROUP_MAX_TASKS})")
+                        await asyncio.to_thread(discard_blobs, path, *(tile for _, tile in tiles))
+                        continue
+                    try:
+                        await asyncio.to_thread(enqueue_cover, db_group, name, path, tiles, added, profile)
+                        tasks_created += 1
+                    except Exception as e:
+                        errors.append(str(e))
+                        await asyncio.to_thread(discard_blobs, path, *(tile for _, tile in tiles))
+
+            for future in done:
+                parts_done += 1
+                if future.exception():
+                    errors.append(str(future.exception()))
+                    continue
+
+                _, stats = future.result()
+                errors.extend(stats.pop('errors', []))
+                job_stats = merge_stats(job_stats, stats)
+
+            if batches or done:
+                await asyncio.to_thread(
+                    update_job,
+                    job_id,
+                    parts_done=parts_done,
+                    tasks_created=tasks_created,
+                    errors=errors,
+                    stats=job_stats,
+                )
+
+        state = 'FAILED' if errors and not tasks_created else 'SUCCESS'
+        await asyncio.to_thread(update_job, job_id, state=state, finished=moscow_now())
+    except Exception as e:
+        errors.append(str(e))
+        await asyncio.to_thread(update_job, job_id, state='FAILED', errors=errors, finished=moscow_now())
+    finally:
+        # охваты и тайлы перенесены в хранилище блобов, в папках разбора остаются только временные файлы
+        await asyncio.to_thread(shutil.rmtree, job_dir(job_id), ignore_errors=True)
+        await asyncio.to_thread(shutil.rmtree, parse_dir(job_id), ignore_errors=True)
+        await asyncio.to_thread(sweep_blob_leases)
+
+
+def drain_queue(queue) -> list:
+    """
+    Все порции охватов, которые уже есть в очереди.
+    """
+    batches = []
+    while True:
+        try:
+            batches.append(queue.get_nowait())
+        except Empty:
+            return batches
+
+
+def update_job(job_id: int, **params):
+    return TaskUploader.create_or_update(model=DBIngestJob, instance=job_id, params=params)
+
+
+def fail_interrupted_jobs():
+    """
+    Помечает задачи загрузки, прерванные перезапуском приложения.
+    """
+    db = SessionLocal()
+    try:
+        db.query(DBIngestJob).filter(DBIngestJob.state.in_(('QUEUED', 'WAITING', 'RUNNING'))).update(
+            {'state': 'FAILED', 'errors': ['Загрузка прервана перезапуском приложения'], 'finished': moscow_now()},
+            synchronize_session=False,
+        )
+        db.commit()
+    finally:
+        db.close()
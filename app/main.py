@@ -1,21 +1,36 @@
 import os
 import json
+import asyncio
 from contextlib import asynccontextmanager
-from uuid import uuid4
 from datetime import datetime
 from zoneinfo import ZoneInfo
 from pathlib import Path
+from urllib.parse import quote
 
 import aiosqlite
-from fastapi import FastAPI, File, UploadFile, Request, Form
+from fastapi import FastAPI, File, UploadFile, Request, Form, HTTPException, BackgroundTasks
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, RedirectResponse, StreamingResponse
 
-from .uploader import TaskUploader, create_archive, delete_paths, execute_db_operations
+from .uploader import TaskUploader, stream_archive, delete_paths, execute_db_operations
 from .models import TaskModel, ResponseGroupsModel, ResponseTasksModel
-from .db import DBTask, DBTasksGroup, create_tables, drop_tables
-from app.worker import celery, CollectKadTask
+from .db import DBTasksGroup, DBIngestJob, create_tables
+from .ingest import (
+    UPLOAD_EXTENSIONS,
+    save_upload,
+    run_ingest_job,
+    fail_interrupted_jobs,
+    shutdown_executor,
+)
+from .profiler import ProfilingMiddleware, list_profiles, get_profile_path
+from .storage import get_storage, verify
+from .blobs import blob_filename, is_compressed, sweep_blob_leases
+from .cache import conditional_json
+from .breaker import toolbox_breaker
+from .admission import AdmissionMiddleware, admission_status, client_id
+from .tracing import trace, trace_headers, load_trace, filter_spans, critical_path, summarize
+from app.worker import celery, CollectKadTask, send_task
 
 
 DATABASE_URL = "data/database/database.db"
@@ -28,17 +43,23 @@ async def app_lifespan(app: FastAPI):
 
     check_folders()
     await create_tables()
+    fail_interrupted_jobs()
+    sweep_blob_leases()
     tasks = TaskUploader.get_working_tasks()
     for task in tasks:
         print(f"Перезапуск задачи: {task.name}({task.id})")
-        CollectKadTask().apply_async(args=(task.id,), task_id=task.celery_task)
+        send_task(task)
     yield
 
     # здесь можно выполнять код при остановке приложения
+    shutdown_executor()
     # await drop_tables()
 
 
 app = FastAPI(lifespan=app_lifespan)
+app.add_middleware(ProfilingMiddleware)
+# добавлен последним, чтобы отклонять загрузки до профилирования и чтения тела запроса
+app.add_middleware(AdmissionMiddleware)
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 templates = Jinja2Templates(directory="app/templates")
 
@@ -53,131 +74,152 @@ def check_folders():
         'data/database',
         'data/logs',
         'data/tmp',
+        'data/profiles',
+        'data/traces',
+        'data/blobs',
     ]
 
     [os.makedirs(folder, exist_ok=True) for folder in folders]
 
 
+def restart_logical_task(task_id, profile=False):
+    """
+    Перезапуск задачи. Для задачи, разбитой на тайлы, перезапускаются только незавершенные тайлы.
+    Перезапуск начинает новую трассу задачи.
+    """
+    with trace('restart', root=True, task_id=task_id):
+        for db_task in TaskUploader.restart_task(task_id, celery):
+            CollectKadTask().apply_async(
+                args=(db_task.id,), kwargs={'profile': profile}, task_id=db_task.celery_task, headers=trace_headers()
+            )
+
+
 @app.get("/")
 async def home(request: Request):
     return templates.TemplateResponse("index.html", context={"request": request})
 
 
 @app.get("/groups", status_code=200)
-async def get_groups():
+async def get_groups(request: Request):
     """
     Получение списка задач.
     """
     async with aiosqlite.connect(DATABASE_URL) as db:
-        query = """
-        SELECT g.id, g.name, g.added, t.kpt_status, t.kad_status
-        FROM ngw_task_groups g
-        LEFT JOIN ngw_tasks t ON g.id = t.group_id
-        """
 
-        cursor = await db.execute(query)
-        tasks_rows = await cursor.fetchall()
-
-        groups = {}
-        for row in tasks_rows:
-            group_id, name, added, kpt_status, kad_status = row
-
-            if group_id not in groups:
-                groups[group_id] = {
-                    'id': group_id,
-                    'name': name,
-                    'added': added,
-                    'statistics': {
-                        'loaded': 0,
-                        'in_progress': 0,
-                        'completed': 0,
-                        'failed': 0,
-                        'remaining': 0,
-                    },
+        async def build():
+            query = """
+            SELECT
+                g.id, g.name, g.added,
+                COUNT(t.id),
+                COALESCE(SUM(t.state = 'IN_PROGRESS'), 0),
+                COALESCE(SUM(t.state = 'SUCCESS'), 0),
+                COALESCE(SUM(t.state = 'FAILED'), 0)
+            FROM ngw_task_groups g
+            LEFT JOIN ngw_tasks t ON g.id = t.group_id AND t.parent_id IS NULL
+            GROUP BY g.id
+            """
+
+            cursor = await db.execute(query)
+            rows = await cursor.fetchall()
+
+            groups = []
+            for group_id, name, added, loaded, in_progress, completed, failed in rows:
+                stats = {
+                    'loaded': loaded,
+                    'in_progress': in_progress,
+                    'completed': completed,
+                    'failed': failed,
+                    'remaining': loaded - completed - failed,
                 }
+                groups.append(
+                    {
+                        'id': group_id,
+                        'name': name,
+                        'added': added,
+                        'statistics': json.dumps(stats, ensure_ascii=False),
+                    }
+                )
 
-            stats = groups[group_id]['statistics']
-
-            kpt = json.loads(kpt_status) if kpt_status else None
-            kad = json.loads(kad_status) if kad_status else None
-
-            if kpt and kpt['state'] == 'FAILED' or kad and kad['state'] == 'FAILED':
-                stats['failed'] += 1
-            elif kpt and kpt['state'] == 'SUCCESS' and kad and kad['state'] == 'SUCCESS':
-                stats['completed'] += 1
-            elif kpt and kpt['state'] != 'PREPARING' or kad and kad['state'] != 'PREPARING':
-                stats['in_progress'] += 1
-
-            if kpt or kad:
-                stats['loaded'] += 1
-
-        for group in groups.values():
-            stats = group['statistics']
-            stats['remaining'] = stats['loaded'] - stats['completed'] - stats['failed']
-            group['statistics'] = json.dumps(stats, ensure_ascii=False)
+            return ResponseGroupsModel(groups=groups).dict()
 
-        return ResponseGroupsModel(groups=list(groups.values())).dict()
+        return await conditional_json(request, db, 'groups', 'global', build)
 
 
 @app.get("/tasks", status_code=200)
-async def get_tasks():
+async def get_tasks(request: Request, group_id: int = None):
     """
-    Получение списка задач.
+    Получение списка задач (всех или задач одной группы).
     """
 
     async with aiosqlite.connect(DATABASE_URL) as db:
-        cursor = await db.execute("SELECT id, name, added, kpt_status, kad_status, group_id FROM ngw_tasks")
-        tasks = await cursor.fetchall()
 
-        tasks_list = [
-            TaskModel(
-                id=task[0],
-                name=task[1],
-                added=task[2],
-                kpt_status=task[3],
-                kad_status=task[4],
-                group_id=task[5],
-            )
-            for task in tasks
-        ]
+        async def build():
+            query = "SELECT id, name, added, kpt_status, kad_status, group_id FROM ngw_tasks WHERE parent_id IS NULL"
+            params = ()
+            if group_id is not None:
+                query += " AND group_id = ?"
+                params = (group_id,)
+
+            cursor = await db.execute(query, params)
+            tasks = await cursor.fetchall()
+
+            tasks_list = [
+                TaskModel(
+                    id=task[0],
+                    name=task[1],
+                    added=task[2],
+                    kpt_status=task[3],
+                    kad_status=task[4],
+                    group_id=task[5],
+                )
+                for task in tasks
+            ]
+
+            return ResponseTasksModel(tasks=tasks_list).dict()
 
-        return ResponseTasksModel(tasks=tasks_list).dict()
+        scope = 'global' if group_id is None else f'group:{group_id}'
+        return await conditional_json(request, db, f'tasks:{scope}', scope, build)
 
 
 @app.get("/tasks/statistics", status_code=200)
-async def get_groups_statistics():
+async def get_groups_statistics(request: Request):
     """
     Получение статистики по группам на основе задач.
     """
 
     async with aiosqlite.connect(DATABASE_URL) as db:
-        cursor = await db.execute("SELECT kpt_status, kad_status FROM ngw_tasks")
-        tasks = await cursor.fetchall()
 
-        loaded = len(tasks)
-        in_progress = 0
-        completed = 0
-        failed = 0
+        async def build():
+            cursor = await db.execute("SELECT state, COUNT(*) FROM ngw_tasks WHERE parent_id IS NULL GROUP BY state")
+            states = dict(await cursor.fetchall())
 
-        for kpt_status, kad_status in tasks:
-            kpt = json.loads(kpt_status) if kpt_status else None
-            kad = json.loads(kad_status) if kad_status else None
+            loaded = sum(states.values())
+            in_progress = states.get('IN_PROGRESS', 0)
+            completed = states.get('SUCCESS', 0)
+            failed = states.get('FAILED', 0)
 
-            if kpt and kpt['state'] == 'FAILED' or kad and kad['state'] == 'FAILED':
-                failed += 1
-            elif kpt and kpt['state'] == 'SUCCESS' and kad and kad['state'] == 'SUCCESS':
-                completed += 1
-            elif kpt and kpt['state'] != 'PREPARING' or kad and kad['state'] != 'PREPARING':
-                in_progress += 1
+            remaining = loaded - completed - failed
+            return {
+                'loaded': loaded,
+                'in_progress': in_progress,
+                'completed': completed,
+                'failed': failed,
+                'remaining': remaining,
+            }
 
-        remaining = loaded - completed - failed
-        return {
-            'loaded': loaded,
-            'in_progress': in_progress,
-            'completed': completed,
-            'failed': failed,
-            'remaining': remaining,
-        }
+        return await conditional_json(request, db, 'statistics', 'global', build)
+
+
+def archive_response(root: str, files: list, filename: str):
+    """
+    Отдает архив по мере его сборки: файлы читаются из хранилища потоком,
+    архив не сохраняется ни на диск, ни в хранилище.
+    """
+    return StreamingResponse(
+        stream_archive(root, files),
+        media_type='application/zip',
+        headers={'Content-Disposition': f"attachment; filename*=utf-8''{quote(filename)}"},
+    )
 
 
 @app.get("/groups/{group_id}/download", status_code=200)
@@ -185,15 +227,9 @@ async def download_group_files(group_id: int):
     """
     Скачивание файлов группы по ее id.
     """
-    os.makedirs('temp', exist_ok=True)
-    archive_name = f"data/temp/group_{group_id}_files"
-
-    if os.path.exists(archive_name + '.zip'):
-        os.remove(archive_name + '.zip')
-
     async with aiosqlite.connect(DATABASE_URL) as db:
         query = """
-        SELECT t.kpt_file, t.kad_file, g.name
+        SELECT t.kpt_file, t.kad_file, g.name, t.name
         FROM ngw_task_groups g
         LEFT JOIN ngw_tasks t ON g.id = t.group_id
         WHERE g.id = ?
@@ -202,11 +238,8 @@ async def download_group_files(group_id: int):
         cursor = await db.execute(query, (group_id,))
         group_files = await cursor.fetchall()
 
-        files = [file for task in group_files for file in task if file]
-        group_path = f'data/temp/group_{group_id}'
-        await create_archive(group_path, files, archive_name)
-
-        return FileResponse(path=archive_name + '.zip', filename=f"{group_files[0][2]}_files.zip")
+    files = [(file, blob_filename(file, task[3])) for task in group_files for file in task[:2] if file]
+    return archive_response(f'group_{group_id}', files, filename=f"{group_files[0][2]}_files.zip")
 
 
 @app.get("/tasks/{task_id}/download", status_code=200)
@@ -214,20 +247,108 @@ async def download_task_files(task_id: int):
     """
     Скачивание файлов задачи по ее id.
     """
-    os.makedirs('temp', exist_ok=True)
-    archive_name = f"data/temp/task_{task_id}_files"
+    async with aiosqlite.connect(DATABASE_URL) as db:
+        cursor = await db.execute(
+            "SELECT kpt_file, kad_file, name FROM ngw_tasks WHERE id = ? OR parent_id = ? ORDER BY id",
+            (task_id, task_id),
+        )
+        task_files = await cursor.fetchall()
+
+    files = [(file, blob_filename(file, task[2])) for task in task_files for file in task[:2] if file]
+    return archive_response(f'task_{task_id}', files, filename=f"{task_files[0][2]}_files.zip")
+
 
-    if os.path.exists(archive_name + '.zip'):
-        os.remove(archive_name + '.zip')
+@app.get("/tasks/{task_id}/files/{kind}", status_code=307)
+async def get_task_file(task_id: int, kind: str):
+    """
+    Ссылка на скачивание отдельного файла задачи (cover, kpt, kad) напрямую из хранилища.
+    """
+    columns = {'cover': 'cover_file', 'kpt': 'kpt_file', 'kad': 'kad_file'}
+    if kind not in columns:
+        raise HTTPException(status_code=404, detail=f'Неизвестный тип файла: {kind}')
 
     async with aiosqlite.connect(DATABASE_URL) as db:
-        cursor = await db.execute("SELECT kpt_file, kad_file, name FROM ngw_tasks WHERE id = ?", (task_id,))
-        task_files = await cursor.fetchone()
+        cursor = await db.execute(f"SELECT {columns[kind]}, name FROM ngw_tasks WHERE id = ?", (task_id,))
+        row = await cursor.fetchone()
+
+    if not row or not row[0]:
+        raise HTTPException(status_code=404, detail='Файл не найден')
+
+    # сжатые блобы отдаются как есть, браузер распаковывает их по Content-Encoding
+    encoding = 'gzip' if is_compressed(row[0]) else None
+    return RedirectResponse(get_storage().url(row[0], filename=blob_filename(row[0], row[1]), encoding=encoding))
 
-    task_path = f'data/temp/task_{task_id}'
-    await create_archive(task_path, [file for file in task_files if file], archive_name)
 
-    return FileResponse(path=archive_name + '.zip', filename=f"{task_files[2]}_files.zip")
+def trace_report(trace_id: str, task_ids: set[int] | None = None) -> dict:
+    spans = load_trace(trace_id)
+    if task_ids is not None:
+        spans = filter_spans(spans, task_ids)
+
+    return {
+        'trace_id': trace_id,
+        'duration': max((span['end'] or span['start'] for span in spans), default=0)
+        - min((span['start'] for span in spans), default=0),
+        'critical_path': critical_path(spans),
+        'summary': summarize(spans),
+        'spans': spans,
+    }
+
+
+@app.get("/tasks/{task_id}/trace", status_code=200)
+async def get_task_trace(task_id: int):
+    """
+    Трасса последнего запуска задачи: спаны загрузки, задачи Celery (и ее тайлов),
+    запросов к NG Toolbox и записей в базу, а также критический путь.
+    """
+    async with aiosqlite.connect(DATABASE_URL) as db:
+        cursor = await db.execute(
+            "SELECT id, trace_id FROM ngw_tasks WHERE id = ? OR parent_id = ?", (task_id, task_id)
+        )
+        rows = await cursor.fetchall()
+
+    if not rows:
+        raise HTTPException(status_code=404, detail='Задача не найдена')
+
+    task_ids = {row[0] for row in rows}
+    trace_ids = sorted({row[1] for row in rows if row[1]})
+    return {'task_id': task_id, 'traces': [await asyncio.to_thread(trace_report, t, task_ids) for t in trace_ids]}
+
+
+@app.get("/groups/{group_id}/trace", status_code=200)
+async def get_group_trace(group_id: int):
+    """
+    Трассы задач группы с критическим путем каждой трассы.
+    Спаны возвращаются только по запросу /tasks/{task_id}/trace.
+    """
+    async with aiosqlite.connect(DATABASE_URL) as db:
+        cursor = await db.execute(
+            "SELECT DISTINCT trace_id FROM ngw_tasks WHERE group_id = ? AND trace_id IS NOT NULL", (group_id,)
+        )
+        trace_ids = [row[0] for row in await cursor.fetchall()]
+
+    traces = []
+    for trace_id in trace_ids:
+        report = await asyncio.to_thread(trace_report, trace_id)
+        report.pop('spans')
+        traces.append(report)
+
+    return {'group_id': group_id, 'traces': sorted(traces, key=lambda item: item['duration'], reverse=True)}
+
+
+@app.get("/files/{key:path}", status_code=200)
+async def get_storage_file(key: str, expires: int, signature: str, filename: str = None, encoding: str = None):
+    """
+    Скачивание файла локального хранилища по подписанной ссылке (поддерживаются Range-запросы).
+    """
+    storage = get_storage()
+    if not storage.is_local or not verify(key, expires, signature, filename=filename, encoding=encoding):
+        raise HTTPException(status_code=403, detail='Ссылка недействительна')
+
+    if not storage.exists(key):
+        raise HTTPException(status_code=404, detail='Файл не найден')
+
+    headers = {'Content-Encoding': encoding} if encoding == 'gzip' else None
+    return FileResponse(path=key, filename=filename or os.path.basename(key), headers=headers)
 
 
 @app.delete("/groups/{group_id}/delete", status_code=200)
@@ -242,17 +363,16 @@ async def delete_group(group_id: int):
         files_for_delete = []
         for task in tasks:
             if task[0]:
-                celery.control.revoke(task[0], terminate=True)
+                celery.control.revoke(task[0])
             files_for_delete.extend(task[1:])
 
-        files_for_delete.append(f'data/temp/group_{group_id}_files.zip')
-        await delete_paths(*files_for_delete)
-
+        # файлы удаляются после задач: блобы, на которые ссылаются другие задачи, сохраняются
         await execute_db_operations(
             db,
             ("DELETE FROM ngw_tasks WHERE group_id = ?", (group_id,)),
             ("DELETE FROM ngw_task_groups WHERE id = ?", (group_id,)),
         )
+        await delete_paths(*files_for_delete)
 
     return {'message': 'Группа успешно удалена'}
 
@@ -261,101 +381,192 @@ async def delete_group(group_id: int):
 async def delete_task(task_id: int):
     async with aiosqlite.connect(DATABASE_URL) as db:
         cursor = await db.execute(
-            "SELECT celery_task, kpt_file, kad_file, cover_file FROM ngw_tasks WHERE id = ?",
-            (task_id,),
+            "SELECT celery_task, kpt_file, kad_file, cover_file FROM ngw_tasks WHERE id = ? OR parent_id = ?",
+            (task_id, task_id),
         )
-        task_files = await cursor.fetchone()
-
-        if task_files:
-            task_files_list = list(task_files)
-            celery.control.revoke(task_files_list[0], terminate=True)
-
-            files_for_delete = task_files_list[1:]
-            files_for_delete.append(f'data/temp/task_{task_id}_files.zip')
+        tasks = await cursor.fetchall()
 
+        if tasks:
+            files_for_delete = []
+            for task in tasks:
+                if task[0]:
+                    celery.control.revoke(task[0])
+                files_for_delete.extend(task[1:])
+
+            await execute_db_operations(
+                db,
+                ("DELETE FROM ngw_tasks WHERE parent_id = ?", (task_id,)),
+                ("DELETE FROM ngw_tasks WHERE id = ?", (task_id,)),
+            )
             await delete_paths(*files_for_delete)
-            await execute_db_operations(db, ("DELETE FROM ngw_tasks WHERE id = ?", (task_id,)))
 
     return {'message': 'Задача успешно удалена'}
 
 
 @app.post("/run_tasks", status_code=200)
-async def run_task(files: list[UploadFile] = File(...), name: str = Form(None)):
+async def run_task(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    files: list[UploadFile] = File(...),
+    name: str = Form(None),
+    profile: bool = False,
+):
     """
     Принимает один или несколько файлов (GeoJSON или ZIP).
-    Загруженные файлы отправляются на обработку.
+    Файлы сохраняются, а их разбор и постановка задач в очередь выполняются в фоне.
+    Ход загрузки доступен по /ingest/{job_id}.
 
     Args:
         files: Список файлов для обработки.
         name: Название группы задач.
+        profile: Профилировать разбор файлов и созданные задачи.
 
     Returns:
-        Статус об успешной загрузке и обработке файлов.
+        ID задачи загрузки и ошибки приема файлов.
     """
-    errors = []
+    # трасса загрузки продолжается в разборе файлов, задачах Celery и запросах к NG Toolbox
+    with trace('run_tasks', traceparent=request.headers.get('traceparent'), root=True, files=len(files)) as span:
+        errors = []
+        uploads = []
 
-    try:
         moscow_time = datetime.now(ZoneInfo("Europe/Moscow"))
+        client = client_id(request.scope)
+        size = int(request.headers.get('content-length') or 0)
 
         db_group = TaskUploader.create_or_update(
             model=DBTasksGroup,
-            params={'name': name or Path(files[0].filename).stem, 'added': moscow_time},
+            params={'name': name or Path(files[0].filename).stem, 'added': moscow_time, 'client': client},
+        )
+        # задачу загрузки создает AdmissionMiddleware при резервировании места под загрузку
+        db_job = TaskUploader.create_or_update(
+            model=DBIngestJob,
+            instance=getattr(request.state, 'ingest_job_id', None),
+            params={
+                'group_id': db_group.id,
+                'added': moscow_time,
+                'state': 'QUEUED',
+                'errors': [],
+                'client': client,
+                'size': size,
+            },
         )
+        if span:
+            span.set(group_id=db_group.id, job_id=db_job.id)
 
         for file in files:
-            paths = TaskUploader.upload_file(content=file, filename=file.filename)
-
-            for path in paths:
-                celery_uuid = uuid4()
-                db_task = TaskUploader.create_or_update(
-                    model=DBTask,
-                    params={
-                        'name': Path(path).stem,
-                        'cover_file': path,
-                        'added': moscow_time,
-                        'group_id': db_group.id,
-                        'celery_task': str(celery_uuid),
-                    },
-                )
-                CollectKadTask().apply_async(args=(db_task.id,), task_id=str(celery_uuid))
-    except Exception as e:
-        errors.append(str(e))
+            file_ext = Path(file.filename).suffix
+            if file_ext not in UPLOAD_EXTENSIONS:
+                errors.append(f"{file.filename}: Неизвестное расширение файла: {file_ext}")
+                continue
+
+            try:
+                path = await asyncio.to_thread(save_upload, file, file.filename, db_job.id)
+                uploads.append((path, file.filename))
+            except Exception as e:
+                errors.append(f"{file.filename}: {e}")
+
+        background_tasks.add_task(
+            run_ingest_job, db_job.id, uploads, db_group, moscow_time, profile, span.traceparent if span else None
+        )
+
+    return {
+        'message': 'Файлы приняты в обработку',
+        'job_id': db_job.id,
+        'group_id': db_group.id,
+        'trace_id': span.trace_id if span else None,
+        'errors': errors,
+    }
+
+
+@app.get("/ingest/{job_id}", status_code=200)
+async def get_ingest_job(job_id: int):
+    """
+    Ход разбора загруженных файлов.
+    """
+    async with aiosqlite.connect(DATABASE_URL) as db:
+        cursor = await db.execute(
+            "SELECT id, group_id, state, parts_total, parts_done, tasks_created, errors, stats, added, finished "
+            "FROM ngw_ingest_jobs WHERE id = ?",
+            (job_id,),
+        )
+        job = await cursor.fetchone()
+
+    if not job:
+        raise HTTPException(status_code=404, detail='Задача загрузки не найдена')
+
+    job_id, group_id, state, parts_total, parts_done, tasks_created, errors, stats, added, finished = job
+    return {
+        'id': job_id,
+        'group_id': group_id,
+        'state': state,
+        'parts_total': parts_total,
+        'parts_done': parts_done,
+        'tasks_created': tasks_created,
+        'errors': json.loads(errors) if errors else [],
+        'stats': json.loads(stats) if stats else {},
+        'added': added,
+        'finished': finished,
+    }
+
+
+@app.post("/tasks/{task_id}/cancel", status_code=200)
+async def cancel_task(task_id: int):
+    """
+    Отмена задачи по ее id (для логической задачи - всех ее тайлов). Выполняющаяся задача завершается воркером,
+    задача на сервере NG Toolbox отменяется, если сервер это поддерживает.
+    """
+    cancelled = TaskUploader.request_cancel([task_id], celery)
+
+    return {'message': f'Запрошена отмена задач: {cancelled}'}
+
+
+@app.post("/groups/{group_id}/cancel", status_code=200)
+async def cancel_group(group_id: int):
+    """
+    Отмена всех незавершенных задач группы.
+    """
+    async with aiosqlite.connect(DATABASE_URL) as db:
+        cursor = await db.execute("SELECT id FROM ngw_tasks WHERE group_id = ? AND parent_id IS NULL", (group_id,))
+        task_ids = [row[0] for row in await cursor.fetchall()]
+
+    cancelled = TaskUploader.request_cancel(task_ids, celery)
 
-    return {'message': 'Задачи успешно добавлены в очередь', 'errors': errors}
+    return {'message': f'Запрошена отмена задач: {cancelled}'}
 
 
 @app.post("/tasks/{task_id}/restart", status_code=200)
-async def restart_task(task_id: int):
+async def restart_task(task_id: int, profile: bool = False):
     """
     Перезапуск задачи по ее id.
 
     Args:
         task_id: id задачи.
+        profile: Профилировать перезапущенную задачу.
 
     Returns:
         Статус об успешном перезапуске задачи.
     """
-    db_task = TaskUploader.restart_task(task_id, celery)
-    CollectKadTask().apply_async(args=(db_task.id,), task_id=db_task.celery_task)
+    restart_logical_task(task_id, profile)
 
     return {'message': 'Задача успешно перезапущена'}
 
 
 # перезапуск группы задач
 @app.post("/groups/{group_id}/restart", status_code=200)
-async def restart_group(group_id: int):
+async def restart_group(group_id: int, profile: bool = False):
     """
     Перезапуск группы задач по ее id.
 
     Args:
         group_id: id группы задач.
+        profile: Профилировать перезапущенные задачи.
 
     Returns:
         Статус об успешном перезапуске группы задач.
     """
 
     async with aiosqlite.connect(DATABASE_URL) as db:
-        cursor = await db.execute("SELECT id FROM ngw_tasks WHERE group_id = ?", (group_id,))
+        cursor = await db.execute("SELECT id FROM ngw_tasks WHERE group_id = ? AND parent_id IS NULL", (group_id,))
         tasks = await cursor.fetchall()
 
         moscow_time = datetime.now(ZoneInfo("Europe/Moscow"))
@@ -363,7 +574,74 @@ async def restart_group(group_id: int):
         TaskUploader.create_or_update(model=DBTasksGroup, instance=group_id, params={'added': moscow_time})
 
         for task in tasks:
-            db_task = TaskUploader.restart_task(task[0], celery)
-            CollectKadTask().apply_async(args=(db_task.id,), task_id=db_task.celery_task)
+            restart_logical_task(task[0], profile)
 
     return {'message': 'Группа успешно перезапущена'}
+
+
+@app.get("/admin/profiles", status_code=200)
+async def get_profiles():
+    """
+    Получение списка сохраненных профилей запросов и задач.
+    """
+    profiles = sorted(list_profiles(), key=lambda item: item['created'], reverse=True)
+    return {'profiles': profiles}
+
+
+@app.get("/admin/profiles/{name}", status_code=200)
+async def download_profile(name: str):
+    """
+    Скачивание профиля по его имени (формат collapsed stacks).
+    """
+    path = get_profile_path(name)
+    if not path:
+        raise HTTPException(status_code=404, detail='Профиль не найден')
+
+    return FileResponse(path=path, filename=name, media_type='text/plain')
+
+
+@app.get("/admin/poll_stats", status_code=200)
+async def get_poll_statistics():
+    """
+    Статистика опроса статусов NG Toolbox: длительность задач, число запросов статуса
+    и задержка обнаружения завершения.
+    """
+    async with aiosqlite.connect(DATABASE_URL) as db:
+        query = """
+        SELECT operation, COUNT(*), AVG(duration), AVG(polls), AVG(detection_delay), MAX(detection_delay)
+        FROM ngw_job_stats
+        GROUP BY operation
+        """
+
+        cursor = await db.execute(query)
+        rows = await cursor.fetchall()
+
+    return {
+        'operations': [
+            {
+                'operation': operation,
+                'jobs': jobs,
+                'avg_duration': avg_duration,
+                'avg_polls': avg_polls,
+                'avg_detection_delay': avg_delay,
+                'max_detection_delay': max_delay,
+            }
+            for operation, jobs, avg_duration, avg_polls, avg_delay, max_delay in rows
+        ]
+    }
+
+
+@app.get("/admin/breaker", status_code=200)
+async def get_breaker_status():
+    """
+    Состояние предохранителя запросов к NG Toolbox.
+    """
+    return await asyncio.to_thread(toolbox_breaker.status)
+
+
+@app.get("/admin/admission", status_code=200)
+async def get_admission_status(request: Request):
+    """
+    Текущая нагрузка и лимиты приема загрузок.
+    """
+    return await admission_status(client_id(request.scope))
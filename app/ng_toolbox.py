@@ -1,12 +1,45 @@
 import os
 import requests
-from requests.exceptions import RequestException, Timeout
+from requests.exceptions import RequestException, Timeout, ConnectionError
+
+from .breaker import toolbox_breaker
+from .blobs import blob_file
+from .tracing import trace, trace_headers
+
+
+class ToolboxError(Exception):
+    pass
+
+
+class TransientToolboxError(ToolboxError):
+    """
+    Временная ошибка (таймаут, обрыв соединения, 429, 5xx). Запрос можно повторить позже.
+    """
+    pass
+
+
+class PermanentToolboxError(ToolboxError):
+    """
+    Ошибка, которая не исчезнет при повторе (например, 4xx из-за некорректных данных).
+    """
+    pass
+
+
+class CircuitOpenError(TransientToolboxError):
+    """
+    Запросы к NextGIS Toolbox приостановлены предохранителем.
+    """
+
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super().__init__(f'NGToolbox: Сервис недоступен, запросы приостановлены на {int(retry_after)} сек')
 
 
 class NGToolbox:
     upload_url = os.getenv('NGT_UPLOAD_URL')
     execute_url = os.getenv('NGT_EXECUTE_URL')
     status_url = os.getenv('NGT_STATUS_URL')
+    cancel_url = os.getenv('NGT_CANCEL_URL')  # необязательный, если сервер поддерживает отмену задач
     token = os.getenv('NGT_TOKEN')
     api_key = os.getenv('NGT_API_KEY')
     headers = {'Authorization': 'Token ' + token}
@@ -15,35 +48,58 @@ class NGToolbox:
     def make_request(url, req_type='get', data=None, json=None, params=None, timeout=30, max_attempts=5):
         attempt = 0
         while attempt < max_attempts:
+            retry_after = toolbox_breaker.retry_after()
+            if retry_after:
+                raise CircuitOpenError(retry_after)
+
             try:
-                response = requests.request(
-                    req_type,
-                    url,
-                    data=data,
-                    params=params,
-                    json=json,
-                    headers=NGToolbox.headers,
-                    verify=False,
-                    timeout=timeout
-                )
-
-                response.raise_for_status()
+                with trace('toolbox.request', method=req_type.upper(), url=url, attempt=attempt + 1) as span:
+                    response = requests.request(
+                        req_type,
+                        url,
+                        data=data,
+                        params=params,
+                        json=json,
+                        headers={**NGToolbox.headers, **trace_headers()},
+                        verify=False,
+                        timeout=timeout
+                    )
+                    if span:
+                        span.set(status_code=response.status_code)
+
+                    response.raise_for_status()
+                toolbox_breaker.record_success()
                 return response
-            except Timeout:
-                print(f"Попытка {attempt + 1} из {max_attempts}. Время ожидания ответа истекло.")
+            except (Timeout, ConnectionError) as e:
+                toolbox_breaker.record_failure()
+                print(f"Попытка {attempt + 1} из {max_attempts}. Сервер не отвечает: {e}")
                 attempt += 1
+                # поток файла нельзя отправить повторно
+                if hasattr(data, 'read'):
+                    break
             except RequestException as e:
-                raise Exception(f'TaskUploader (make_request): Ошибка при выполнении запроса к серверу:<br>{e}')
+                status_code = e.response.status_code if e.response is not None else None
+                message = f'TaskUploader (make_request): Ошибка при выполнении запроса к серверу:<br>{e}'
+                if status_code is None or status_code == 429 or status_code >= 500:
+                    toolbox_breaker.record_failure()
+                    raise TransientToolboxError(message)
 
-        raise Exception(f'TaskUploader (make_request): Превышено количество запросов к серверу ({max_attempts})')
+                # сервер отвечает, ошибка в самом запросе
+                toolbox_breaker.record_success()
+                raise PermanentToolboxError(message)
+
+        raise TransientToolboxError(f'TaskUploader (make_request): Превышено количество запросов к серверу ({max_attempts})')
 
     @staticmethod
     def upload(upload_file):
         try:
-            with open(upload_file, 'rb') as f:
-                url = NGToolbox.upload_url + os.path.basename(upload_file)
+            # сжатые блобы распаковываются во временный файл, имя файла нужно серверу для определения формата
+            with blob_file(upload_file) as path, open(path, 'rb') as f:
+                url = NGToolbox.upload_url + os.path.basename(path)
                 response = NGToolbox.make_request(url, req_type='post', data=f)
                 return response.text  # id файла на сервере
+        except ToolboxError:
+            raise
         except Exception as e:
             raise Exception('NGToolbox (upload): Ошибка при загрузке файла на сервер:<br>', e)
 
@@ -91,3 +147,18 @@ class NGToolbox:
 
         response = NGToolbox.make_request(file_url)
         return response.content
+
+    @staticmethod
+    def cancel(task_id):
+        """
+        Отмена задачи на сервере. Возвращает False, если отмена не поддерживается или не удалась.
+        """
+        if not task_id or not NGToolbox.cancel_url:
+            return False
+
+        try:
+            NGToolbox.make_request(NGToolbox.cancel_url + task_id + '/', req_type='post', max_attempts=2)
+            return True
+        except Exception as e:
+            print(f"NGToolbox (cancel): Не удалось отменить задачу {task_id}: {e}")
+            return False
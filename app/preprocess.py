@@ -0,0 +1,99 @@
+import os
+
+from .tiling import KM_PER_DEGREE, polygonal
+
+COVER_REPAIR = os.getenv('COVER_REPAIR', '1') == '1'  # исправлять невалидные геометрии охватов
+COVER_SIMPLIFY = float(os.getenv('COVER_SIMPLIFY', '0'))  # допуск упрощения охвата, м (0 - без упрощения)
+COVER_PRECISION = int(os.getenv('COVER_PRECISION', '7'))  # знаков после запятой в координатах (0 - без округления)
+
+# geometry_bytes - размер геометрии в GeoJSON с полной точностью (без свойств), сравнивает геометрии до и после;
+# file_bytes - фактический размер записанных файлов охватов
+GEOMETRY_KEYS = (
+    'covers', 'repaired', 'vertices_before', 'vertices_after', 'geometry_bytes_before', 'geometry_bytes_after'
+)
+STATS_KEYS = GEOMETRY_KEYS + ('file_bytes',)
+
+
+def geometry_size(geometry) -> tuple[int, int]:
+    """
+    Число вершин и размер геометрии в GeoJSON с полной точностью в байтах.
+    Это сравнительная оценка, а не размер файла: при записи файла точность задается write_options.
+    """
+    import shapely
+
+    return int(shapely.get_num_coordinates(geometry)), len(shapely.to_geojson(geometry))
+
+
+def write_options() -> dict:
+    """
+    Параметры записи GeoJSON: количество знаков в координатах, чтобы не писать полную точность double.
+    """
+    return {'COORDINATE_PRECISION': COVER_PRECISION} if COVER_PRECISION else {}
+
+
+def preprocess_cover(geometry, name: str, stats: dict | None = None):
+    """
+    Подготовка геометрии охвата перед загрузкой на сервер:
+    исправление (make_valid), упрощение с сохранением топологии и округление координат.
+
+    :param geometry: Геометрия охвата в EPSG:4326.
+    :param name: Имя охвата (для текста ошибки).
+    :param stats: Словарь для накопления статистики (GEOMETRY_KEYS).
+    :return:
+        Подготовленная геометрия.
+    :raises ValueError: Геометрия пустая, невалидная (без исправления) или вырождается после обработки.
+    """
+    import shapely
+
+    if geometry is None or geometry.is_empty:
+        raise ValueError(f"Preprocess: Охват {name} не содержит геометрии")
+
+    vertices_before, bytes_before = geometry_size(geometry)
+    repaired = False
+    # у полигонов после обработки отбрасываются выродившиеся в линии и точки части
+    cleanup = polygonal if geometry.geom_type in ('Polygon', 'MultiPolygon') else lambda g: g
+
+    if not geometry.is_valid:
+        reason = shapely.is_valid_reason(geometry)
+        if not COVER_REPAIR:
+            raise ValueError(f"Preprocess: Невалидная геометрия охвата {name}: {reason}")
+        geometry = cleanup(shapely.make_valid(geometry))
+        if geometry is None or geometry.is_empty:
+            raise ValueError(f"Preprocess: Геометрию охвата {name} не удалось исправить: {reason}")
+        repaired = True
+
+    if COVER_SIMPLIFY:
+        geometry = geometry.simplify(COVER_SIMPLIFY / 1000 / KM_PER_DEGREE, preserve_topology=True)
+
+    if COVER_PRECISION:
+        geometry = shapely.set_precision(geometry, 10**-COVER_PRECISION)
+
+    geometry = cleanup(geometry) if not geometry.is_empty else None
+    if geometry is None or geometry.is_empty:
+        raise ValueError(f"Preprocess: Охват {name} вырождается после упрощения, уменьшите COVER_SIMPLIFY")
+
+    vertices_after, bytes_after = geometry_size(geometry)
+
+    if stats is not None:
+        for key, value in zip(
+            GEOMETRY_KEYS, (1, int(repaired), vertices_before, vertices_after, bytes_before, bytes_after)
+        ):
+            stats[key] = stats.get(key, 0) + value
+
+    return geometry
+
+
+def merge_stats(total: dict | None, stats: dict) -> dict:
+    total = dict(total or {})
+    for key in STATS_KEYS:
+        total[key] = total.get(key, 0) + stats.get(key, 0)
+    return total
+
+
+def format_stats(stats: dict) -> str:
+    return (
+        f"охватов {stats.get('covers', 0)}, исправлено {stats.get('repaired', 0)}, "
+        f"вершин {stats.get('vertices_before', 0)} -> {stats.get('vertices_after', 0)}, "
+        f"байт геометрий {stats.get('geometry_bytes_before', 0)} -> {stats.get('geometry_bytes_after', 0)}, "
+        f"записано байт {stats.get('file_bytes', 0)}"
+    )
@@ -0,0 +1,203 @@
+import os
+import sys
+import time
+import asyncio
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import parse_qs
+
+PROFILES_DIR = 'data/profiles'
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.005'))  # секунды между сэмплами
+PROFILE_RETENTION = int(os.getenv('PROFILE_RETENTION', '50'))  # сколько профилей хранить
+PROFILE_TASKS = os.getenv('PROFILE_TASKS', '0') == '1'  # профилировать все задачи Celery
+
+TRUE_VALUES = ('1', 'true', 'yes', 'on')
+
+
+def is_profiling_requested(*values) -> bool:
+    """
+    Проверяет, запрошено ли профилирование (заголовок, параметр запроса или флаг задачи).
+    """
+    for value in values:
+        if value is True:
+            return True
+        if isinstance(value, (str, bytes)):
+            value = value.decode() if isinstance(value, bytes) else value
+            if value.lower() in TRUE_VALUES:
+                return True
+    return False
+
+
+class SamplingProfiler:
+    """
+    Сэмплирующий профилировщик.
+    Фоновый поток с заданным интервалом снимает стек потока, запустившего профилирование,
+    и сохраняет стеки в формате collapsed stacks (flamegraph, speedscope).
+    Первый элемент каждого стека - имя потока, в котором он снят.
+    """
+
+    def __init__(self, kind: str, label: str, interval=PROFILE_INTERVAL):
+        self.kind = kind
+        self.label = label
+        self.interval = interval
+        self.thread_id = None
+        self.thread_name = None
+        self.samples = Counter()
+        self.started = time.time()
+        self.name = self._make_name()
+        self.duration = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+
+    def _make_name(self) -> str:
+        safe_label = ''.join(c if c.isalnum() or c in '-_' else '_' for c in self.label).strip('_')
+        timestamp = datetime.fromtimestamp(self.started).strftime('%Y%m%d_%H%M%S_%f')
+        return f"{timestamp}_{self.kind}_{safe_label}.folded"
+
+    def start(self):
+        self.thread_id = threading.get_ident()
+        self.thread_name = threading.current_thread().name
+        self.started = time.time()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.duration = time.time() - self.started
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+
+            stack.append(self.thread_name)
+            self.samples[';'.join(reversed(stack))] += 1
+
+    def save(self) -> str:
+        """
+        Сохраняет профиль в папку data/profiles и удаляет устаревшие профили.
+
+        :return:
+            Имя файла профиля.
+        """
+        os.makedirs(PROFILES_DIR, exist_ok=True)
+
+        with open(os.path.join(PROFILES_DIR, self.name), 'w', encoding='utf-8') as f:
+            f.write(
+                f"# {self.kind} {self.label}: {self.duration:.3f} сек, интервал {self.interval} сек, "
+                f"поток {self.thread_name}\n"
+            )
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+        clean_profiles()
+        return self.name
+
+
+@contextmanager
+def profile(kind: str, label: str, enabled: bool = True):
+    """
+    Профилирует блок кода, если профилирование включено.
+    При выключенном профилировании никаких действий не выполняется.
+    """
+    if not enabled:
+        yield
+        return
+
+    profiler = SamplingProfiler(kind, label)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        print(f"Profiler: профиль сохранен в {profiler.save()}")
+
+
+def clean_profiles(retention=PROFILE_RETENTION):
+    """
+    Удаляет самые старые профили сверх лимита хранения.
+    """
+    profiles = sorted(list_profiles(), key=lambda item: item['created'], reverse=True)
+    for item in profiles[retention:]:
+        try:
+            os.remove(os.path.join(PROFILES_DIR, item['name']))
+        except FileNotFoundError:
+            pass
+
+
+def list_profiles():
+    """
+    Получение списка сохраненных профилей.
+    """
+    if not os.path.isdir(PROFILES_DIR):
+        return []
+
+    profiles = []
+    for entry in os.scandir(PROFILES_DIR):
+        if entry.is_file() and entry.name.endswith('.folded'):
+            stat = entry.stat()
+            profiles.append(
+                {
+                    'name': entry.name,
+                    'size': stat.st_size,
+                    'created': datetime.fromtimestamp(stat.st_mtime).isoformat(),
+                }
+            )
+    return profiles
+
+
+def get_profile_path(name: str) -> str | None:
+    """
+    Получение пути к профилю по его имени.
+    """
+    if os.path.basename(name) != name or not name.endswith('.folded'):
+        return None
+
+    path = os.path.join(PROFILES_DIR, name)
+    return path if os.path.isfile(path) else None
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware, профилирующий HTTP-запрос по заголовку X-Profile или параметру ?profile=1.
+    Без запроса профилирования вызов сразу передается приложению.
+    Сэмплируется поток event loop, поэтому в профиль попадают и запросы,
+    которые выполнялись одновременно с профилируемым.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not self._requested(scope):
+            return await self.app(scope, receive, send)
+
+        profiler = SamplingProfiler('http', f"{scope['method']} {scope['path']}")
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = list(message.get('headers', [])) + [(b'x-profile-id', profiler.name.encode())]
+            await send(message)
+
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profiler.stop()
+            name = await asyncio.to_thread(profiler.save)
+            print(f"Profiler: профиль запроса {profiler.label} сохранен в {name}")
+
+    @staticmethod
+    def _requested(scope) -> bool:
+        header = dict(scope.get('headers', [])).get(b'x-profile')
+        query = parse_qs(scope.get('query_string', b'').decode())
+        return is_profiling_requested(header, *query.get('profile', []))
@@ -0,0 +1,197 @@
+import os
+import time
+import random
+import statistics
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+from .db import DBJobStat, SessionLocal
+from .storage import get_storage
+
+POLL_MIN_DELAY = float(os.getenv('POLL_MIN_DELAY', '2'))  # минимальная задержка между запросами статуса, сек
+POLL_MAX_DELAY = float(os.getenv('POLL_MAX_DELAY', '300'))  # максимальная задержка между запросами статуса, сек
+POLL_HISTORY = int(os.getenv('POLL_HISTORY', '50'))  # сколько последних задач учитывать в оценке
+POLL_MAX_LAG = float(os.getenv('POLL_MAX_LAG', '0.2'))  # максимальная задержка как доля прошедшего времени
+
+FINISHED_KEYS = ('finished', 'finished_at', 'completed_at', 'end_time')  # время завершения в ответе сервера
+
+OPERATIONS = {
+    'kpt': 'egrn_kvartals_cover',
+    'kad': 'cadnums_to_geodata',
+}
+
+
+def moscow_now():
+    return datetime.now(ZoneInfo("Europe/Moscow"))
+
+
+def job_size(task_type: str, db_task) -> float | None:
+    """
+    Размер задачи для сравнения с историей: размер файла охвата (КПТ) или списка кварталов (геометрия), КБ.
+    Файл не читается, размер берется из хранилища.
+    """
+    try:
+        key = db_task.cover_file if task_type == 'kpt' else db_task.kpt_file
+        return get_storage().size(key) / 1024
+    except Exception as e:
+        print(f"PollScheduler (job_size): Не удалось определить размер задачи: {e}")
+        return None
+
+
+def extract_progress(status: dict) -> float | None:
+    """
+    Прогресс задачи в процентах, если сервер его сообщает.
+    """
+    progress = status.get('progress')
+    if isinstance(progress, dict):
+        progress = progress.get('percent') or progress.get('value')
+
+    try:
+        progress = float(progress)
+    except (TypeError, ValueError):
+        return None
+
+    return progress if 0 < progress < 100 else None
+
+
+def extract_finished(status: dict) -> float | None:
+    """
+    Время завершения задачи (unix time), если сервер его сообщает (ISO 8601 или unix time).
+    """
+    for key in FINISHED_KEYS:
+        value = status.get(key)
+        if not value:
+            continue
+        try:
+            if isinstance(value, (int, float)):
+                return float(value)
+            finished = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+            if finished.tzinfo is None:
+                finished = finished.replace(tzinfo=ZoneInfo("UTC"))
+            return finished.timestamp()
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+class PollScheduler:
+    """
+    Планировщик запросов статуса задачи NG Toolbox.
+    Задержка до следующего запроса рассчитывается по прогрессу, который сообщает сервер,
+    либо по истории длительности похожих задач (по размеру и времени суток).
+    Без истории используется линейное увеличение задержки.
+    Задержка не превышает доли POLL_MAX_LAG прошедшего времени, поэтому задача, завершившаяся раньше
+    ожидаемого, обнаруживается с опозданием не больше этой доли.
+    """
+
+    def __init__(self, task_type: str, size: float | None = None, started: float | None = None):
+        self.operation = OPERATIONS[task_type]
+        self.size = size
+        self.started = started or time.time()
+        self.polls = 0
+        self.overdue_polls = 0
+        self.last_poll = None  # время последнего запроса статуса, когда задача еще выполнялась
+        self.expected = self.estimate()
+
+    def estimate(self) -> float | None:
+        """
+        Ожидаемая длительность задачи (медиана по похожим задачам).
+        """
+        db = SessionLocal()
+        try:
+            history = (
+                db.query(DBJobStat)
+                .filter(DBJobStat.operation == self.operation)
+                .order_by(DBJobStat.id.desc())
+                .limit(POLL_HISTORY * 4)
+                .all()
+            )
+        finally:
+            db.close()
+
+        if self.size:
+            similar = [stat for stat in history if stat.size and self.size / 2 <= stat.size <= self.size * 2]
+            history = similar or history
+
+        hour = moscow_now().hour
+        same_hours = [stat for stat in history if min(abs(stat.hour - hour), 24 - abs(stat.hour - hour)) <= 2]
+        if len(same_hours) >= 3:
+            history = same_hours
+
+        durations = [stat.duration for stat in history[:POLL_HISTORY]]
+        return statistics.median(durations) if durations else None
+
+    def next_delay(self, status: dict) -> float:
+        """
+        Задержка до следующего запроса статуса.
+
+        :param status: Последний ответ сервера о статусе задачи.
+        """
+        self.polls += 1
+        self.last_poll = time.time()
+        elapsed = self.last_poll - self.started
+        progress = extract_progress(status)
+
+        if progress:
+            remaining = elapsed * (100 - progress) / progress
+        elif self.expected:
+            remaining = self.expected - elapsed
+        else:
+            remaining = None
+
+        if remaining is None:
+            delay = self.polls * 2
+        elif remaining > POLL_MIN_DELAY:
+            # половина оставшегося времени: число запросов растет логарифмически
+            delay = remaining / 2
+        else:
+            # задача выполняется дольше ожидаемого - наращиваем задержку с минимальной
+            self.overdue_polls += 1
+            delay = POLL_MIN_DELAY * 2**self.overdue_polls
+
+        delay = min(max(delay, POLL_MIN_DELAY), POLL_MAX_DELAY, max(elapsed * POLL_MAX_LAG, POLL_MIN_DELAY))
+        return delay + random.uniform(0, delay * 0.1)
+
+    def finished(self, status: dict | None = None, now: float | None = None) -> float:
+        """
+        Оценка времени завершения задачи: из ответа сервера или середина интервала между последними
+        запросами статуса. Оценка не раньше последнего запроса, при котором задача еще выполнялась.
+        """
+        now = now or time.time()
+        earliest = self.last_poll or self.started
+        finished = extract_finished(status or {})
+        if finished and self.started <= finished <= now:
+            return max(finished, earliest)
+        if self.last_poll:
+            return (self.last_poll + now) / 2
+        return now
+
+    def record(self, status: dict | None = None):
+        """
+        Сохраняет длительность завершенной задачи, число запросов статуса
+        и задержку обнаружения завершения.
+
+        :param status: Ответ сервера о завершении задачи.
+        """
+        now = time.time()
+        finished = self.finished(status, now)
+
+        db = SessionLocal()
+        try:
+            db.add(
+                DBJobStat(
+                    added=moscow_now(),
+                    operation=self.operation,
+                    size=self.size,
+                    hour=datetime.fromtimestamp(self.started, ZoneInfo("Europe/Moscow")).hour,
+                    duration=finished - self.started,
+                    polls=self.polls + 1,
+                    detection_delay=now - finished,
+                )
+            )
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"PollScheduler (record): Ошибка при сохранении статистики: {e}")
+        finally:
+            db.close()
@@ -5,6 +5,7 @@ function getStatusPriority(status) {
         'FAILED': 3,
         'ACCEPTED': 4,
         'STARTED': 5,
+        'RETRYING': 6,
     };
     return priorities[status] || 0
 }
@@ -199,9 +200,11 @@ class Table {
     static getStatus(status, message = '') {
         const state = status.state;
         const error = status.error || '';
+        const tiles = status.tiles ? ` (${status.tiles.success}/${status.tiles.total})` : '';
         const statuses = {
             'ACCEPTED': `<span class="badge text-bg-secondary">${message} Принято к исполнению</span>`,
-            'STARTED': `<span class="badge text-bg-warning">${message} В обработке</span>`,
+            'STARTED': `<span class="badge text-bg-warning">${message} В обработке${tiles}</span>`,
+            'RETRYING': `<span class="badge text-bg-warning">${message} Повтор ${status.retry || ''}</span> <span class="badge text-bg-light">${error}</span>`,
             'SUCCESS': `<span class="badge text-bg-success">${message} Готово</span>`,
             'FAILED': `<span class="badge text-bg-danger">${message} Ошибка</span> <span class="badge text-bg-danger">${error}</span>`,
             'CANCELLED': `<span class="badge text-bg-secondary">${message} Отменено</span>`,
@@ -124,6 +124,15 @@ class Uploader {
             body: formData,
         });
 
+        if (!response.ok) {
+            // 429 - сервис перегружен или превышены лимиты клиента, 413 - слишком большая загрузка
+            const data = await response.json().catch(() => ({}));
+            const retryAfter = response.headers.get('Retry-After');
+            const message = data.detail || `Ошибка загрузки: ${response.status}`;
+            Uploader.showAlert(retryAfter ? `${message}. Повторите через ${retryAfter} с` : message, 'warning');
+            return null;
+        }
+
         return await response.json();
     }
 
@@ -156,10 +165,29 @@ class Uploader {
 
                 modal.hide();
                 table.refreshTable();
+
+                if (data.job_id) {
+                    const job = await this.waitIngest(data.job_id);
+                    const errors = job.errors || [job.detail];
+                    if (errors.length !== 0) Uploader.showAlert(errors.join('<br>'), 'warning')
+                    else Uploader.showAlert(`Задачи успешно добавлены в очередь: ${job.tasks_created}`);
+                }
             }
         })
     }
 
+    async waitIngest(jobId, interval = 2000) {
+        while (true) {
+            await new Promise(resolve => setTimeout(resolve, interval));
+
+            const response = await fetch(`/ingest/${jobId}`);
+            const job = await response.json();
+            table.refreshTable();
+
+            if (!response.ok || job.state === 'SUCCESS' || job.state === 'FAILED') return job;
+        }
+    }
+
     static showAlert(message, type = 'success') {
         const alert = document.createElement('div');
         alert.className = `alert alert-${type} alert-dismissible fade show`;
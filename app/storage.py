@@ -0,0 +1,253 @@
+import os
+import hmac
+import time
+import shutil
+import hashlib
+import secrets
+import tempfile
+from urllib.parse import quote, urlencode
+
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'local')  # local или s3
+STORAGE_SECRET = os.getenv('STORAGE_SECRET')  # ключ подписи ссылок на скачивание
+STORAGE_SECRET_FILE = os.getenv('STORAGE_SECRET_FILE', 'data/storage_secret')  # ключ, если STORAGE_SECRET не задан
+STORAGE_URL_EXPIRES = int(os.getenv('STORAGE_URL_EXPIRES', '3600'))  # время жизни ссылки на скачивание, сек
+
+CHUNK_SIZE = 1024 * 1024
+
+
+_secret = None
+
+
+def read_secret(path: str) -> str | None:
+    try:
+        with open(path) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def create_secret(path: str) -> str:
+    """
+    Создает общий ключ подписи в файле, если его еще нет.
+    Ключ записывается во временный файл и подключается жесткой ссылкой: если другой процесс
+    успел создать ключ раньше, используется его ключ.
+    """
+    folder = os.path.dirname(path) or '.'
+    os.makedirs(folder, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.storage_secret_')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(tmp_path, path)
+            print(f"Storage (create_secret): Создан ключ подписи ссылок {path}")
+        except FileExistsError:
+            pass
+    finally:
+        os.remove(tmp_path)
+
+    return read_secret(path)
+
+
+def get_secret() -> bytes:
+    """
+    Ключ подписи ссылок, одинаковый для процессов API и воркеров.
+    Если STORAGE_SECRET не задан, используется ключ из STORAGE_SECRET_FILE в общей папке data
+    (ссылки подписываются только для локального хранилища, которое у процессов тоже общее).
+    """
+    global _secret
+    if _secret is None:
+        secret = STORAGE_SECRET or read_secret(STORAGE_SECRET_FILE) or create_secret(STORAGE_SECRET_FILE)
+        if not secret:
+            raise Exception(f"Storage (get_secret): Не удалось получить ключ подписи из {STORAGE_SECRET_FILE}")
+        _secret = secret.encode()
+    return _secret
+
+
+def sign(key: str, expires: int, **params) -> str:
+    """
+    Подпись ссылки на файл. Подписываются ключ, срок действия и все параметры ссылки,
+    которые влияют на ответ (имя файла и т.п.).
+    """
+    payload = urlencode(sorted((name, value) for name, value in params.items() if value))
+    return hmac.new(get_secret(), f"{key}:{expires}:{payload}".encode(), hashlib.sha256).hexdigest()
+
+
+def verify(key: str, expires: int, signature: str, **params) -> bool:
+    """
+    Проверка подписанной ссылки на файл локального хранилища.
+    """
+    return expires >= time.time() and hmac.compare_digest(sign(key, expires, **params), signature)
+
+
+class LocalStorage:
+    """
+    Хранилище на локальном диске. Ключ файла совпадает с его путем относительно рабочей папки.
+    """
+
+    is_local = True
+
+    def open(self, key: str, mode: str = 'rb'):
+        if 'w' in mode:
+            os.makedirs(os.path.dirname(key) or '.', exist_ok=True)
+        return open(key, mode)
+
+    def put_file(self, path: str, key: str | None = None) -> str:
+        """
+        Помещает локальный файл в хранилище.
+
+        :return:
+            Ключ файла в хранилище.
+        """
+        key = key or path
+        if key != path:
+            os.makedirs(os.path.dirname(key) or '.', exist_ok=True)
+            shutil.move(path, key)
+        return key
+
+    def size(self, key: str) -> int:
+        return os.path.getsize(key)
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(key)
+
+    def delete(self, key: str):
+        if os.path.isfile(key):
+            os.remove(key)
+
+    def url(
+        self, key: str, filename: str | None = None, expires: int = STORAGE_URL_EXPIRES, encoding: str | None = None
+    ) -> str:
+        """
+        Подписанная ссылка на скачивание файла через /files.
+        """
+        expires_at = int(time.time()) + expires
+        params = {'expires': expires_at, 'signature': sign(key, expires_at, filename=filename, encoding=encoding)}
+        if filename:
+            params['filename'] = filename
+        if encoding:
+            params['encoding'] = encoding
+        return f"/files/{quote(key)}?{urlencode(params)}"
+
+
+class S3Writer:
+    """
+    Файловый объект для записи в S3. Данные буферизуются (в памяти до 8 МБ, далее на диске)
+    и загружаются частями при закрытии.
+    """
+
+    def __init__(self, storage, key: str):
+        self.storage = storage
+        self.key = key
+        self.buffer = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+    def close(self):
+        if self.buffer.closed:
+            return
+        self.buffer.seek(0)
+        self.storage.client.upload_fileobj(self.buffer, self.storage.bucket, self.key)
+        self.buffer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type:
+            self.buffer.close()
+        else:
+            self.close()
+
+
+class S3Storage:
+    """
+    S3-совместимое хранилище (AWS S3, MinIO и др.).
+    Локальные файлы после загрузки в хранилище удаляются.
+    """
+
+    is_local = False
+
+    def __init__(self):
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise Exception('Storage (S3): Для работы с S3 необходимо установить пакет boto3')
+
+        self.client_error = ClientError
+        self.bucket = os.getenv('S3_BUCKET')
+        if not self.bucket:
+            raise Exception('Storage (S3): Не указан S3_BUCKET')
+
+        self.client = boto3.client(
+            's3',
+            endpoint_url=os.getenv('S3_ENDPOINT_URL') or None,
+            aws_access_key_id=os.getenv('S3_ACCESS_KEY'),
+            aws_secret_access_key=os.getenv('S3_SECRET_KEY'),
+            region_name=os.getenv('S3_REGION') or None,
+        )
+
+    def open(self, key: str, mode: str = 'rb'):
+        if 'w' in mode:
+            return S3Writer(self, key)
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body']
+
+    def put_file(self, path: str, key: str | None = None) -> str:
+        key = key or path
+        self.client.upload_file(path, self.bucket, key)
+        os.remove(path)
+        return key
+
+    def size(self, key: str) -> int:
+        return self.client.head_object(Bucket=self.bucket, Key=key)['ContentLength']
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except self.client_error:
+            return False
+
+    def keys(self, prefix: str) -> set:
+        """
+        Ключи объектов, начинающиеся с prefix (один запрос list_objects_v2 на каждую 1000 ключей).
+        """
+        keys = set()
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=prefix):
+            keys.update(item['Key'] for item in page.get('Contents', []))
+        return keys
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def url(
+        self, key: str, filename: str | None = None, expires: int = STORAGE_URL_EXPIRES, encoding: str | None = None
+    ) -> str:
+        params = {'Bucket': self.bucket, 'Key': key}
+        if filename:
+            params['ResponseContentDisposition'] = f"attachment; filename*=UTF-8''{quote(filename)}"
+        if encoding:
+            params['ResponseContentEncoding'] = encoding
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=expires)
+
+
+_storage = None
+
+
+def get_storage():
+    """
+    Хранилище файлов, выбранное в STORAGE_BACKEND.
+    """
+    global _storage
+    if _storage is None:
+        backends = {
+            'local': LocalStorage,
+            's3': S3Storage,
+        }
+        if STORAGE_BACKEND not in backends:
+            raise ValueError(f"Storage: Неизвестный тип хранилища: {STORAGE_BACKEND}")
+        _storage = backends[STORAGE_BACKEND]()
+    return _storage
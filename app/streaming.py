@@ -0,0 +1,211 @@
+import os
+import re
+import json
+
+STREAM_THRESHOLD = int(os.getenv('STREAM_THRESHOLD_MB', '50')) * 1024 * 1024  # потоковое чтение для файлов больше
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', '500'))  # количество объектов в одной порции
+READ_SIZE = 1024 * 1024
+
+FEATURES_RE = re.compile(r'"features"\s*:\s*\[')
+DEFAULT_CRS = 'EPSG:4326'
+
+
+def read_geojson_header(f, buffer: str = '') -> tuple[str, str | None]:
+    """
+    Читает начало FeatureCollection до массива features.
+
+    :return:
+        Остаток буфера после '[' и CRS из заголовка (если указан до features).
+    """
+    while True:
+        match = FEATURES_RE.search(buffer)
+        if match:
+            break
+
+        data = f.read(READ_SIZE)
+        if not data:
+            raise ValueError('Streaming (read_geojson_header): В файле не найден массив features')
+        buffer += data
+
+    crs = None
+    try:
+        header = json.loads(buffer[: match.end()] + ']}')
+        name = ((header.get('crs') or {}).get('properties') or {}).get('name')
+        crs = name or None
+    except json.JSONDecodeError:
+        pass
+
+    return buffer[match.end() :], crs
+
+
+class ValueScanner:
+    """
+    Поиск конца JSON-объекта по мере чтения файла.
+    Глубина вложенности и положение внутри строки сохраняются между порциями,
+    поэтому каждый прочитанный символ просматривается один раз.
+    """
+
+    TOKENS_RE = re.compile(r'["{}\[\]]')
+    STRING_RE = re.compile(r'["\\]')
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+
+    def feed(self, data: str) -> int | None:
+        """
+        :return:
+            Позиция в data после конца объекта или None, если объект не закончился.
+        """
+        position = 0
+        if self.escape and data:
+            position, self.escape = 1, False
+
+        while True:
+            match = (self.STRING_RE if self.in_string else self.TOKENS_RE).search(data, position)
+            if not match:
+                return None
+
+            char, position = match.group(), match.end()
+            if self.in_string:
+                if char == '\\':
+                    if position >= len(data):
+                        self.escape = True
+                        return None
+                    position += 1
+                else:
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in '{[':
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if self.depth == 0:
+                    return position
+
+
+def read_value(f, buffer: str) -> str:
+    """
+    Дочитывает из файла JSON-объект, начало которого находится в buffer.
+    Прочитанные данные собираются в список и объединяются один раз.
+
+    :return:
+        Буфер, начинающийся с объекта и содержащий его целиком.
+    """
+    scanner = ValueScanner()
+    parts = []
+    data = buffer
+
+    while True:
+        parts.append(data)
+        if scanner.feed(data) is not None:
+            return ''.join(parts)
+
+        data = f.read(READ_SIZE)
+        if not data:
+            raise ValueError('Streaming (iter_geojson_features): Неожиданный конец файла')
+
+
+def iter_geojson_features(path: str):
+    """
+    Потоковое чтение объектов GeoJSON FeatureCollection.
+    В памяти одновременно находится только текущий объект и буфер чтения.
+    Объект, не поместившийся в буфер, дочитывается до конца (см. read_value) и разбирается один раз.
+
+    :return:
+        Генератор (crs, feature).
+    """
+    decoder = json.JSONDecoder()
+
+    with open(path, encoding='utf-8') as f:
+        buffer, crs = read_geojson_header(f)
+        position = 0
+
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+
+            if position >= len(buffer):
+                data = f.read(READ_SIZE)
+                if not data:
+                    raise ValueError('Streaming (iter_geojson_features): Неожиданный конец файла')
+                buffer = data
+                position = 0
+                continue
+
+            if buffer[position] == ']':
+                return
+
+            try:
+                feature, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if buffer[position] != '{':
+                    raise
+                buffer = read_value(f, buffer[position:])
+                feature, end = decoder.raw_decode(buffer)
+
+            yield crs or DEFAULT_CRS, feature
+            position = end
+
+            if position > READ_SIZE:
+                buffer = buffer[position:]
+                position = 0
+
+
+def iter_geojson_chunks(path: str, chunk_size: int = STREAM_CHUNK_SIZE):
+    """
+    Порции GeoJSON в виде GeoDataFrame с индексом, продолжающим нумерацию объектов файла.
+    """
+    import geopandas as gpd
+
+    features = []
+    offset = 0
+    crs = DEFAULT_CRS
+
+    def make_chunk():
+        gdf = gpd.GeoDataFrame.from_features(features, crs=crs)
+        gdf.index = range(offset, offset + len(gdf))
+        return gdf
+
+    for crs, feature in iter_geojson_features(path):
+        features.append(feature)
+        if len(features) >= chunk_size:
+            yield make_chunk()
+            offset += len(features)
+            features = []
+
+    if features:
+        yield make_chunk()
+
+
+def iter_ogr_chunks(path: str, chunk_size: int = STREAM_CHUNK_SIZE):
+    """
+    Порции SHP (и других форматов OGR) в виде GeoDataFrame.
+    """
+    import pyogrio
+
+    total = pyogrio.read_info(path)['features']
+    for offset in range(0, total, chunk_size):
+        gdf = pyogrio.read_dataframe(path, skip_features=offset, max_features=chunk_size)
+        gdf.index = range(offset, offset + len(gdf))
+        yield gdf
+
+
+def iter_chunks(path: str, chunk_size: int = STREAM_CHUNK_SIZE):
+    """
+    Чтение файла охвата порциями фиксированного размера.
+    Небольшие файлы читаются целиком одной порцией.
+    """
+    if os.path.getsize(path) <= STREAM_THRESHOLD:
+        import geopandas as gpd
+
+        yield gpd.read_file(path)
+        return
+
+    print(f"Streaming (iter_chunks): Потоковое чтение {os.path.basename(path)} порциями по {chunk_size}")
+    if os.path.splitext(path)[1].lower() == '.geojson':
+        yield from iter_geojson_chunks(path, chunk_size)
+    else:
+        yield from iter_ogr_chunks(path, chunk_size)
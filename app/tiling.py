@@ -0,0 +1,118 @@
+import os
+import math
+
+TILE_MODE = os.getenv('TILE_MODE', '')  # '' - без разбиения, 'grid' - сетка, 'quadtree' - дерево квадрантов
+TILE_MAX_AREA = float(os.getenv('TILE_MAX_AREA', '2500'))  # максимальная площадь тайла, км²
+TILE_MAX_VERTICES = int(os.getenv('TILE_MAX_VERTICES', '20000'))  # максимальное число вершин тайла
+TILE_MAX_DEPTH = int(os.getenv('TILE_MAX_DEPTH', '6'))  # максимальная глубина дерева квадрантов
+
+KM_PER_DEGREE = 111.32
+
+
+def measure(geometry) -> tuple[float, int]:
+    """
+    Приближенная площадь (км²) и число вершин геометрии в EPSG:4326.
+    Площадь считается по средней широте охвата, этого достаточно для выбора размера тайлов.
+    """
+    import shapely
+
+    min_x, min_y, max_x, max_y = geometry.bounds
+    scale = KM_PER_DEGREE**2 * math.cos(math.radians((min_y + max_y) / 2))
+    return geometry.area * scale, int(shapely.get_num_coordinates(geometry))
+
+
+def is_oversized(geometry) -> bool:
+    area, vertices = measure(geometry)
+    return area > TILE_MAX_AREA or vertices > TILE_MAX_VERTICES
+
+
+def polygonal(geometry):
+    """
+    Оставляет только полигональные части геометрии (после пересечения могут появиться линии и точки).
+    """
+    import shapely
+    from shapely.geometry import MultiPolygon
+
+    polygons = [part for part in shapely.get_parts(geometry) if part.geom_type == 'Polygon' and not part.is_empty]
+    if not polygons:
+        return None
+    return polygons[0] if len(polygons) == 1 else MultiPolygon(polygons)
+
+
+def split_grid(geometry) -> list:
+    """
+    Разбиение охвата регулярной сеткой, размер ячейки подбирается по площади и числу вершин.
+    Сетка покрывает границы охвата, поэтому площадь ячеек считается по ним, а не по площади охвата:
+    иначе у невыпуклых охватов тайлы получались бы больше TILE_MAX_AREA.
+    """
+    from shapely.geometry import box
+
+    min_x, min_y, max_x, max_y = geometry.bounds
+    area, _ = measure(box(min_x, min_y, max_x, max_y))
+    _, vertices = measure(geometry)
+    cells = math.ceil(math.sqrt(max(area / TILE_MAX_AREA, vertices / TILE_MAX_VERTICES)))
+
+    step_x = (max_x - min_x) / cells
+    step_y = (max_y - min_y) / cells
+
+    tiles = []
+    for i in range(cells):
+        for j in range(cells):
+            cell = box(min_x + i * step_x, min_y + j * step_y, min_x + (i + 1) * step_x, min_y + (j + 1) * step_y)
+            tile = polygonal(geometry.intersection(cell))
+            if tile is not None:
+                tiles.append(tile)
+
+    return tiles
+
+
+def split_quadtree(geometry, depth=0) -> list:
+    """
+    Рекурсивное разбиение охвата на квадранты, пока части не станут меньше порогов.
+    """
+    from shapely.geometry import box
+
+    if depth >= TILE_MAX_DEPTH or not is_oversized(geometry):
+        return [geometry]
+
+    min_x, min_y, max_x, max_y = geometry.bounds
+    mid_x = (min_x + max_x) / 2
+    mid_y = (min_y + max_y) / 2
+
+    tiles = []
+    for quadrant in (
+        box(min_x, min_y, mid_x, mid_y),
+        box(mid_x, min_y, max_x, mid_y),
+        box(min_x, mid_y, mid_x, max_y),
+        box(mid_x, mid_y, max_x, max_y),
+    ):
+        part = polygonal(geometry.intersection(quadrant))
+        if part is not None:
+            tiles.extend(split_quadtree(part, depth + 1))
+
+    return tiles
+
+
+def split_cover(geometry, mode=TILE_MODE) -> list:
+    """
+    Разбивает слишком большой охват на тайлы.
+
+    :param geometry: Геометрия охвата в EPSG:4326.
+    :param mode: Способ разбиения (grid, quadtree). Пустое значение отключает разбиение.
+
+    :return:
+        Список геометрий тайлов. Пустой список, если разбиение не требуется.
+    """
+    if not mode or geometry is None or geometry.is_empty or not is_oversized(geometry):
+        return []
+
+    splitters = {
+        'grid': split_grid,
+        'quadtree': split_quadtree,
+    }
+
+    if mode not in splitters:
+        raise ValueError(f"Tiling (split_cover): Неизвестный способ разбиения: {mode}")
+
+    tiles = splitters[mode](geometry)
+    return tiles if len(tiles) > 1 else []
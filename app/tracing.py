@@ -0,0 +1,263 @@
+import os
+import json
+import time
+import secrets
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+TRACES_DIR = 'data/traces'
+TRACE_ENABLED = os.getenv('TRACE_ENABLED', '1') == '1'  # трассировка загрузок и задач
+TRACE_COLLECTOR_URL = os.getenv('TRACE_COLLECTOR_URL')  # необязательный адрес для отправки спанов (POST JSON)
+TRACE_RETENTION = int(os.getenv('TRACE_RETENTION', '1000'))  # сколько трасс хранить
+
+_current_span = ContextVar('current_span', default=None)
+_lock = threading.Lock()
+
+
+class Span:
+    """
+    Участок трассы: HTTP-запрос, задача Celery, запрос к NG Toolbox или запись в базу.
+    Спаны, завершенные в процессе, накапливаются в корневом спане процесса
+    и сохраняются вместе при его завершении.
+    """
+
+    def __init__(self, name: str, trace_id: str, parent_id: str | None = None, root=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.root = root or self
+        self.attributes = attributes or {}
+        self.start = time.time()
+        self.end = None
+        self.error = None
+        self.finished = []
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> dict:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'end': self.end,
+            'duration': (self.end or time.time()) - self.start,
+            'pid': os.getpid(),
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+def parse_traceparent(value: str | bytes | None) -> tuple[str, str] | None:
+    """
+    Разбор заголовка traceparent (W3C Trace Context).
+
+    :return:
+        (trace_id, span_id) или None, если заголовок отсутствует или некорректен.
+    """
+    if isinstance(value, bytes):
+        value = value.decode()
+    parts = (value or '').strip().split('-')
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None
+    return parts[1], parts[2]
+
+
+def current_span() -> Span | None:
+    return _current_span.get()
+
+
+def current_trace_id() -> str | None:
+    span = current_span()
+    return span.trace_id if span else None
+
+
+def trace_headers() -> dict:
+    """
+    Заголовки для передачи контекста трассы (HTTP-запросы, сообщения Celery).
+    """
+    span = current_span()
+    return {'traceparent': span.traceparent} if span else {}
+
+
+@contextmanager
+def trace(name: str, traceparent: str | None = None, trace_id: str | None = None, root=False, **attributes):
+    """
+    Спан трассы для блока кода.
+    Вне трассы блок выполняется без записи, если не указан traceparent, trace_id или root=True.
+
+    :param name: Название спана.
+    :param traceparent: Контекст родительского спана из другого процесса.
+    :param trace_id: ID трассы, к которой нужно присоединить спан (без родителя, если текущий спан из другой трассы).
+    :param root: Начать новую трассу, если нет текущей.
+    :param attributes: Атрибуты спана.
+    """
+    parent = current_span()
+    remote = parse_traceparent(traceparent)
+
+    if not TRACE_ENABLED or (parent is None and not remote and not trace_id and not root):
+        yield None
+        return
+
+    if remote:
+        span = Span(name, remote[0], remote[1], attributes=attributes)
+    elif parent is not None and trace_id in (None, parent.trace_id):
+        span = Span(name, parent.trace_id, parent.span_id, root=parent.root, attributes=attributes)
+    else:
+        span = Span(name, trace_id or secrets.token_hex(16), attributes=attributes)
+
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current_span.reset(token)
+        span.end = time.time()
+        span.root.finished.append(span.to_dict())
+        if span.root is span:
+            export(span.trace_id, span.finished)
+
+
+def export(trace_id: str, spans: list[dict]):
+    """
+    Сохраняет спаны в data/traces/<trace_id>.jsonl и отправляет их в коллектор, если он указан.
+    Ошибки экспорта не влияют на выполнение задач.
+    """
+    try:
+        os.makedirs(TRACES_DIR, exist_ok=True)
+        lines = ''.join(json.dumps(span, ensure_ascii=False, default=str) + '\n' for span in spans)
+        with _lock, open(os.path.join(TRACES_DIR, f"{trace_id}.jsonl"), 'a', encoding='utf-8') as f:
+            f.write(lines)
+        clean_traces()
+    except Exception as e:
+        print(f"Tracing (export): Не удалось сохранить трассу {trace_id}: {e}")
+
+    if TRACE_COLLECTOR_URL:
+        try:
+            import requests
+
+            requests.post(TRACE_COLLECTOR_URL, json={'spans': spans}, timeout=5)
+        except Exception as e:
+            print(f"Tracing (export): Не удалось отправить трассу {trace_id} в коллектор: {e}")
+
+
+def clean_traces(retention=TRACE_RETENTION):
+    """
+    Удаляет самые старые трассы сверх лимита хранения.
+    """
+    entries = [entry for entry in os.scandir(TRACES_DIR) if entry.name.endswith('.jsonl')]
+    if len(entries) <= retention:
+        return
+
+    entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in entries[retention:]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+def load_trace(trace_id: str) -> list[dict]:
+    """
+    Спаны трассы, отсортированные по времени начала.
+    """
+    if not trace_id or not all(c in '0123456789abcdef' for c in trace_id):
+        return []
+
+    path = os.path.join(TRACES_DIR, f"{trace_id}.jsonl")
+    if not os.path.isfile(path):
+        return []
+
+    with open(path, encoding='utf-8') as f:
+        spans = [json.loads(line) for line in f if line.strip()]
+    return sorted(spans, key=lambda span: span['start'])
+
+
+def filter_spans(spans: list[dict], task_ids: set[int]) -> list[dict]:
+    """
+    Спаны, относящиеся к задачам: спаны с атрибутом task_id, их потомки и предки.
+    """
+    by_id = {span['span_id']: span for span in spans}
+    children = {}
+    for span in spans:
+        children.setdefault(span['parent_id'], []).append(span)
+
+    matched = [span for span in spans if span['attributes'].get('task_id') in task_ids]
+    selected = set()
+
+    stack = list(matched)
+    while stack:
+        span = stack.pop()
+        if span['span_id'] not in selected:
+            selected.add(span['span_id'])
+            stack.extend(children.get(span['span_id'], []))
+
+    for span in matched:
+        parent = by_id.get(span['parent_id'])
+        while parent and parent['span_id'] not in selected:
+            selected.add(parent['span_id'])
+            parent = by_id.get(parent['parent_id'])
+
+    return [span for span in spans if span['span_id'] in selected]
+
+
+def critical_path(spans: list[dict]) -> list[dict]:
+    """
+    Критический путь трассы: от корня по дочерним спанам, поддерево которых завершилось последним.
+    Учитывается поддерево, а не сам спан: постановка задачи в очередь завершается быстро,
+    а задача Celery, запущенная из нее, - последней.
+    """
+    ids = {span['span_id'] for span in spans}
+    children = {}
+    for span in spans:
+        children.setdefault(span['parent_id'] if span['parent_id'] in ids else None, []).append(span)
+
+    finished = {}
+
+    def subtree_end(span):
+        if span['span_id'] not in finished:
+            ends = [subtree_end(child) for child in children.get(span['span_id'], [])]
+            finished[span['span_id']] = max([span['end'] or span['start'], *ends])
+        return finished[span['span_id']]
+
+    path = []
+    level = children.get(None, [])
+    while level:
+        span = max(level, key=subtree_end)
+        path.append(
+            {
+                'name': span['name'],
+                'span_id': span['span_id'],
+                'duration': span['duration'],
+                'attributes': span['attributes'],
+            }
+        )
+        level = children.get(span['span_id'], [])
+    return path
+
+
+def summarize(spans: list[dict]) -> dict:
+    """
+    Суммарное время и количество спанов по названиям.
+    """
+    summary = {}
+    for span in spans:
+        item = summary.setdefault(span['name'], {'count': 0, 'duration': 0.0, 'errors': 0})
+        item['count'] += 1
+        item['duration'] += span['duration']
+        item['errors'] += 1 if span['error'] else 0
+    return summary
@@ -1,60 +1,175 @@
 from .db import DBTask, SessionLocal
-from sqlalchemy import and_, or_, not_, case
+from .tiling import split_cover
+from .preprocess import preprocess_cover, write_options, format_stats
+from .storage import get_storage, CHUNK_SIZE
+from .blobs import put_blob, open_blob, release_blob, is_blob
+from .streaming import iter_chunks
+from .tracing import trace
+from sqlalchemy import case, func, or_
+from sqlalchemy.orm import aliased
 from sqlalchemy.exc import SQLAlchemyError
 from zoneinfo import ZoneInfo
 from uuid import uuid4
 from datetime import datetime
 import os
+import time
 import shutil
+import asyncio
 import zipfile
 from pathlib import Path
-import geopandas as gpd
 import urllib3
 
 urllib3.disable_warnings()
 
+WORKER_TIMEOUT = float(os.getenv('WORKER_TIMEOUT', '180'))  # задача без отметки воркера дольше считается не выполняемой, сек
 
-async def delete_paths(*paths: str):
+
+def remove_paths(*paths: str):
     """
-    Удаляет файлы и папки по указанным путям.
+    Удаляет файлы и папки по указанным путям (локальные пути или ключи хранилища).
+    Блобы удаляются, только если на них не ссылаются задачи, поэтому вызывать после изменения задач.
     """
     for path in paths:
-        if os.path.exists(path):
+        if not path:
+            continue
+
+        if is_blob(path):
+            release_blob(path)
+        elif os.path.exists(path):
             print(f"TaskUploader (delete): Удаление {path}")
             if os.path.isfile(path):
                 os.remove(path)
             else:
                 shutil.rmtree(path)
+        elif not get_storage().is_local:
+            print(f"TaskUploader (delete): Удаление {path} из хранилища")
+            get_storage().delete(path)
+
+
+def cancel_stages(task: DBTask) -> dict:
+    """
+    Статусы отмены для всех незавершенных этапов задачи, чтобы ни один этап не оставался в PREPARING.
+
+    :return:
+        Словарь {этап: статус}.
+    """
+    statuses = {}
+    for stage in ('kpt_status', 'kad_status'):
+        status = getattr(task, stage) or {}
+        if status.get('state') != 'SUCCESS':
+            statuses[stage] = {**status, 'state': 'CANCELLED'}
+    return statuses
+
+
+async def delete_paths(*paths: str):
+    """
+    Удаляет файлы и папки по указанным путям.
+    """
+    await asyncio.to_thread(remove_paths, *paths)
 
 
 async def execute_db_operations(db, *queries):
     """
     Выполняет несколько операций с базой данных.
     """
-    for query, params in queries:
-        await db.execute(query, params)
-    await db.commit()
+    with trace('db.execute', statements=[query.split(' WHERE ')[0] for query, _ in queries]):
+        for query, params in queries:
+            await db.execute(query, params)
+        await db.commit()
 
 
-async def create_archive(base_path: str, files: list, archive_name: str):
+class ArchiveBuffer:
+    """
+    Приемник данных архива: zipfile пишет в него по мере сжатия, а записанные байты забираются частями.
+    У приемника нет seek, поэтому zipfile записывает размеры файлов после их данных.
     """
-    Создает архив с файлами.
 
-    :param base_path: Путь, где будут временно сохранены файлы для архивации.
-    :param files: Список путей к файлам для добавления в архив.
-    :param archive_name: Полный путь к архиву, который будет создан.
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def stream_archive(root: str, files: list):
     """
-    os.makedirs(base_path, exist_ok=True)
-    for file_path in files:
-        if os.path.exists(file_path):
-            shutil.copy(file_path, base_path)
-    shutil.make_archive(
-        base_name=archive_name,
-        format='zip',
-        root_dir='data/temp',
-        base_dir=os.path.basename(base_path),
-    )
-    shutil.rmtree(base_path)
+    Архив с файлами, который отдается частями по мере чтения файлов из хранилища.
+    Архив не сохраняется ни на диск, ни в хранилище. Сжатые блобы распаковываются при чтении
+    и сжимаются в архиве заново.
+
+    :param root: Корневая папка в архиве.
+    :param files: Список (ключ файла в хранилище, имя файла в архиве).
+
+    :return:
+        Генератор частей архива.
+    """
+    storage = get_storage()
+    buffer = ArchiveBuffer()
+    added = set()
+
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for key, filename in files:
+            if not storage.exists(key):
+                continue
+
+            # у задач с одинаковыми именами файлы в архиве получают номер
+            base, extension = os.path.splitext(filename)
+            arcname = f"{root}/{filename}"
+            counter = 1
+            while arcname in added:
+                arcname = f"{root}/{base}({counter}){extension}"
+                counter += 1
+            added.add(arcname)
+
+            with open_blob(key) as source, archive.open(arcname, 'w', force_zip64=True) as target:
+                for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                    target.write(chunk)
+                    data = buffer.take()
+                    if data:
+                        yield data
+
+    yield buffer.take()
+
+
+def aggregate_status(statuses: list, names: list) -> dict:
+    """
+    Сводный статус этапа логической задачи по статусам ее тайлов.
+
+    :param statuses: Статусы этапа (kpt_status или kad_status) тайлов.
+    :param names: Имена тайлов (для текста ошибки).
+    """
+    states = [(status or {}).get('state', 'PREPARING') for status in statuses]
+    tiles = {'total': len(states), 'success': states.count('SUCCESS')}
+
+    if 'FAILED' in states:
+        index = states.index('FAILED')
+        error = statuses[index].get('error') or 'Неизвестная ошибка'
+        return {'state': 'FAILED', 'error': f"{names[index]}: {error}", 'tiles': tiles}
+
+    if 'CANCELLED' in states:
+        return {'state': 'CANCELLED', 'tiles': tiles}
+
+    if tiles['success'] == tiles['total']:
+        return {'state': 'SUCCESS', 'tiles': tiles}
+
+    if all(state == 'PREPARING' for state in states):
+        return {'state': 'PREPARING', 'tiles': tiles}
+
+    return {'state': 'STARTED', 'tiles': tiles}
 
 
 class TaskUploader:
@@ -78,8 +193,11 @@ class TaskUploader:
         base, extension = os.path.splitext(file_path)
         final_path = file_path
 
+        storage = get_storage()
+        # занятые ключи хранилища получаются одним запросом, а не проверкой каждого варианта имени
+        taken = set() if storage.is_local else storage.keys(base)
         counter = 1
-        while os.path.exists(final_path):
+        while os.path.exists(final_path) or final_path in taken:
             final_path = f"{base}({counter}){extension}"
             counter += 1
 
@@ -99,31 +217,33 @@ class TaskUploader:
         """
 
         db = SessionLocal(expire_on_commit=False)
-        try:
-            if instance:
-                instance_id = instance.id if isinstance(instance, model) else instance
-                db_instance = db.query(model).filter(model.id == instance_id).first()
-                if not db_instance:
-                    raise ValueError(
-                        f"TaskUploader (create_or_update): " f"{model.__tablename__} с ID {instance_id} не найден"
-                    )
-
-                if params:
-                    for key, value in params.items():
-                        setattr(db_instance, key, value)
-            else:
-                if params is None:
-                    params = {}
-                db_instance = model(**params)
-                db.add(db_instance)
-
-            db.commit()
-            return db_instance
-        except SQLAlchemyError as e:
-            db.rollback()
-            raise Exception(f"TaskUploader (create_or_update): Ошибка при создании или обновлении: {e}")
-        finally:
-            db.close()
+        operation = 'update' if instance else 'insert'
+        with trace(f'db.{operation}', table=model.__tablename__, fields=sorted(params or {})):
+            try:
+                if instance:
+                    instance_id = instance.id if isinstance(instance, model) else instance
+                    db_instance = db.query(model).filter(model.id == instance_id).first()
+                    if not db_instance:
+                        raise ValueError(
+                            f"TaskUploader (create_or_update): " f"{model.__tablename__} с ID {instance_id} не найден"
+                        )
+
+                    if params:
+                        for key, value in params.items():
+                            setattr(db_instance, key, value)
+                else:
+                    if params is None:
+                        params = {}
+                    db_instance = model(**params)
+                    db.add(db_instance)
+
+                db.commit()
+                return db_instance
+            except SQLAlchemyError as e:
+                db.rollback()
+                raise Exception(f"TaskUploader (create_or_update): Ошибка при создании или обновлении: {e}")
+            finally:
+                db.close()
 
     @staticmethod
     def get_working_tasks():
@@ -134,36 +254,26 @@ class TaskUploader:
             Список необработанных задач.
         """
 
+        # статусы логических задач пересчитываются, т.к. их обновление могло не завершиться до остановки
+        TaskUploader.update_parents()
+
+        # этапы в ожидании повтора не перезапускаются: их сообщение с ETA еще в очереди Celery
+        now = time.time()
+        waiting_retry = [
+            (state == 'RETRYING') & (func.coalesce(func.json_extract(status, '$.retry_at'), 0) > now)
+            for state, status in ((DBTask.kpt_state, DBTask.kpt_status), (DBTask.kad_state, DBTask.kad_status))
+        ]
+
         db = SessionLocal(expire_on_commit=False)
         try:
             tasks = (
                 db.query(DBTask)
                 .filter(
-                    not_(
-                        and_(
-                            DBTask.kpt_status["state"].as_string() == "SUCCESS",
-                            DBTask.kad_status["state"].as_string() == "SUCCESS",
-                        )
-                    ),
-                    not_(
-                        or_(
-                            DBTask.kpt_status["state"].as_string() == "FAILED",
-                            DBTask.kad_status["state"].as_string() == "FAILED",
-                        )
-                    ),
-                )
-                .order_by(
-                    case(
-                        (
-                            or_(
-                                DBTask.kpt_status["state"].as_string() != "PREPARING",
-                                DBTask.kad_status["state"].as_string() != "PREPARING",
-                            ),
-                            1,
-                        ),
-                        else_=2,
-                    )
+                    DBTask.celery_task.isnot(None),
+                    DBTask.state.in_(("PREPARING", "IN_PROGRESS")),
+                    ~or_(*waiting_retry),
                 )
+                .order_by(case((DBTask.state == "IN_PROGRESS", 1), else_=2), DBTask.added)
             )
 
             return tasks
@@ -173,6 +283,284 @@ class TaskUploader:
         finally:
             db.close()
 
+    @staticmethod
+    def cancel_reason(task_id, celery_task):
+        """
+        Проверка отмены задачи воркером.
+
+        :param task_id: ID задачи.
+        :param celery_task: ID Celery-задачи, которая выполняет задачу.
+
+        :return:
+            None, если задачу нужно продолжать, иначе причина: deleted, restarted или cancelled.
+        """
+
+        db = SessionLocal()
+        try:
+            row = db.query(DBTask.celery_task, DBTask.cancel_requested).filter(DBTask.id == task_id).first()
+        finally:
+            db.close()
+
+        if not row:
+            return 'deleted'
+        if celery_task and row.celery_task != celery_task:
+            return 'restarted'
+        if row.cancel_requested:
+            return 'cancelled'
+        return None
+
+    @staticmethod
+    def get_waiting_retries():
+        """
+        Получение задач, повтор которых ожидает восстановления NG Toolbox (см. CollectKadTask.set_retrying).
+
+        :return:
+            Список задач.
+        """
+
+        waiting = [
+            (state == 'RETRYING') & (func.json_extract(status, '$.breaker') == 1)
+            for state, status in ((DBTask.kpt_state, DBTask.kpt_status), (DBTask.kad_state, DBTask.kad_status))
+        ]
+
+        db = SessionLocal(expire_on_commit=False)
+        try:
+            return db.query(DBTask).filter(DBTask.celery_task.isnot(None), or_(*waiting)).order_by(DBTask.added).all()
+        finally:
+            db.close()
+
+    @staticmethod
+    def claim_retry(task_id, retry_id):
+        """
+        Захват повтора задачи воркером.
+        Повтор может быть доставлен дважды (сообщение с ETA и повторная отправка при запуске приложения
+        или после восстановления NG Toolbox), поэтому выполняет его только воркер, первым снявший retry_id со статуса этапа.
+
+        :param task_id: ID задачи.
+        :param retry_id: ID повтора из статуса этапа (см. CollectKadTask.set_retrying).
+
+        :return:
+            True, если повтор захвачен, False, если он уже выполняется, отменен или задача перезапущена.
+        """
+
+        with trace('db.claim_retry', table='ngw_tasks', task_id=task_id):
+            db = SessionLocal()
+            try:
+                # первая запись берет блокировку до чтения статусов
+                locked = (
+                    db.query(DBTask)
+                    .filter(DBTask.id == task_id)
+                    .update({DBTask.name: DBTask.name}, synchronize_session=False)
+                )
+                db_task = db.query(DBTask).filter(DBTask.id == task_id).first() if locked else None
+                for stage in ('kpt_status', 'kad_status'):
+                    status = getattr(db_task, stage, None) or {}
+                    if status.get('state') == 'RETRYING' and status.get('retry_id') == retry_id:
+                        retry_keys = ('retry_id', 'retry_at', 'breaker')
+                        setattr(db_task, stage, {k: v for k, v in status.items() if k not in retry_keys})
+                        db.commit()
+                        return True
+
+                db.rollback()
+                return False
+            except SQLAlchemyError as e:
+                db.rollback()
+                raise Exception(f"TaskUploader (claim_retry): Ошибка при захвате повтора: {e}")
+            finally:
+                db.close()
+
+    @staticmethod
+    def update_running(task_id, celery_task, params, cancelled=False):
+        """
+        Запись воркера в задачу, только если задачу все еще выполняет этот воркер:
+        она не удалена, не перезапущена и (если не указано cancelled) не отменена.
+        Проверка и запись выполняются в одной транзакции под блокировкой базы на запись,
+        поэтому перезапуск или отмена не могут произойти между ними.
+
+        :param task_id: ID задачи.
+        :param celery_task: ID Celery-задачи, которая выполняет задачу.
+        :param params: Записываемые значения.
+        :param cancelled: Записать и в задачу с запрошенной отменой.
+
+        :return:
+            Обновленная задача или None, если запись не выполнена.
+        """
+
+        fields = sorted(params) if isinstance(params, dict) else None
+        with trace('db.update', table='ngw_tasks', task_id=task_id, fields=fields):
+            db = SessionLocal(expire_on_commit=False)
+            try:
+                query = db.query(DBTask).filter(DBTask.id == task_id)
+                if celery_task:
+                    query = query.filter(DBTask.celery_task == celery_task)
+                if not cancelled:
+                    query = query.filter(DBTask.cancel_requested.isnot(True))
+
+                # первая запись берет блокировку до чтения задачи
+                if not query.update({DBTask.name: DBTask.name}, synchronize_session=False):
+                    db.rollback()
+                    return None
+
+                db_task = query.first()
+                for key, value in (params(db_task) if callable(params) else params).items():
+                    setattr(db_task, key, value)
+
+                db.commit()
+                return db_task
+            except SQLAlchemyError as e:
+                db.rollback()
+                raise Exception(f"TaskUploader (update_running): Ошибка при обновлении задачи: {e}")
+            finally:
+                db.close()
+
+    @staticmethod
+    def request_cancel(task_ids, celery):
+        """
+        Запрос отмены задач. Вместо логической задачи отменяются ее тайлы, а ее статусы пересчитываются по ним.
+        Задачи, которые не выполняет ни один воркер (в очереди или без отметки воркера дольше WORKER_TIMEOUT),
+        отменяются сразу, остальные завершаются воркером при ближайшей проверке.
+
+        :param task_ids: ID задач.
+        :param celery: Приложение Celery.
+
+        :return:
+            Количество отмененных задач.
+        """
+
+        with trace('db.request_cancel', table='ngw_tasks', tasks=len(task_ids)):
+            db = SessionLocal()
+            try:
+                parent_ids = {
+                    row.parent_id
+                    for row in db.query(DBTask.parent_id).filter(DBTask.parent_id.in_(task_ids)).distinct()
+                }
+                children = db.query(DBTask.id).filter(DBTask.parent_id.in_(parent_ids))
+                ids = (set(task_ids) - parent_ids) | {row.id for row in children}
+
+                # первая запись берет блокировку, чтобы воркер не записал статус между проверкой и отменой
+                locked = db.query(DBTask).filter(DBTask.id.in_(ids))
+                locked.update({DBTask.name: DBTask.name}, synchronize_session=False)
+                tasks = locked.filter(DBTask.state.in_(('PREPARING', 'IN_PROGRESS'))).all()
+
+                alive = time.time() - WORKER_TIMEOUT
+                for task in tasks:
+                    task.cancel_requested = True
+                    if task.celery_task:
+                        celery.control.revoke(task.celery_task)
+                    if not task.heartbeat or task.heartbeat < alive:
+                        for stage, status in cancel_stages(task).items():
+                            setattr(task, stage, status)
+                    if task.parent_id:
+                        parent_ids.add(task.parent_id)
+
+                db.commit()
+            except SQLAlchemyError as e:
+                db.rollback()
+                raise Exception(f"TaskUploader (request_cancel): Ошибка при отмене задач: {e}")
+            finally:
+                db.close()
+
+            for parent_id in parent_ids:
+                TaskUploader.update_parent(parent_id)
+            return len(tasks)
+
+    @staticmethod
+    def finish_cancel(task_id, celery_task):
+        """
+        Отметка отмены задачи воркером, который ее выполнял.
+
+        :param task_id: ID задачи.
+        :param celery_task: ID Celery-задачи, которая выполняла задачу.
+
+        :return:
+            Обновленная задача или None, если задача удалена или перезапущена.
+        """
+        return TaskUploader.update_running(task_id, celery_task, cancel_stages, cancelled=True)
+
+    @staticmethod
+    def get_children(task_id):
+        """
+        Получение тайлов логической задачи.
+
+        :param task_id: ID логической задачи.
+
+        :return:
+            Список задач-тайлов (пустой, если задача не разбивалась).
+        """
+
+        db = SessionLocal(expire_on_commit=False)
+        try:
+            return db.query(DBTask).filter(DBTask.parent_id == task_id).order_by(DBTask.id).all()
+        finally:
+            db.close()
+
+    @staticmethod
+    def update_parent(parent_id):
+        """
+        Пересчет статусов логической задачи по статусам ее тайлов.
+        Тайлы читаются и задача записывается в одной транзакции под блокировкой базы на запись,
+        поэтому при одновременном завершении тайлов последний пересчет видит статусы всех тайлов.
+
+        :param parent_id: ID логической задачи.
+
+        :return:
+            Обновленная логическая задача или None, если тайлов нет.
+        """
+
+        with trace('db.update_parent', table='ngw_tasks', task_id=parent_id):
+            db = SessionLocal(expire_on_commit=False)
+            try:
+                # первая запись берет блокировку до чтения тайлов
+                locked = (
+                    db.query(DBTask)
+                    .filter(DBTask.id == parent_id)
+                    .update({DBTask.name: DBTask.name}, synchronize_session=False)
+                )
+                children = db.query(DBTask).filter(DBTask.parent_id == parent_id).order_by(DBTask.id).all()
+                if not locked or not children:
+                    db.rollback()
+                    return None
+
+                names = [child.name for child in children]
+                db_parent = db.query(DBTask).filter(DBTask.id == parent_id).first()
+                for stage in ('kpt_status', 'kad_status'):
+                    setattr(db_parent, stage, aggregate_status([getattr(child, stage) for child in children], names))
+
+                db.commit()
+                return db_parent
+            except SQLAlchemyError as e:
+                db.rollback()
+                raise Exception(f"TaskUploader (update_parent): Ошибка при обновлении логической задачи: {e}")
+            finally:
+                db.close()
+
+    @staticmethod
+    def update_parents():
+        """
+        Пересчет всех незавершенных логических задач
+        (при запуске приложения, если обновление после завершения тайла не было записано).
+
+        :return:
+            Количество пересчитанных задач.
+        """
+
+        parent = aliased(DBTask)
+        db = SessionLocal()
+        try:
+            parent_ids = [
+                row.parent_id
+                for row in db.query(DBTask.parent_id)
+                .join(parent, parent.id == DBTask.parent_id)
+                .filter(parent.state.in_(("PREPARING", "IN_PROGRESS")))
+                .distinct()
+            ]
+        finally:
+            db.close()
+
+        for parent_id in parent_ids:
+            TaskUploader.update_parent(parent_id)
+        return len(parent_ids)
+
     @staticmethod
     def upload_file(content, filename=None, dest='data/uploaded/'):
         """
@@ -184,7 +572,7 @@ class TaskUploader:
         :param dest: Папка для сохранения файла.
         :param filename: Имя файла для сохранения. Если не указано, пытается использовать file.filename.
         :return:
-            files: Список файлов для обработки.
+            files: Список охватов для обработки (см. make_parts).
         """
 
         if not filename:
@@ -222,7 +610,7 @@ class TaskUploader:
         :param parts: Разбивать файлы на части.
 
         :return:
-            files: Список файлов для обработки.
+            files: Список файлов (parts=False) или список охватов (parts=True, см. make_parts).
         """
 
         zip_path = TaskUploader.find_path(dest + 'temp_' + filename)
@@ -254,11 +642,12 @@ class TaskUploader:
                         if file_ext in ['.shp', '.geojson']:
                             parts_files.append(final_path)
 
+        covers = []
         for part in parts_files:
-            files.extend(TaskUploader.make_parts(dest, part, filename))
+            covers.extend(TaskUploader.make_parts(dest, part, filename))
 
         TaskUploader.clean_files(dest)
-        return files
+        return covers if parts else files
 
     @staticmethod
     def process_file(content, dest, filename, parts=True):
@@ -272,7 +661,7 @@ class TaskUploader:
         :param parts: Разбивать файлы на части.
 
         :return:
-            files: Список файлов для обработки.
+            files: Список файлов (parts=False) или список охватов (parts=True, см. make_parts).
         """
 
         base_filename = "temp_" + filename if parts else filename
@@ -281,38 +670,102 @@ class TaskUploader:
         with open(geo_path, 'wb') as f:
             f.write(content)
 
-        files = TaskUploader.make_parts(dest, geo_path, filename) if parts else [geo_path]
+        files = dict(TaskUploader.make_parts(dest, geo_path, filename)) if parts else [geo_path]
         TaskUploader.clean_files(dest)
         return files
 
     @staticmethod
-    def make_parts(dest, filepath, filename):
-        gdf = gpd.read_file(filepath)
+    def make_parts(dest, filepath, filename, stats=None, limit=None):
+        """
+        Разбивает файл охвата на отдельные объекты.
+        Геометрии охватов исправляются, упрощаются и округляются (см. app.preprocess),
+        слишком большие охваты дополнительно разбиваются на тайлы (см. app.tiling).
 
-        if gdf.crs != 'EPSG:4326':
-            gdf = gdf.to_crs('EPSG:4326')
+        :param dest: Папка для сохранения файлов.
+        :param filepath: Путь к файлу охвата.
+        :param filename: Исходное имя загруженного файла.
+        :param stats: Словарь для статистики подготовки геометрий и ошибок (ключ errors).
+        :param limit: Максимальное количество объектов для разбора (остальные не читаются).
 
-        files = []
+        :return:
+            Генератор (имя охвата, ключ охвата, [(имя тайла, ключ тайла)]) по мере сохранения охватов.
+            Для охватов без разбиения список тайлов пуст.
+        """
+        import geopandas as gpd
 
-        for index, row in gdf.iterrows():
-            base_name_parts = []
+        stats = {} if stats is None else stats
+        remaining = limit
 
-            if 'name' in row:
-                base_name_parts.append(row['name'])
+        # большие файлы читаются порциями, чтобы память не зависела от размера файла
+        for gdf in iter_chunks(filepath):
+            if remaining is not None:
+                if remaining <= 0:
+                    break
+                gdf = gdf.iloc[:remaining]
+                remaining -= len(gdf)
 
-            if 'lpu' in row:
-                base_name_parts.append(row['lpu'])
+            if gdf.crs != 'EPSG:4326':
+                gdf = gdf.to_crs('EPSG:4326')
 
-            if not base_name_parts:
-                base_name_parts.extend([Path(filename).stem, str(index)])
+            for position, (index, row) in enumerate(gdf.iterrows()):
+                base_name_parts = []
 
-            geo_name = dest + "_".join(base_name_parts) + '.geojson'
-            geo_path = TaskUploader.find_path(geo_name)
-            polygon = gdf[gdf.index == index]
-            polygon.to_file(geo_path, driver='GeoJSON')
-            files.append(geo_path)
+                if 'name' in row:
+                    base_name_parts.append(row['name'])
 
-        return files
+                if 'lpu' in row:
+                    base_name_parts.append(row['lpu'])
+
+                if not base_name_parts:
+                    base_name_parts.extend([Path(filename).stem, str(index)])
+
+                geo_name = dest + "_".join(base_name_parts) + '.geojson'
+                geo_path = TaskUploader.find_path(geo_name)
+                polygon = gdf.iloc[[position]].copy()
+
+                # охваты с неисправимой геометрией отклоняются сразу, а не после ожидания ответа сервера
+                try:
+                    geometry = preprocess_cover(polygon.geometry.iloc[0], Path(geo_path).stem, stats)
+                except ValueError as e:
+                    stats.setdefault('errors', []).append(str(e))
+                    continue
+
+                polygon[polygon.geometry.name] = gpd.GeoSeries([geometry], index=polygon.index, crs=polygon.crs)
+                polygon.to_file(geo_path, driver='GeoJSON', **write_options())
+                stats['file_bytes'] = stats.get('file_bytes', 0) + os.path.getsize(geo_path)
+                tiles = TaskUploader.make_tiles(polygon, geo_path)
+                yield Path(geo_path).stem, put_blob(geo_path), tiles
+
+        print(f"TaskUploader (make_parts): {os.path.basename(filepath)}: {format_stats(stats)}")
+
+    @staticmethod
+    def make_tiles(polygon, geo_path):
+        """
+        Сохраняет тайлы охвата рядом с файлом охвата.
+
+        :param polygon: GeoDataFrame с одним объектом охвата.
+        :param geo_path: Путь к файлу охвата.
+
+        :return:
+            tiles: Список (имя тайла, ключ тайла) (пустой, если охват не требует разбиения).
+        """
+        import geopandas as gpd
+
+        base, extension = os.path.splitext(geo_path)
+        tiles = []
+
+        for number, tile in enumerate(split_cover(polygon.geometry.iloc[0]), start=1):
+            tile_gdf = polygon.copy()
+            tile_gdf[polygon.geometry.name] = gpd.GeoSeries([tile], index=polygon.index, crs=polygon.crs)
+
+            tile_path = TaskUploader.find_path(f"{base}_tile{number}{extension}")
+            tile_gdf.to_file(tile_path, driver='GeoJSON', **write_options())
+            tiles.append((Path(tile_path).stem, put_blob(tile_path)))
+
+        if tiles:
+            print(f"TaskUploader (make_tiles): {os.path.basename(geo_path)} разбит на {len(tiles)} тайлов")
+
+        return tiles
 
     @staticmethod
     def clean_files(dest):
@@ -324,21 +777,37 @@ class TaskUploader:
     def restart_task(db_task, celery):
         """
         Перезапуск задачи.
+        У логической задачи нет своей Celery-задачи, поэтому вместо нее перезапускаются
+        незавершенные тайлы, а ее статусы пересчитываются по ним.
+
+        :param db_task: Задача или ее ID.
+        :param celery: Приложение Celery.
+
+        :return:
+            Список задач, которые нужно отправить в очередь.
         """
         db_task = TaskUploader.create_or_update(
             model=DBTask,
             instance=db_task,
         )
 
+        children = TaskUploader.get_children(db_task.id)
+        if children:
+            restarted = [
+                TaskUploader.restart_task(child, celery)[0]
+                for child in children
+                if child.kpt_status.get('state') != 'SUCCESS' or child.kad_status.get('state') != 'SUCCESS'
+            ]
+            TaskUploader.update_parent(db_task.id)
+            return restarted
+
         files_for_delete = [
             db_task.kpt_file,
             db_task.kad_file,
-            f'data/temp/task_{db_task.id}_files.zip',
         ]
 
-        delete_paths(*files_for_delete)
-
-        celery.control.revoke(db_task.celery_task, terminate=True)
+        if db_task.celery_task:
+            celery.control.revoke(db_task.celery_task)
         celery_uuid = uuid4()
         moscow_time = datetime.now(ZoneInfo("Europe/Moscow"))
 
@@ -354,7 +823,12 @@ class TaskUploader:
                 'kad_task_id': None,
                 'added': moscow_time,
                 'celery_task': str(celery_uuid),
+                'cancel_requested': False,
+                'heartbeat': None,
             },
         )
 
-        return db_task
+        # файлы удаляются после сброса ссылок, иначе блобы считались бы используемыми
+        remove_paths(*files_for_delete)
+
+        return [db_task]
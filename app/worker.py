@@ -1,18 +1,134 @@
 from celery import Celery, Task
 from celery.exceptions import SoftTimeLimitExceeded
 import os
-from .ng_toolbox import NGToolbox
-from .uploader import TaskUploader
+from .ng_toolbox import NGToolbox, TransientToolboxError, CircuitOpenError
+from .uploader import TaskUploader, remove_paths
 from .db import DBTask
+from .profiler import profile, is_profiling_requested, PROFILE_TASKS
+from .scheduler import PollScheduler, job_size
+from .blobs import put_blob, claim_blobs, discard_blobs
+from .breaker import toolbox_breaker
+from .tracing import trace, trace_headers, current_trace_id
 import time
 import random
+from uuid import uuid4
 
 celery = Celery(__name__)
 celery.conf.broker_url = os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0")
 celery.conf.result_backend = os.getenv("CELERY_RESULT_BACKEND", "redis://localhost:6379/0")
+# используется при запуске воркера с --autoscale=MAX,MIN
+celery.conf.worker_autoscaler = 'app.autoscale:QueueAutoscaler'
 
+CANCEL_CHECK_INTERVAL = float(os.getenv('CANCEL_CHECK_INTERVAL', '5'))  # период проверки отмены задачи, сек
+HEARTBEAT_INTERVAL = float(os.getenv('WORKER_HEARTBEAT_INTERVAL', '60'))  # период отметки воркера в задаче, сек
+TRANSIENT_MAX_RETRIES = int(os.getenv('TRANSIENT_MAX_RETRIES', '5'))  # повторов при временных ошибках
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', '60'))  # задержка перед первым повтором, сек
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', '1800'))  # максимальная задержка повтора, сек
 
-def check_status(ngw_task_id: str | None, task_type: str, db_task: int | DBTask) -> DBTask:
+# ошибки, после которых задачу можно продолжить с последнего завершенного этапа
+TRANSIENT_ERRORS = (TransientToolboxError, TimeoutError, SoftTimeLimitExceeded)
+
+
+class TaskCancelled(Exception):
+    """
+    Задача удалена, перезапущена или отменена пользователем.
+    """
+
+    def __init__(self, reason):
+        super().__init__(f"Задача отменена ({reason})")
+        self.reason = reason
+
+
+def update_parent(db_task: DBTask):
+    try:
+        TaskUploader.update_parent(db_task.parent_id)
+    except Exception as e:
+        print(f"Задача {db_task.id}: не удалось обновить логическую задачу: {e}")
+
+
+def check_cancelled(db_task_id: int, celery_task: str | None):
+    reason = TaskUploader.cancel_reason(db_task_id, celery_task)
+    if reason:
+        raise TaskCancelled(reason)
+
+
+def save(db_task_id: int, celery_task: str | None, params: dict) -> DBTask:
+    """
+    Запись в задачу вместе с отметкой воркера. Если задача удалена, перезапущена или отменена,
+    запись не выполняется и воркер прекращает работу с задачей.
+    """
+    db_task = TaskUploader.update_running(db_task_id, celery_task, {**params, 'heartbeat': time.time()})
+    if db_task is None:
+        raise TaskCancelled(TaskUploader.cancel_reason(db_task_id, celery_task) or 'cancelled')
+    return db_task
+
+
+def finish(db_task_id: int, celery_task: str | None, params: dict):
+    """
+    Запись итогового статуса задачи. Задача с запрошенной отменой отмечается отмененной,
+    перезапущенная или удаленная задача не изменяется.
+    """
+    if TaskUploader.update_running(db_task_id, celery_task, params) is None:
+        if TaskUploader.cancel_reason(db_task_id, celery_task) == 'cancelled':
+            TaskUploader.finish_cancel(db_task_id, celery_task)
+
+
+def wait(seconds: float, db_task_id: int, celery_task: str | None):
+    """
+    Пауза между запросами статуса с периодической проверкой отмены задачи и отметкой воркера.
+    """
+    deadline = time.time() + seconds
+    beat = time.time()
+    while True:
+        check_cancelled(db_task_id, celery_task)
+        if time.time() - beat >= HEARTBEAT_INTERVAL:
+            save(db_task_id, celery_task, {})
+            beat = time.time()
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        time.sleep(min(remaining, CANCEL_CHECK_INTERVAL))
+
+
+def retry_delay(attempt: int) -> float:
+    """
+    Экспоненциальная задержка повтора со случайным разбросом, чтобы задачи не повторялись одновременно.
+    """
+    delay = min(RETRY_BASE_DELAY * 2 ** attempt, RETRY_MAX_DELAY)
+    return delay * random.uniform(0.75, 1.25)
+
+
+def send_task(db_task: DBTask):
+    """
+    Отправка задачи в очередь. Ожидающий повтор отправляется с его retry_id: если сообщение повтора
+    с ETA еще в очереди, выполнится только одно из них (см. TaskUploader.claim_retry).
+    Повторная отправка продолжает трассу задачи.
+    """
+    status = getattr(db_task, f'{db_task.stage}_status') or {}
+    kwargs = {'attempt': status['retry'], 'retry_id': status['retry_id']} if status.get('retry_id') else {}
+    with trace('worker.send', trace_id=db_task.trace_id, task_id=db_task.id):
+        CollectKadTask().apply_async(
+            args=(db_task.id,), kwargs=kwargs, task_id=db_task.celery_task, headers=trace_headers()
+        )
+
+
+def wake_retries():
+    """
+    Запуск задач, ожидающих восстановления NG Toolbox, сразу после замыкания предохранителя,
+    не дожидаясь окончания их задержки.
+    """
+    for db_task in TaskUploader.get_waiting_retries():
+        print(f"Задача {db_task.id}: сервис восстановлен, повтор отправлен")
+        send_task(db_task)
+
+
+toolbox_breaker.on_close(wake_retries)
+
+
+def check_status(
+    ngw_task_id: str | None, task_type: str, db_task: int | DBTask, celery_task: str | None = None
+) -> DBTask:
     task_config = {
         'kpt': {'file_key': 'kpt_file', 'upload_method': TaskUploader.process_file, 'suffix': '.csv'},
         'kad': {'file_key': 'kad_file', 'upload_method': TaskUploader.process_zip, 'suffix': '.zip'},
@@ -27,55 +143,76 @@ def check_status(ngw_task_id: str | None, task_type: str, db_task: int | DBTask)
 
     max_total_time = 60 * 30  # 30 минут
     start_time = time.time()
-    max_delay = 60 * 5  # максимальная задержка между попытками
-    attempts = 0
 
-    jitter = random.uniform(0, 3)
-    time.sleep(jitter)
+    # время отправки задачи сохраняется в статусе, чтобы после перезапуска воркера учитывать ее длительность
+    previous_status = getattr(db_task, status_key, None) if isinstance(db_task, DBTask) else None
+    scheduler = PollScheduler(
+        task_type,
+        size=job_size(task_type, db_task) if isinstance(db_task, DBTask) else None,
+        started=(previous_status or {}).get('submitted'),
+    )
 
-    while True:
-        if time.time() - start_time > max_total_time:
-            raise TimeoutError(f"Превышено время обработки задачи")
+    db_task_id = db_task.id if isinstance(db_task, DBTask) else db_task
+    written = []
 
-        status = NGToolbox.status(task_id=ngw_task_id)
-
-        if status['state'] == 'FAILED':
-            raise Exception(status['error'] if status['error'] else 'Неизвестная ошибка')
-
-        if status['state'] == 'CANCELLED':
-            raise Exception('Задача была отменена')
-
-        db_task = TaskUploader.create_or_update(
-            model=DBTask, instance=db_task, params={status_key: status, task_id: ngw_task_id}
-        )
-
-        if status['state'] == 'SUCCESS':
-            file_key = config['file_key']
-            if not getattr(db_task, file_key, None):
-                file_url = status['output'][0]['value']
-                file = NGToolbox.download(file_url=file_url)
-                task_path = config['upload_method'](
-                    content=file,
-                    filename=db_task.name + config['suffix'],
-                    dest='data/results/',
-                    parts=False,
-                )
-
-                db_task = TaskUploader.create_or_update(
-                    model=DBTask,
-                    instance=db_task,
-                    params={
-                        file_key: task_path[0],
-                    },
-                )
-
-            break
-
-        jitter = random.uniform(0, 10)
-        sleep_time = min(attempts * 2 + jitter, max_delay)
-        print(f"Попытка {attempts + 1} через {sleep_time} секунд")
-        time.sleep(sleep_time)
-        attempts += 1
+    with trace(f'stage.{task_type}', toolbox_task_id=ngw_task_id) as span:
+        try:
+            wait(random.uniform(0, 3), db_task_id, celery_task)
+
+            while True:
+                if time.time() - start_time > max_total_time:
+                    raise TimeoutError("Превышено время обработки задачи")
+
+                status = NGToolbox.status(task_id=ngw_task_id)
+
+                if status['state'] == 'FAILED':
+                    raise Exception(status['error'] if status['error'] else 'Неизвестная ошибка')
+
+                if status['state'] == 'CANCELLED':
+                    raise Exception('Задача была отменена')
+
+                status['submitted'] = scheduler.started
+                previous_state = (getattr(db_task, status_key, None) or {}).get('state')
+                db_task = save(db_task_id, celery_task, {status_key: status, task_id: ngw_task_id})
+                if db_task.parent_id and status['state'] != previous_state:
+                    # логическая задача показывает ход тайлов, а не только их завершение
+                    update_parent(db_task)
+
+                if status['state'] == 'SUCCESS':
+                    file_key = config['file_key']
+                    if not getattr(db_task, file_key, None):
+                        scheduler.record(status)
+                        file_url = status['output'][0]['value']
+                        file = NGToolbox.download(file_url=file_url)
+                        task_path = config['upload_method'](
+                            content=file,
+                            filename=db_task.name + config['suffix'],
+                            dest='data/results/',
+                            parts=False,
+                        )
+                        written.extend(task_path)
+
+                        key = put_blob(task_path[0])
+                        try:
+                            db_task = save(db_task_id, celery_task, {file_key: key})
+                        except Exception:
+                            # ссылка на файл не записана: блоб удаляется, если его не используют другие задачи
+                            discard_blobs(key)
+                            raise
+                        claim_blobs(key)
+
+                    if span:
+                        span.set(polls=scheduler.polls)
+                    break
+
+                sleep_time = scheduler.next_delay(status)
+                print(f"Попытка {scheduler.polls + 1} через {sleep_time:.1f} секунд")
+                wait(sleep_time, db_task_id, celery_task)
+        except TaskCancelled:
+            # задача на сервере больше не нужна, а скачанные файлы не попали в базу
+            NGToolbox.cancel(ngw_task_id)
+            remove_paths(*written)
+            raise
 
     return db_task
 
@@ -103,7 +240,45 @@ class CollectKadTask(Task):
 
     def run(self, *args, **kwargs):
         db_task_id = args[0]
+        enabled = PROFILE_TASKS or is_profiling_requested(kwargs.get('profile'), self.request.get('profile'))
+
+        # контекст трассы передается в заголовке сообщения, без него задача начинает новую трассу
+        traceparent = self.request.get('traceparent') or (self.request.headers or {}).get('traceparent')
+        attempt = kwargs.get('attempt', 0)
+
+        with profile('task', f'{self.name}_{db_task_id}', enabled=enabled), trace(
+            'worker.collect_kad', traceparent=traceparent, root=True, task_id=db_task_id, attempt=attempt
+        ):
+            retry = self.collect(db_task_id, attempt=attempt, retry_id=kwargs.get('retry_id'))
+            headers = trace_headers()
+
+        if retry:
+            # задача продолжится с последнего завершенного этапа: ID задач и файлы этапов сохранены в базе
+            countdown, attempt, retry_id = retry
+            self.retry(
+                kwargs={**kwargs, 'attempt': attempt, 'retry_id': retry_id},
+                countdown=countdown,
+                max_retries=None,
+                headers=headers,
+            )
+
+    def collect(self, db_task_id, attempt=0, retry_id=None):
+        """
+        Выполнение этапов задачи.
+
+        :param db_task_id: ID задачи в базе.
+        :param attempt: Номер повтора после временной ошибки.
+        :param retry_id: ID повтора, если задача запущена повтором.
+        :return:
+            None или (задержка, номер повтора, ID повтора), если задачу нужно повторить.
+        """
         current_stage = 'kpt_status'
+        celery_task = self.request.id
+        retry = None
+
+        if retry_id and not TaskUploader.claim_retry(db_task_id, retry_id):
+            print(f"Задача {db_task_id}: повтор {retry_id} уже выполняется или отменен, пропуск")
+            return None
 
         db_task = TaskUploader.create_or_update(
             model=DBTask,
@@ -111,36 +286,97 @@ class CollectKadTask(Task):
         )
 
         try:
+            # отметка воркера: отмена задачи, которую никто не выполняет, не ждет воркера (см. TaskUploader.request_cancel)
+            db_task = save(db_task_id, celery_task, {'trace_id': current_trace_id()} if current_trace_id() else {})
+
             if os.statvfs('/').f_bsize * os.statvfs('/').f_bavail < 500 * 1024 * 1024:
                 raise Exception('Worker (collect_kad): Недостаточно места на диске')
 
             # ПОЛУЧЕНИЕ СПИСКА КПТ ПО ЗАДАННОЙ ОБЛАСТИ
             if db_task.kpt_task_id:
-                db_task = check_status(ngw_task_id=db_task.kpt_task_id, task_type='kpt', db_task=db_task)
+                db_task = check_status(db_task.kpt_task_id, 'kpt', db_task, celery_task)
             else:
                 file_id = NGToolbox.upload(upload_file=db_task.cover_file)
                 task_id = NGToolbox.collect_kpt(file_id=file_id)
-                db_task = check_status(ngw_task_id=task_id, task_type='kpt', db_task=db_task)
+                db_task = check_status(task_id, 'kpt', db_task, celery_task)
 
             # ПОЛУЧЕНИЕ ГЕОМЕТРИИ ПО КАДАСТРОВЫМ НОМЕРАМ
             current_stage = 'kad_status'
+            check_cancelled(db_task_id, celery_task)
             if db_task.kad_task_id:
-                db_task = check_status(ngw_task_id=db_task.kad_task_id, task_type='kad', db_task=db_task)
+                db_task = check_status(db_task.kad_task_id, 'kad', db_task, celery_task)
             else:
                 file_id = NGToolbox.upload(upload_file=db_task.kpt_file)
                 task_id = NGToolbox.collect_kad(file_id=file_id)
-                db_task = check_status(ngw_task_id=task_id, task_type='kad', db_task=db_task)
-        except SoftTimeLimitExceeded:
-            TaskUploader.create_or_update(
-                model=DBTask,
-                instance=db_task,
-                params={current_stage: {'state': 'FAILED', 'error': '(Worker): Превышено время выполнения задачи'}},
-            )
+                db_task = check_status(task_id, 'kad', db_task, celery_task)
+        except TaskCancelled as e:
+            print(f"Задача {db_task_id}: {e}")
+            if e.reason == 'cancelled':
+                TaskUploader.finish_cancel(db_task_id, celery_task)
+        except CircuitOpenError as e:
+            # сервис недоступен: ждем восстановления, не расходуя повторы
+            retry = self.set_retrying(db_task, celery_task, current_stage, e, (e.retry_after, attempt), breaker=True)
+        except TRANSIENT_ERRORS as e:
+            if isinstance(e, SoftTimeLimitExceeded):
+                e = '(Worker): Превышено время выполнения задачи'
+
+            if attempt < TRANSIENT_MAX_RETRIES:
+                # пока предохранитель разомкнут, повтор раньше окончания паузы сразу получит отказ
+                cooldown = toolbox_breaker.remaining_cooldown()
+                retry = self.set_retrying(
+                    db_task,
+                    celery_task,
+                    current_stage,
+                    e,
+                    (cooldown or retry_delay(attempt), attempt + 1),
+                    breaker=bool(cooldown),
+                )
+            else:
+                finish(
+                    db_task_id,
+                    celery_task,
+                    {current_stage: {'state': 'FAILED', 'error': f"{e} (повторов: {attempt})"}},
+                )
         except Exception as e:
-            TaskUploader.create_or_update(
-                model=DBTask, instance=db_task, params={current_stage: {'state': 'FAILED', 'error': str(e)}}
-            )
-        return
+            finish(db_task_id, celery_task, {current_stage: {'state': 'FAILED', 'error': str(e)}})
+        finally:
+            if db_task.parent_id:
+                update_parent(db_task)
+
+        return retry
+
+    @staticmethod
+    def set_retrying(db_task, celery_task, stage, error, retry, breaker=False):
+        """
+        Сохранение состояния повтора этапа.
+        ID повтора передается в сообщении повтора: выполняет повтор только воркер, захвативший его
+        (см. TaskUploader.claim_retry), а по времени повтора приложение при запуске отличает этапы,
+        сообщение которых еще ожидает в очереди. Воркер снимает с задачи свою отметку,
+        поэтому отмена задачи в ожидании повтора выполняется сразу.
+
+        :param retry: (задержка, номер повтора).
+        :param breaker: Повтор ожидает восстановления NG Toolbox и отправляется сразу после замыкания предохранителя.
+        :return:
+            (задержка, номер повтора, ID повтора) или None, если задача отменена, перезапущена или удалена.
+        """
+        countdown, attempt = retry
+        retry_id = str(uuid4())
+        print(f"Задача {db_task.id}: временная ошибка, повтор {attempt} через {countdown:.0f} секунд: {error}")
+        # сохраняем данные этапа (в т.ч. время отправки задачи на сервер) для продолжения после повтора
+        status = {
+            **(getattr(db_task, stage) or {}),
+            'state': 'RETRYING',
+            'error': str(error),
+            'retry': attempt,
+            'retry_id': retry_id,
+            'retry_at': time.time() + countdown,
+            'breaker': breaker,
+        }
+        if TaskUploader.update_running(db_task.id, celery_task, {stage: status, 'heartbeat': None}) is None:
+            if TaskUploader.cancel_reason(db_task.id, celery_task) == 'cancelled':
+                TaskUploader.finish_cancel(db_task.id, celery_task)
+            return None
+        return countdown, attempt, retry_id
 
 
 celery.register_task(CollectKadTask())
@@ -0,0 +1,76 @@
+"""
+Замер времени импорта и потребления памяти процессами API и воркера.
+
+Запуск из корня проекта:
+    python benchmarks/import_bench.py --max-seconds 3 --max-rss-mb 120
+
+Завершается с кодом 1, если при импорте загружаются геоданные (geopandas, shapely, pyproj, pyogrio)
+или превышены заданные лимиты.
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+HEAVY_MODULES = ('geopandas', 'shapely', 'pyproj', 'pyogrio', 'fiona', 'pandas')
+
+MODULES = {
+    'api': 'app.main',
+    'worker': 'app.worker',
+}
+
+PROBE = """
+import sys, time, json, resource
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+heavy = sorted(name for name in {heavy!r} if name in sys.modules)
+print(json.dumps({{'seconds': elapsed, 'rss_mb': rss, 'heavy': heavy}}))
+"""
+
+
+def measure(module: str) -> dict:
+    env = dict(os.environ)
+    env.setdefault('NGT_TOKEN', 'bench')
+
+    result = subprocess.run(
+        [sys.executable, '-c', PROBE.format(module=module, heavy=HEAVY_MODULES)],
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+
+    if result.returncode != 0:
+        raise RuntimeError(f"Ошибка импорта {module}:\n{result.stderr}")
+
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Замер времени импорта и памяти процессов сервиса')
+    parser.add_argument('--max-seconds', type=float, default=None, help='Лимит времени импорта, сек')
+    parser.add_argument('--max-rss-mb', type=float, default=None, help='Лимит пикового RSS, МБ')
+    args = parser.parse_args()
+
+    failed = False
+    for name, module in MODULES.items():
+        stats = measure(module)
+        print(f"{name:<7} {module:<11} {stats['seconds']:.3f} сек  {stats['rss_mb']:.1f} МБ")
+
+        if stats['heavy']:
+            print(f"  Загружены тяжелые модули: {', '.join(stats['heavy'])}")
+            failed = True
+        if args.max_seconds is not None and stats['seconds'] > args.max_seconds:
+            print(f"  Превышен лимит времени импорта ({args.max_seconds} сек)")
+            failed = True
+        if args.max_rss_mb is not None and stats['rss_mb'] > args.max_rss_mb:
+            print(f"  Превышен лимит памяти ({args.max_rss_mb} МБ)")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# приложение работает с путями относительно рабочей папки (data/...), поэтому тесты
+# запускаются во временной папке, а окружение задается до импорта модулей приложения
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORKDIR = tempfile.mkdtemp(prefix='ngw_tests_')
+os.chdir(WORKDIR)
+os.makedirs('data/database', exist_ok=True)
+
+# статические файлы и шаблоны app.main подключаются по относительным путям
+os.makedirs('app', exist_ok=True)
+for folder in ('static', 'templates'):
+    os.symlink(os.path.join(ROOT, 'app', folder), os.path.join('app', folder))
+
+os.environ.setdefault('NGT_TOKEN', 'test')
+
+
+@pytest.fixture
+def db():
+    """
+    Пустая база для теста.
+    """
+    from app.db import Base, engine, SessionLocal, migrate
+
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    migrate()
+
+    session = SessionLocal(expire_on_commit=False)
+    yield session
+    session.close()
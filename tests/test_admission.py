@@ -0,0 +1,165 @@
+import json
+import asyncio
+
+import aiosqlite
+import pytest
+
+import app.admission as admission
+from app.db import DBTask, DBTasksGroup
+from app.admission import AdmissionMiddleware, client_id
+
+
+@pytest.fixture(autouse=True)
+def no_broker(monkeypatch):
+    monkeypatch.setattr(admission, 'queue_depth', lambda: 0)
+
+
+def make_scope(headers=None, client=('10.0.0.1', 1234), path='/run_tasks'):
+    return {
+        'type': 'http',
+        'method': 'POST',
+        'path': path,
+        'client': client,
+        'headers': [(name.encode(), value.encode()) for name, value in (headers or {}).items()],
+    }
+
+
+def call(scope):
+    """
+    Выполняет запрос через middleware: (статус, заголовки, тело) ответа и признак вызова приложения.
+    """
+    messages = []
+    called = []
+
+    async def app(scope, receive, send):
+        called.append(scope)
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b'{}'})
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(AdmissionMiddleware(app)(scope, receive, send))
+    start, body = messages
+    return start['status'], dict(start['headers']), json.loads(body['body']), bool(called)
+
+
+def test_client_id_ignores_headers_from_untrusted_clients(monkeypatch):
+    monkeypatch.setattr(admission, 'ADMISSION_TRUSTED_PROXIES', set())
+    scope = make_scope({'x-client-id': 'alice', 'x-forwarded-for': '1.2.3.4'})
+
+    assert client_id(scope) == '10.0.0.1'
+
+
+def test_client_id_behind_trusted_proxy(monkeypatch):
+    monkeypatch.setattr(admission, 'ADMISSION_TRUSTED_PROXIES', {'10.0.0.1', '10.0.0.2'})
+
+    assert client_id(make_scope({'x-client-id': 'alice'})) == 'alice'
+    assert client_id(make_scope({'x-forwarded-for': '6.6.6.6, 1.2.3.4, 10.0.0.2'})) == '1.2.3.4'
+    assert client_id(make_scope()) == '10.0.0.1'
+
+
+def test_upload_without_content_length_rejected(db):
+    status, headers, body, called = call(make_scope({'transfer-encoding': 'chunked'}))
+
+    assert status == 411
+    assert 'Content-Length' in body['detail']
+    assert not called
+
+
+def test_oversized_upload_rejected(db, monkeypatch):
+    monkeypatch.setattr(admission, 'ADMISSION_MAX_UPLOAD_MB', 1)
+    status, headers, body, called = call(make_scope({'content-length': str(2 * 1024 * 1024)}))
+
+    assert status == 413
+    assert not called
+
+
+def test_upload_admitted(db):
+    status, headers, body, called = call(make_scope({'content-length': '100'}))
+
+    assert status == 200
+    assert called
+
+
+def test_other_requests_pass(db):
+    status, headers, body, called = call(make_scope({'transfer-encoding': 'chunked'}, path='/tasks'))
+
+    assert status == 200
+    assert called
+
+
+def admit_all(requests):
+    async def run():
+        admits = (admission.admit(client, size) for client, size in requests)
+        return await asyncio.gather(*admits, return_exceptions=True)
+
+    return asyncio.run(run())
+
+
+def test_concurrent_uploads_do_not_overshoot(db, monkeypatch):
+    monkeypatch.setattr(admission, 'ADMISSION_MAX_INGEST', 1)
+    monkeypatch.setattr(admission, 'ADMISSION_MAX_WAITING', 1)
+
+    results = admit_all([(f'client{number}', 100) for number in range(6)])
+
+    admitted = [result for result in results if isinstance(result, int)]
+    rejected = [result for result in results if isinstance(result, admission.AdmissionRejected)]
+    assert len(admitted) == 2
+    assert len(rejected) == 4
+    assert all(error.status_code == 429 and error.retry_after for error in rejected)
+
+
+def test_client_ingest_bytes_limit(db, monkeypatch):
+    monkeypatch.setattr(admission, 'ADMISSION_CLIENT_MAX_INGEST_MB', 1)
+    size = 600 * 1024
+
+    first, second, other = admit_all([('alice', size), ('alice', size), ('bob', size)])
+
+    assert isinstance(first, int) != isinstance(second, int)
+    assert isinstance(other, int)
+
+
+def test_overloaded_uploads_wait(db, monkeypatch):
+    monkeypatch.setattr(admission, 'ADMISSION_MAX_WAITING', 2)
+    monkeypatch.setattr(admission, 'queue_depth', lambda: admission.ADMISSION_MAX_QUEUE)
+
+    results = admit_all([('alice', 100)] * 3)
+
+    assert sum(isinstance(result, int) for result in results) == 2
+
+
+def test_unhandled_upload_releases_reservation(db, monkeypatch):
+    monkeypatch.setattr(admission, 'ADMISSION_MAX_INGEST', 1)
+    monkeypatch.setattr(admission, 'ADMISSION_MAX_WAITING', 0)
+
+    # запрос не дошел до обработчика (например, ошибка проверки формы): место освобождается
+    status, headers, body, called = call(make_scope({'content-length': '100'}))
+    assert status == 200
+
+    status, headers, body, called = call(make_scope({'content-length': '100'}))
+    assert status == 200
+
+
+def test_pending_excludes_logical_tasks(db):
+    group = DBTasksGroup(name='group', client='alice')
+    db.add(group)
+    db.commit()
+    parent = DBTask(name='cover', group_id=group.id)
+    db.add(parent)
+    db.commit()
+    db.add_all(
+        DBTask(name=f'cover_tile{number}', group_id=group.id, parent_id=parent.id, celery_task=f'tile{number}')
+        for number in range(2)
+    )
+    db.commit()
+
+    async def load():
+        async with aiosqlite.connect(admission.DATABASE_URL) as connection:
+            return await admission.load(connection, 'alice')
+
+    state = asyncio.run(load())
+    assert (state['pending'], state['client_pending']) == (2, 2)
@@ -0,0 +1,118 @@
+from celery.worker import state
+
+from app import autoscale
+from app.autoscale import QueueAutoscaler
+
+
+class FakePipeline:
+    def __init__(self, queues: dict):
+        self.queues = queues
+        self.commands = []
+
+    def llen(self, queue):
+        self.commands.append(queue)
+
+    def execute(self):
+        return [self.queues.get(queue, 0) for queue in self.commands]
+
+
+class FakeRedis:
+    def __init__(self, queues: dict):
+        self.queues = queues
+
+    def pipeline(self):
+        return FakePipeline(self.queues)
+
+
+class FakeBreaker:
+    def status(self):
+        return {'tripped': False}
+
+
+class FakePool:
+    num_processes = 1
+
+
+class FakeQoS:
+    def __init__(self):
+        self.changes = []
+
+    def increment_eventually(self, n=1):
+        self.changes.append(n)
+
+    def decrement_eventually(self, n=1):
+        self.changes.append(-n)
+
+
+class FakeConsumer:
+    prefetch_multiplier = 4
+
+    def __init__(self):
+        self.qos = FakeQoS()
+
+
+class FakeWorker:
+    max_concurrency, min_concurrency = 4, 1
+    consumer = None
+
+
+class FakeRequest:
+    pass
+
+
+def make_scaler(monkeypatch, queues: dict):
+    monkeypatch.setattr(autoscale, '_redis', FakeRedis(queues))
+    monkeypatch.setattr(autoscale, 'toolbox_breaker', FakeBreaker())
+    monkeypatch.setattr(autoscale, 'cpu_load', lambda: 0.1)
+    monkeypatch.setattr(autoscale, 'free_disk_mb', lambda: 100000.0)
+    return QueueAutoscaler(FakePool(), 8, 1)
+
+
+def test_target_counts_reserved_and_queued(monkeypatch):
+    scaler = make_scaler(monkeypatch, {'celery': 2})
+    requests = [FakeRequest() for _ in range(3)]
+    for request in requests:
+        state.reserved_requests.add(request)
+    try:
+        target, metrics = scaler.compute_target(1)
+    finally:
+        for request in requests:
+            state.reserved_requests.discard(request)
+
+    assert (metrics['reserved'], metrics['backlog']) == (3, 2)
+    assert target == 5
+
+    # больше MAX процессов не запускается
+    monkeypatch.setattr(autoscale, '_redis', FakeRedis({'celery': 100}))
+    assert scaler.compute_target(1)[0] == 8
+
+
+def test_target_waits_for_disk_and_cpu(monkeypatch):
+    scaler = make_scaler(monkeypatch, {'celery': 10})
+
+    monkeypatch.setattr(autoscale, 'cpu_load', lambda: 2.0)
+    assert scaler.compute_target(3) == (3, {'reserved': 0, 'backlog': 10, 'load': 2.0, 'free_mb': 100000, 'limit': 'cpu'})
+
+    monkeypatch.setattr(autoscale, 'free_disk_mb', lambda: 10.0)
+    assert scaler.compute_target(3)[0] == 1
+
+
+def test_max_override_updates_worker(monkeypatch):
+    monkeypatch.setattr(autoscale, 'AUTOSCALE_MAX', 10)
+    monkeypatch.setattr(autoscale, 'AUTOSCALE_MIN', 2)
+    worker = FakeWorker()
+
+    scaler = QueueAutoscaler(FakePool(), 4, 1, worker=worker)
+
+    assert (scaler.max_concurrency, scaler.min_concurrency) == (10, 2)
+    assert (worker.max_concurrency, worker.min_concurrency) == (10, 2)
+
+
+def test_max_override_updates_running_consumer_prefetch(monkeypatch):
+    monkeypatch.setattr(autoscale, 'AUTOSCALE_MAX', 2)
+    worker = FakeWorker()
+    worker.consumer = FakeConsumer()
+
+    QueueAutoscaler(FakePool(), 4, 1, worker=worker)
+
+    assert worker.consumer.qos.changes == [-8]
@@ -0,0 +1,140 @@
+import os
+import gzip
+import threading
+
+from app.blobs import put_blob, open_blob, release_blob, claim_blobs, discard_blobs, blob_refs, is_compressed
+from app.db import DBTask, DBBlobLease
+
+
+def write_file(name: str, content: bytes) -> str:
+    os.makedirs('data/tmp', exist_ok=True)
+    path = os.path.join('data/tmp', name)
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+
+def add_task(db, **params):
+    task = DBTask(name='task', **params)
+    db.add(task)
+    db.commit()
+    return task
+
+
+def test_put_blob_deduplicates_and_compresses(db):
+    first = put_blob(write_file('a.geojson', b'{"type": "FeatureCollection"}'))
+    second = put_blob(write_file('b.geojson', b'{"type": "FeatureCollection"}'))
+
+    assert first == second
+    assert is_compressed(first)
+    assert not os.path.exists('data/tmp/b.geojson')
+    with gzip.open(first) as f:
+        assert f.read() == b'{"type": "FeatureCollection"}'
+    with open_blob(first) as f:
+        assert f.read() == b'{"type": "FeatureCollection"}'
+
+
+def test_release_blob_counts_references(db):
+    key = put_blob(write_file('cover.geojson', b'cover'))
+    task = add_task(db, cover_file=key)
+    other = add_task(db, kpt_file=key)
+    claim_blobs(key)
+
+    assert blob_refs(key) == 2
+
+    db.delete(task)
+    db.commit()
+    assert not release_blob(key)
+    assert os.path.exists(key)
+
+    db.delete(other)
+    db.commit()
+    assert release_blob(key)
+    assert not os.path.exists(key)
+
+
+def test_release_blob_keeps_unclaimed_blob(db):
+    key = put_blob(write_file('cover.geojson', b'pending'))
+    again = put_blob(write_file('copy.geojson', b'pending'))
+
+    # ссылки из задач еще нет: загрузка сохранила охват, но задачу не создала
+    assert not release_blob(key)
+    assert os.path.exists(key)
+
+    claim_blobs(key)
+    assert not release_blob(key)
+
+    claim_blobs(again)
+    assert db.query(DBBlobLease).count() == 0
+    assert release_blob(key)
+    assert not os.path.exists(key)
+
+
+def test_put_blob_after_release_restores_file(db):
+    key = put_blob(write_file('cover.geojson', b'restored'))
+    claim_blobs(key)
+    assert release_blob(key)
+
+    assert put_blob(write_file('cover.geojson', b'restored')) == key
+    assert os.path.exists(key)
+
+
+def test_put_blob_waits_for_release(db, monkeypatch):
+    import app.blobs as blobs
+
+    key = put_blob(write_file('cover.geojson', b'race'))
+    claim_blobs(key)
+
+    deleting = threading.Event()
+    proceed = threading.Event()
+    storage_delete = blobs.get_storage().delete
+
+    def slow_delete(path):
+        deleting.set()
+        proceed.wait(5)
+        storage_delete(path)
+
+    monkeypatch.setattr(blobs.get_storage(), 'delete', slow_delete)
+
+    released = threading.Thread(target=release_blob, args=(key,))
+    released.start()
+    assert deleting.wait(5)
+
+    # сохранение такого же файла во время удаления ждет его завершения и сохраняет файл заново
+    stored = threading.Thread(target=put_blob, args=(write_file('copy.geojson', b'race'),))
+    stored.start()
+    proceed.set()
+    released.join(5)
+    stored.join(10)
+
+    assert os.path.exists(key)
+
+
+def test_discard_blobs_keeps_referenced(db):
+    shared = put_blob(write_file('shared.geojson', b'shared'))
+    add_task(db, cover_file=shared)
+    claim_blobs(shared)
+    again = put_blob(write_file('again.geojson', b'shared'))
+    unused = put_blob(write_file('unused.geojson', b'unused'))
+
+    # задачи для охватов не созданы
+    discard_blobs(again, unused)
+
+    assert os.path.exists(shared)
+    assert not os.path.exists(unused)
+    assert db.query(DBBlobLease).count() == 0
+
+
+def test_sweep_expired_leases(db, monkeypatch):
+    import app.blobs as blobs
+
+    stale = put_blob(write_file('stale.geojson', b'stale'))
+    fresh = put_blob(write_file('fresh.geojson', b'fresh'))
+    db.query(DBBlobLease).filter(DBBlobLease.key == stale).update({'updated': 0})
+    db.commit()
+
+    assert blobs.sweep_blob_leases() == 1
+
+    assert not os.path.exists(stale)
+    assert os.path.exists(fresh)
+    assert [lease.key for lease in db.query(DBBlobLease)] == [fresh]
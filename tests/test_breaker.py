@@ -0,0 +1,187 @@
+import pytest
+
+from app import breaker
+from app.breaker import CircuitBreaker
+
+
+class FakeRedis:
+    """
+    Команды Redis, которые использует предохранитель, с управляемыми часами для сроков жизни ключей.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        self.data = {}
+        self.expires = {}
+
+    def _alive(self, key):
+        if key in self.expires and self.expires[key] <= self.now:
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.data
+
+    def exists(self, *keys):
+        return sum(self._alive(key) for key in keys)
+
+    def get(self, key):
+        return self.data.get(key) if self._alive(key) else None
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and self._alive(key):
+            return None
+        self.data[key] = value
+        self.expires.pop(key, None)
+        if ex:
+            self.expires[key] = self.now + ex
+        return True
+
+    def incr(self, key):
+        self.data[key] = int(self.get(key) or 0) + 1
+        return self.data[key]
+
+    def expire(self, key, seconds):
+        self.expires[key] = self.now + seconds
+        return True
+
+    def pttl(self, key):
+        if not self._alive(key):
+            return -2
+        return int((self.expires[key] - self.now) * 1000) if key in self.expires else -1
+
+    def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+
+class BrokenRedis:
+    def __getattr__(self, name):
+        raise ConnectionError('redis is down')
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    monkeypatch.setattr(breaker, 'BREAKER_THRESHOLD', 3)
+    monkeypatch.setattr(breaker, 'BREAKER_WINDOW', 60)
+    monkeypatch.setattr(breaker, 'BREAKER_COOLDOWN', 120)
+    return FakeRedis()
+
+
+def make_breaker(client):
+    circuit = CircuitBreaker('test')
+    circuit._client = client
+    return circuit
+
+
+def test_opens_after_threshold(redis):
+    circuit = make_breaker(redis)
+
+    circuit.record_failure()
+    circuit.record_failure()
+    assert circuit.retry_after() == 0
+    assert circuit.status() == {'name': 'test', 'open': False, 'tripped': False, 'failures': 2}
+
+    circuit.record_failure()
+    assert circuit.retry_after() == pytest.approx(120)
+    assert circuit.status()['open'] and circuit.status()['tripped']
+
+
+def test_failures_expire_with_window(redis):
+    circuit = make_breaker(redis)
+
+    circuit.record_failure()
+    circuit.record_failure()
+    redis.now += 61
+    circuit.record_failure()
+
+    assert circuit.retry_after() == 0
+    assert circuit.status()['failures'] == 1
+
+
+def test_half_open_allows_single_probe(redis):
+    circuit = make_breaker(redis)
+    for _ in range(3):
+        circuit.record_failure()
+
+    redis.now += 121
+    assert circuit.retry_after() == 0
+    assert circuit.retry_after() == pytest.approx(120)
+
+    # неудачный пробный запрос сразу размыкает предохранитель снова
+    circuit.record_failure()
+    assert circuit.status()['failures'] == 1
+    assert circuit.retry_after() == pytest.approx(120)
+
+    redis.now += 121
+    assert circuit.retry_after() == 0
+    circuit.record_success()
+    assert circuit.status() == {'name': 'test', 'open': False, 'tripped': False, 'failures': 0}
+    assert circuit.retry_after() == 0
+    assert circuit.retry_after() == 0
+
+
+def test_redis_unavailable_fails_open():
+    circuit = make_breaker(BrokenRedis())
+
+    circuit.record_failure()
+    circuit.record_success()
+
+    assert circuit.retry_after() == 0
+    assert 'error' in circuit.status()
+
+
+def test_remaining_cooldown_has_no_side_effects(redis):
+    circuit = make_breaker(redis)
+    assert circuit.remaining_cooldown() == 0
+
+    for _ in range(3):
+        circuit.record_failure()
+    redis.now += 20
+    assert circuit.remaining_cooldown() == pytest.approx(100)
+
+    # в полуоткрытом состоянии проверка не занимает пробный запрос
+    redis.now += 101
+    assert circuit.remaining_cooldown() == 0
+    assert circuit.retry_after() == 0
+
+
+def test_close_wakes_waiters_once(redis):
+    circuit = make_breaker(redis)
+    woken = []
+    circuit.on_close(lambda: woken.append(redis.now))
+
+    circuit.record_success()
+    assert woken == []
+
+    for _ in range(3):
+        circuit.record_failure()
+    redis.now += 121
+    assert circuit.retry_after() == 0
+    circuit.record_success()
+    circuit.record_success()
+
+    assert woken == [redis.now]
+
+
+def test_close_handler_errors_are_ignored(redis):
+    circuit = make_breaker(redis)
+    circuit.on_close(lambda: 1 / 0)
+    for _ in range(3):
+        circuit.record_failure()
+
+    circuit.record_success()
+
+    assert circuit.status()['tripped'] is False
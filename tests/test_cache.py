@@ -0,0 +1,96 @@
+import asyncio
+from email.utils import formatdate
+
+import aiosqlite
+import pytest
+from starlette.requests import Request
+
+import app.cache as cache
+from app.cache import VersionedCache, conditional_json
+from app.db import DBTask, DBTasksGroup
+from app.main import DATABASE_URL
+
+
+@pytest.fixture(autouse=True)
+def fresh_cache(monkeypatch):
+    monkeypatch.setattr(cache, 'response_cache', VersionedCache())
+
+
+def make_request(headers=None):
+    return Request({'type': 'http', 'headers': [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]})
+
+
+def fetch(scope, headers=None, key=None):
+    """
+    Условный запрос: ответ и количество построений тела.
+    """
+    builds = []
+
+    async def build():
+        builds.append(scope)
+        return {'scope': scope, 'build': len(builds)}
+
+    async def run():
+        async with aiosqlite.connect(DATABASE_URL) as db:
+            return await conditional_json(make_request(headers), db, key or f'tasks:{scope}', scope, build)
+
+    return asyncio.run(run()), len(builds)
+
+
+def test_versioned_cache():
+    entries = VersionedCache(max_size=2)
+    entries.set('a', 1, b'a1')
+    entries.set('b', 1, b'b1')
+
+    assert entries.get('a', 1) == b'a1'
+    assert entries.get('a', 2) is None
+
+    entries.set('c', 1, b'c1')
+    assert entries.get('b', 1) is None
+    assert entries.get('a', 1) == b'a1'
+
+
+def test_etag_changes_with_data(db):
+    group = DBTasksGroup(name='group')
+    db.add(group)
+    db.commit()
+    other = DBTasksGroup(name='other')
+    db.add(other)
+    db.commit()
+    task = DBTask(name='cover', group_id=group.id)
+    db.add(task)
+    db.commit()
+
+    first, builds = fetch('global')
+    etag = first.headers['etag']
+    assert first.status_code == 200 and builds == 1
+    assert 'last-modified' in first.headers
+
+    not_modified, builds = fetch('global', {'If-None-Match': etag})
+    assert not_modified.status_code == 304 and builds == 0
+
+    cached, builds = fetch('global')
+    assert cached.body == first.body and builds == 0
+
+    other_etag = fetch(f'group:{other.id}')[0].headers['etag']
+    task.kpt_status = {'state': 'STARTED'}
+    db.commit()
+
+    changed, builds = fetch('global', {'If-None-Match': etag})
+    assert changed.status_code == 200 and builds == 1
+    assert changed.headers['etag'] != etag
+    assert fetch(f'group:{group.id}', {'If-None-Match': etag})[0].status_code == 200
+    assert fetch(f'group:{other.id}', {'If-None-Match': other_etag})[0].status_code == 304
+
+
+def test_if_modified_since(db):
+    group = DBTasksGroup(name='group')
+    db.add(group)
+    db.commit()
+
+    response, _ = fetch('global')
+    modified = response.headers['last-modified']
+
+    assert fetch('global', {'If-Modified-Since': modified})[0].status_code == 304
+    assert fetch('global', {'If-Modified-Since': formatdate(0, usegmt=True)})[0].status_code == 200
+    assert fetch('global', {'If-Modified-Since': 'not a date'})[0].status_code == 200
@@ -0,0 +1,191 @@
+import time
+
+import pytest
+
+import app.worker as worker
+from app.db import DBTask, DBTasksGroup
+from app.ng_toolbox import NGToolbox
+from app.uploader import TaskUploader
+from app.worker import CollectKadTask, TaskCancelled, check_cancelled, check_status, wait
+
+
+class FakeControl:
+    def __init__(self):
+        self.revoked = []
+
+    def revoke(self, task_id, **kwargs):
+        self.revoked.append(task_id)
+
+
+class FakeCelery:
+    def __init__(self):
+        self.control = FakeControl()
+
+
+def add_task(db, **params):
+    params.setdefault('name', 'cover')
+    task = DBTask(**params)
+    db.add(task)
+    db.commit()
+    return task
+
+
+def get_task(db, task_id):
+    db.expire_all()
+    return db.get(DBTask, task_id)
+
+
+def test_check_cancelled(db):
+    task = add_task(db, celery_task='current')
+
+    check_cancelled(task.id, 'current')
+    check_cancelled(task.id, None)
+
+    with pytest.raises(TaskCancelled) as error:
+        check_cancelled(task.id, 'previous')
+    assert error.value.reason == 'restarted'
+
+    TaskUploader.create_or_update(model=DBTask, instance=task.id, params={'cancel_requested': True})
+    with pytest.raises(TaskCancelled) as error:
+        check_cancelled(task.id, 'current')
+    assert error.value.reason == 'cancelled'
+
+    with pytest.raises(TaskCancelled) as error:
+        check_cancelled(100500, 'current')
+    assert error.value.reason == 'deleted'
+
+
+def test_wait_stops_on_cancel_and_marks_heartbeat(db, monkeypatch):
+    task = add_task(db, celery_task='current')
+    monkeypatch.setattr(worker, 'CANCEL_CHECK_INTERVAL', 0.01)
+    monkeypatch.setattr(worker, 'HEARTBEAT_INTERVAL', 0)
+
+    wait(0.05, task.id, 'current')
+    assert get_task(db, task.id).heartbeat > time.time() - 5
+
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        TaskUploader.create_or_update(model=DBTask, instance=task.id, params={'cancel_requested': True})
+
+    monkeypatch.setattr(worker.time, 'sleep', sleep)
+    with pytest.raises(TaskCancelled):
+        wait(60, task.id, 'current')
+    assert sleeps == [0.01]
+
+
+def test_check_status_does_not_overwrite_restarted_task(db, monkeypatch):
+    task = add_task(db, celery_task='first')
+    cancelled = []
+
+    def status(task_id):
+        # перезапуск между запросом статуса и его записью
+        TaskUploader.create_or_update(model=DBTask, instance=task.id, params={'celery_task': 'second'})
+        return {'state': 'STARTED', 'error': None}
+
+    monkeypatch.setattr(worker, 'wait', lambda *args: None)
+    monkeypatch.setattr(NGToolbox, 'status', status)
+    monkeypatch.setattr(NGToolbox, 'cancel', cancelled.append)
+
+    with pytest.raises(TaskCancelled) as error:
+        check_status('remote', 'kpt', task, 'first')
+
+    assert error.value.reason == 'restarted'
+    assert cancelled == ['remote']
+    assert get_task(db, task.id).kpt_status == {'state': 'PREPARING'}
+
+
+def test_request_cancel_queued_task(db):
+    task = add_task(db, celery_task='queued')
+    done = add_task(db, celery_task='done', kpt_status={'state': 'SUCCESS'}, kad_status={'state': 'SUCCESS'})
+    celery = FakeCelery()
+
+    assert TaskUploader.request_cancel([task.id, done.id], celery) == 1
+
+    assert celery.control.revoked == ['queued']
+    task = get_task(db, task.id)
+    assert task.cancel_requested
+    assert task.kpt_status == {'state': 'CANCELLED'}
+    assert task.kad_status == {'state': 'CANCELLED'}
+    assert task.state == 'CANCELLED'
+    assert get_task(db, done.id).state == 'SUCCESS'
+
+
+def test_request_cancel_running_task_waits_for_worker(db):
+    running = add_task(db, celery_task='running', kpt_status={'state': 'STARTED'}, heartbeat=time.time())
+    # сообщение снято из очереди до запуска, воркер задачу не выполняет
+    orphan = add_task(
+        db,
+        celery_task='orphan',
+        kpt_status={'state': 'SUCCESS'},
+        kad_status={'state': 'STARTED'},
+        heartbeat=time.time() - 3600,
+    )
+
+    assert TaskUploader.request_cancel([running.id, orphan.id], FakeCelery()) == 2
+
+    running = get_task(db, running.id)
+    assert running.cancel_requested
+    assert running.state == 'IN_PROGRESS'
+
+    orphan = get_task(db, orphan.id)
+    assert orphan.kpt_status == {'state': 'SUCCESS'}
+    assert orphan.kad_status == {'state': 'CANCELLED'}
+    assert orphan.state == 'CANCELLED'
+
+
+def test_request_cancel_parent_cancels_tiles(db):
+    parent = add_task(db)
+    tiles = [
+        add_task(db, name=f'cover_tile{number}', parent_id=parent.id, celery_task=f'tile{number}', **statuses)
+        for number, statuses in enumerate(
+            [{'kpt_status': {'state': 'SUCCESS'}, 'kad_status': {'state': 'SUCCESS'}}, {}], start=1
+        )
+    ]
+    celery = FakeCelery()
+
+    assert TaskUploader.request_cancel([parent.id], celery) == 1
+
+    assert celery.control.revoked == ['tile2']
+    assert get_task(db, tiles[1].id).state == 'CANCELLED'
+    parent = get_task(db, parent.id)
+    assert not parent.cancel_requested
+    assert parent.kad_status['state'] == 'CANCELLED'
+    assert parent.state == 'CANCELLED'
+
+
+def test_worker_marks_both_stages_cancelled(db, monkeypatch):
+    task = add_task(db, kpt_task_id='remote', kpt_status={'state': 'STARTED'}, heartbeat=time.time())
+    TaskUploader.request_cancel([task.id], FakeCelery())
+    assert get_task(db, task.id).state == 'IN_PROGRESS'
+
+    monkeypatch.setattr(NGToolbox, 'status', lambda task_id: pytest.fail('статус отмененной задачи не запрашивается'))
+    CollectKadTask().collect(task.id)
+
+    task = get_task(db, task.id)
+    assert task.kpt_status['state'] == 'CANCELLED'
+    assert task.kad_status == {'state': 'CANCELLED'}
+    assert task.state == 'CANCELLED'
+
+
+def test_cancel_endpoints(db, monkeypatch):
+    from fastapi.testclient import TestClient
+    import app.main as main
+
+    group = DBTasksGroup(name='group')
+    db.add(group)
+    db.commit()
+    tasks = [add_task(db, group_id=group.id, celery_task=f'task{number}') for number in range(3)]
+    celery = FakeCelery()
+    monkeypatch.setattr(main, 'celery', celery)
+    client = TestClient(main.app)
+
+    response = client.post(f'/tasks/{tasks[0].id}/cancel')
+    assert response.status_code == 200
+    assert response.json() == {'message': 'Запрошена отмена задач: 1'}
+    assert get_task(db, tasks[0].id).state == 'CANCELLED'
+
+    assert client.post(f'/groups/{group.id}/cancel').json() == {'message': 'Запрошена отмена задач: 2'}
+    assert celery.control.revoked == ['task0', 'task1', 'task2']
+    assert client.post('/tasks/100500/cancel').json() == {'message': 'Запрошена отмена задач: 0'}
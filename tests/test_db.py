@@ -0,0 +1,102 @@
+import json
+import sqlite3
+
+from sqlalchemy import inspect, text
+
+from app.db import Base, DBTask, engine, migrate
+
+DATABASE_PATH = 'data/database/database.db'
+
+# схема ngw_tasks до появления колонок состояния
+OLD_SCHEMA = [
+    "CREATE TABLE ngw_task_groups (id INTEGER PRIMARY KEY, added DATETIME, name VARCHAR)",
+    """
+    CREATE TABLE ngw_tasks (
+        id INTEGER PRIMARY KEY,
+        celery_task VARCHAR UNIQUE,
+        added DATETIME,
+        name VARCHAR,
+        kpt_task_id VARCHAR UNIQUE,
+        kad_task_id VARCHAR UNIQUE,
+        ngw_resource_id INTEGER UNIQUE,
+        cover_file VARCHAR,
+        kpt_file VARCHAR,
+        kad_file VARCHAR,
+        kpt_status JSON,
+        kad_status JSON,
+        group_id INTEGER REFERENCES ngw_task_groups (id)
+    )
+    """,
+]
+
+
+def raw_execute(query, params=()):
+    # запись в обход ORM, как это делает API через aiosqlite
+    with sqlite3.connect(DATABASE_PATH) as connection:
+        connection.execute(query, params)
+
+
+def test_migrate_backfills_old_schema():
+    Base.metadata.drop_all(bind=engine)
+    with engine.begin() as connection:
+        for query in OLD_SCHEMA:
+            connection.execute(text(query))
+
+    rows = [
+        ('new', None, None),
+        ('running', {'state': 'SUCCESS'}, {'state': 'STARTED'}),
+        ('done', {'state': 'SUCCESS'}, {'state': 'SUCCESS'}),
+        ('failed', {'state': 'SUCCESS'}, {'state': 'FAILED', 'error': 'no data'}),
+        ('cancelled', {'state': 'CANCELLED'}, {'state': 'PREPARING'}),
+    ]
+    for name, kpt_status, kad_status in rows:
+        raw_execute(
+            "INSERT INTO ngw_tasks (name, added, kpt_status, kad_status) VALUES (?, '2026-01-01 10:00:00', ?, ?)",
+            (name, json.dumps(kpt_status), json.dumps(kad_status)),
+        )
+
+    Base.metadata.create_all(bind=engine)
+    migrate()
+
+    assert 'ix_ngw_tasks_group_state' in {index['name'] for index in inspect(engine).get_indexes('ngw_tasks')}
+    with engine.connect() as connection:
+        result = connection.execute(text("SELECT name, stage, state, error, finished FROM ngw_tasks ORDER BY id"))
+        assert [tuple(row) for row in result] == [
+            ('new', 'kpt', 'PREPARING', None, None),
+            ('running', 'kad', 'IN_PROGRESS', None, None),
+            ('done', 'kad', 'SUCCESS', None, '2026-01-01 10:00:00'),
+            ('failed', 'kad', 'FAILED', 'no data', '2026-01-01 10:00:00'),
+            ('cancelled', 'kpt', 'CANCELLED', None, '2026-01-01 10:00:00'),
+        ]
+
+    # повторная миграция ничего не меняет
+    migrate()
+
+
+def test_raw_status_update_syncs_state(db):
+    task = DBTask(name='cover')
+    db.add(task)
+    db.commit()
+    assert task.state == 'PREPARING'
+
+    raw_execute(
+        "UPDATE ngw_tasks SET kpt_status = ? WHERE id = ?",
+        (json.dumps({'state': 'FAILED', 'error': 'timeout'}), task.id),
+    )
+
+    db.expire_all()
+    task = db.get(DBTask, task.id)
+    assert (task.kpt_state, task.stage, task.state, task.error) == ('FAILED', 'kpt', 'FAILED', 'timeout')
+    assert task.finished is not None
+
+
+def test_orm_write_keeps_its_timestamps(db):
+    task = DBTask(name='cover', kpt_status={'state': 'SUCCESS'}, kad_status={'state': 'SUCCESS', 'error': ''})
+    db.add(task)
+    db.commit()
+    updated = task.updated
+
+    db.expire_all()
+    task = db.get(DBTask, task.id)
+    assert (task.state, task.error) == ('SUCCESS', None)
+    assert task.updated == updated.replace(tzinfo=None)
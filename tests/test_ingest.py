@@ -0,0 +1,234 @@
+import os
+import json
+import queue
+import asyncio
+
+import pytest
+
+import app.ingest as ingest
+from app.db import DBTask, DBBlobLease
+from app.worker import CollectKadTask
+
+
+def layer_json(count: int) -> str:
+    features = [
+        {
+            'type': 'Feature',
+            'properties': {'name': f'cover{number}'},
+            'geometry': {
+                'type': 'Polygon',
+                'coordinates': [[[number, 0], [number + 0.01, 0], [number + 0.01, 0.01], [number, 0.01], [number, 0]]],
+            },
+        }
+        for number in range(count)
+    ]
+    return json.dumps({'type': 'FeatureCollection', 'features': features})
+
+
+def write_layer(path: str, count: int) -> str:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(layer_json(count))
+    return path
+
+
+@pytest.fixture(autouse=True)
+def executor():
+    yield
+    ingest.shutdown_executor()
+
+
+def test_parse_source_sends_batches(db, monkeypatch):
+    monkeypatch.setattr(ingest, 'INGEST_BATCH_SIZE', 2)
+    source = write_layer('data/tmp/batches/layer.geojson', 5)
+    batches = queue.Queue()
+
+    total, stats = ingest.parse_source(source, 'data/uploaded/batches/', 'layer.geojson', batches, 3)
+
+    sent = ingest.drain_queue(batches)
+    assert (total, stats['covers']) == (5, 5)
+    assert [number for number, _ in sent] == [3, 3, 3]
+    assert [len(covers) for _, covers in sent] == [2, 2, 1]
+    assert [name for _, covers in sent for name, key, tiles in covers][0] == 'cover0'
+
+
+def test_run_tasks_ingest_flow(db, monkeypatch):
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    # размер порции читается процессами пула при запуске
+    monkeypatch.setenv('INGEST_BATCH_SIZE', '2')
+    sent = []
+
+    def apply_async(self, args=None, kwargs=None, task_id=None, **options):
+        sent.append((args[0], task_id))
+
+    monkeypatch.setattr(CollectKadTask, 'apply_async', apply_async)
+    client = TestClient(app)
+
+    response = client.post(
+        '/run_tasks',
+        files=[
+            ('files', ('layer.geojson', layer_json(3), 'application/geo+json')),
+            ('files', ('notes.txt', b'text', 'text/plain')),
+        ],
+        data={'name': 'group'},
+    )
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body['errors'] == ['notes.txt: Неизвестное расширение файла: .txt']
+
+    job = client.get(f"/ingest/{body['job_id']}").json()
+    assert job['state'] == 'SUCCESS'
+    assert (job['parts_total'], job['parts_done'], job['tasks_created']) == (1, 1, 3)
+    assert job['group_id'] == body['group_id']
+    assert job['stats']['covers'] == 3
+
+    tasks = db.query(DBTask).filter(DBTask.group_id == body['group_id']).order_by(DBTask.id).all()
+    assert [task.name for task in tasks] == ['cover0', 'cover1', 'cover2']
+    assert sent == [(task.id, task.celery_task) for task in tasks]
+    assert all(os.path.exists(task.cover_file) for task in tasks)
+    # охваты перенесены в хранилище блобов, защита от удаления снята после создания задач
+    assert not os.path.exists(ingest.parse_dir(body['job_id']))
+    assert db.query(DBBlobLease).count() == 0
+
+    assert client.get('/ingest/100500').status_code == 404
+
+
+def test_run_tasks_profiles_parsing(db, monkeypatch):
+    from fastapi.testclient import TestClient
+    from app.main import app
+    from app.profiler import list_profiles
+
+    monkeypatch.setattr(CollectKadTask, 'apply_async', lambda self, *args, **kwargs: None)
+    client = TestClient(app)
+
+    response = client.post(
+        '/run_tasks', params={'profile': 1}, files=[('files', ('layer.geojson', layer_json(1), 'application/geo+json'))]
+    )
+
+    names = [item['name'] for item in list_profiles()]
+    assert response.headers['x-profile-id'] in names
+    # разбор выполняется в пуле процессов после ответа и профилируется там
+    assert any('_ingest_parse_layer' in name for name in names)
+
+
+def test_parse_error_discards_unsent_covers(db, monkeypatch):
+    monkeypatch.setattr(ingest, 'INGEST_BATCH_SIZE', 10)
+    source = write_layer('data/tmp/broken/layer.geojson', 2)
+    saved = []
+
+    def make_parts(dest, filepath, filename, stats=None, limit=None):
+        for cover in original(dest, filepath, filename, stats, limit):
+            saved.append(cover[1])
+            yield cover
+        raise ValueError('broken layer')
+
+    original = ingest.TaskUploader.make_parts
+    monkeypatch.setattr(ingest.TaskUploader, 'make_parts', make_parts)
+
+    with pytest.raises(ValueError):
+        ingest.parse_source(source, 'data/uploaded/broken/', 'layer.geojson', queue.Queue(), 0)
+
+    assert len(saved) == 2
+    assert not any(os.path.exists(key) for key in saved)
+    assert db.query(DBBlobLease).count() == 0
+
+
+def test_enqueue_error_discards_cover(db, monkeypatch):
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    keys = []
+
+    def enqueue_cover(db_group, name, path, tiles, added, profile=False):
+        keys.append(path)
+        raise Exception('database is locked')
+
+    monkeypatch.setattr(ingest, 'enqueue_cover', enqueue_cover)
+    client = TestClient(app)
+
+    body = client.post('/run_tasks', files=[('files', ('layer.geojson', layer_json(1), 'application/geo+json'))]).json()
+
+    assert client.get(f"/ingest/{body['job_id']}").json()['state'] == 'FAILED'
+    # задача для охвата не создана, поэтому сохраненный охват удаляется
+    [key] = keys
+    assert not os.path.exists(key)
+    assert db.query(DBBlobLease).count() == 0
+
+
+def test_parse_source_limit(db):
+    source = write_layer('data/tmp/limit/layer.geojson', 5)
+    batches = queue.Queue()
+
+    total, stats = ingest.parse_source(source, 'data/uploaded/limit/', 'layer.geojson', batches, 0, limit=2)
+
+    [(_, covers)] = ingest.drain_queue(batches)
+    assert [name for name, key, tiles in covers] == ['cover0', 'cover1']
+    assert (total, stats['covers']) == (2, 2)
+
+
+def plan(sources: list, errors: list) -> list:
+    async def run():
+        return await ingest.plan_sources(asyncio.get_running_loop(), sources, errors)
+
+    return asyncio.run(run())
+
+
+def test_plan_sources_splits_group_limit(db, monkeypatch):
+    monkeypatch.setattr(ingest, 'ADMISSION_GROUP_MAX_TASKS', 5)
+    sources = [
+        (write_layer('data/tmp/plan/a.geojson', 3), 'a.geojson'),
+        (write_layer('data/tmp/plan/b.geojson', 3), 'b.geojson'),
+        (write_layer('data/tmp/plan/c.geojson', 1), 'c.geojson'),
+        ('data/tmp/plan/missing.geojson', 'missing.geojson'),
+    ]
+    errors = []
+
+    planned = plan(sources, errors)
+
+    assert [(os.path.basename(source), limit) for source, filename, limit in planned] == [
+        ('a.geojson', 3),
+        ('b.geojson', 2),
+    ]
+    assert any(error.startswith('b.geojson') and 'пропущено объектов: 1' in error for error in errors)
+    assert any(error.startswith('c.geojson') and 'пропущено объектов: 1' in error for error in errors)
+    assert any(error.startswith('missing.geojson') for error in errors)
+
+    # 0 - без лимита, слои не пересчитываются
+    monkeypatch.setattr(ingest, 'ADMISSION_GROUP_MAX_TASKS', 0)
+    errors = []
+    assert plan(sources, errors) == [(source, filename, None) for source, filename in sources]
+    assert errors == []
+
+
+def test_covers_over_group_limit_are_discarded(db, monkeypatch):
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    async def plan_sources(loop, sources, errors):
+        # количество объектов слоя насчитано неверно, лимит проверяется при постановке задач
+        return [(source, filename, None) for source, filename in sources]
+
+    discarded = []
+
+    def discard_blobs(*keys):
+        discarded.extend(keys)
+        original(*keys)
+
+    original = ingest.discard_blobs
+    monkeypatch.setattr(ingest, 'ADMISSION_GROUP_MAX_TASKS', 1)
+    monkeypatch.setattr(ingest, 'plan_sources', plan_sources)
+    monkeypatch.setattr(ingest, 'discard_blobs', discard_blobs)
+    monkeypatch.setattr(CollectKadTask, 'apply_async', lambda self, *args, **kwargs: None)
+    client = TestClient(app)
+
+    body = client.post('/run_tasks', files=[('files', ('layer.geojson', layer_json(3), 'application/geo+json'))]).json()
+
+    job = client.get(f"/ingest/{body['job_id']}").json()
+    assert job['tasks_created'] == 1
+    assert sum('Превышен лимит охватов' in error for error in job['errors']) == 2
+    assert len(discarded) == 2
+    assert not any(os.path.exists(key) for key in discarded)
+    assert db.query(DBBlobLease).count() == 0
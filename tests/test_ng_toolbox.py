@@ -0,0 +1,102 @@
+import io
+
+import pytest
+import requests
+
+import app.ng_toolbox as ng_toolbox
+from app.ng_toolbox import NGToolbox, CircuitOpenError, PermanentToolboxError, TransientToolboxError
+
+
+class FakeBreaker:
+    def __init__(self, retry_after=0.0):
+        self.wait = retry_after
+        self.events = []
+
+    def retry_after(self):
+        return self.wait
+
+    def record_success(self):
+        self.events.append('success')
+
+    def record_failure(self):
+        self.events.append('failure')
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    circuit = FakeBreaker()
+    monkeypatch.setattr(ng_toolbox, 'toolbox_breaker', circuit)
+    return circuit
+
+
+def respond(monkeypatch, *outcomes):
+    """
+    Ответы сервера по порядку: код ответа или исключение requests.
+    """
+    calls = []
+    outcomes = list(outcomes)
+
+    def request(method, url, **kwargs):
+        calls.append(url)
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+
+        response = requests.Response()
+        response.status_code = outcome
+        response.url = url
+        return response
+
+    monkeypatch.setattr(ng_toolbox.requests, 'request', request)
+    return calls
+
+
+@pytest.mark.parametrize('status_code', [429, 500, 503])
+def test_server_errors_are_transient(monkeypatch, breaker, status_code):
+    respond(monkeypatch, status_code)
+
+    with pytest.raises(TransientToolboxError):
+        NGToolbox.make_request('http://toolbox/status/')
+    assert breaker.events == ['failure']
+
+
+@pytest.mark.parametrize('status_code', [400, 403, 404])
+def test_client_errors_are_permanent(monkeypatch, breaker, status_code):
+    respond(monkeypatch, status_code)
+
+    with pytest.raises(PermanentToolboxError):
+        NGToolbox.make_request('http://toolbox/status/')
+    # сервер отвечает, поэтому ошибка не размыкает предохранитель
+    assert breaker.events == ['success']
+
+
+def test_timeouts_are_retried_then_transient(monkeypatch, breaker):
+    calls = respond(monkeypatch, requests.Timeout('slow'), requests.ConnectionError('reset'), 200)
+
+    assert NGToolbox.make_request('http://toolbox/status/', max_attempts=3).status_code == 200
+    assert len(calls) == 3
+    assert breaker.events == ['failure', 'failure', 'success']
+
+    respond(monkeypatch, requests.Timeout('slow'), requests.Timeout('slow'))
+    with pytest.raises(TransientToolboxError):
+        NGToolbox.make_request('http://toolbox/status/', max_attempts=2)
+
+
+def test_file_upload_is_not_resent(monkeypatch, breaker):
+    calls = respond(monkeypatch, requests.Timeout('slow'), 200)
+
+    with pytest.raises(TransientToolboxError):
+        NGToolbox.make_request('http://toolbox/upload/', req_type='post', data=io.BytesIO(b'cover'))
+    assert len(calls) == 1
+
+
+def test_open_breaker_skips_request(monkeypatch, breaker):
+    calls = respond(monkeypatch, 200)
+    breaker.wait = 42.0
+
+    with pytest.raises(CircuitOpenError) as error:
+        NGToolbox.make_request('http://toolbox/status/')
+
+    assert error.value.retry_after == 42.0
+    assert isinstance(error.value, TransientToolboxError)
+    assert calls == []
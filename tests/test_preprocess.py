@@ -0,0 +1,65 @@
+import os
+import json
+
+import pytest
+from shapely.geometry import Polygon
+
+import app.preprocess as preprocess
+from app.blobs import open_blob
+from app.uploader import TaskUploader
+
+
+def test_preprocess_repairs_invalid_cover():
+    bowtie = Polygon([(0, 0), (1, 1), (1, 0), (0, 1), (0, 0)])
+    stats = {}
+
+    geometry = preprocess.preprocess_cover(bowtie, 'bowtie', stats)
+
+    assert geometry.is_valid
+    assert geometry.area == pytest.approx(0.5)
+    assert stats['covers'] == 1
+    assert stats['repaired'] == 1
+
+
+def test_preprocess_rejects_degenerate_cover():
+    line = Polygon([(0, 0), (1, 1), (2, 2), (0, 0)])
+
+    with pytest.raises(ValueError):
+        preprocess.preprocess_cover(line, 'line')
+
+
+def test_preprocess_without_repair(monkeypatch):
+    monkeypatch.setattr(preprocess, 'COVER_REPAIR', False)
+    bowtie = Polygon([(0, 0), (1, 1), (1, 0), (0, 1), (0, 0)])
+
+    with pytest.raises(ValueError):
+        preprocess.preprocess_cover(bowtie, 'bowtie')
+
+
+def test_preprocess_rounds_coordinates():
+    polygon = Polygon([(0.123456789, 0), (1, 0), (1, 1.987654321), (0, 1)])
+    stats = {}
+
+    geometry = preprocess.preprocess_cover(polygon, 'cover', stats)
+
+    digits = preprocess.COVER_PRECISION
+    assert all(round(x, digits) == pytest.approx(x, abs=1e-12) for x, y in geometry.exterior.coords)
+    assert stats['geometry_bytes_after'] < stats['geometry_bytes_before']
+
+
+def test_file_bytes_is_written_size(db):
+    source, dest = 'data/tmp/preprocess/layer.geojson', 'data/uploaded/preprocess/'
+    os.makedirs(os.path.dirname(source), exist_ok=True)
+    os.makedirs(dest, exist_ok=True)
+
+    polygon = {'type': 'Polygon', 'coordinates': [[[0.123456789, 0], [1, 0], [1, 1], [0, 1], [0.123456789, 0]]]}
+    feature = {'type': 'Feature', 'properties': {}, 'geometry': polygon}
+    with open(source, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': [feature]}, f)
+
+    stats = {}
+    covers = list(TaskUploader.make_parts(dest, source, 'layer.geojson', stats=stats))
+
+    with open_blob(covers[0][1]) as f:
+        assert stats['file_bytes'] == len(f.read())
+    assert preprocess.merge_stats(stats, stats)['file_bytes'] == 2 * stats['file_bytes']
@@ -0,0 +1,103 @@
+import asyncio
+import os
+import threading
+import time
+
+from app import profiler
+from app.profiler import SamplingProfiler, ProfilingMiddleware, is_profiling_requested
+
+
+def busy(seconds):
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        sum(range(1000))
+
+
+def other_thread_work(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_is_profiling_requested():
+    assert is_profiling_requested(None, 'yes')
+    assert is_profiling_requested(b'1')
+    assert is_profiling_requested(True)
+    assert not is_profiling_requested(None, '0', b'', False)
+
+
+def test_samples_only_started_thread():
+    stop = threading.Event()
+    other = threading.Thread(target=other_thread_work, args=(stop,), name='other')
+    other.start()
+    try:
+        sampler = SamplingProfiler('test', 'own thread', interval=0.001)
+        sampler.start()
+        busy(0.2)
+        sampler.stop()
+    finally:
+        stop.set()
+        other.join()
+
+    stacks = list(sampler.samples)
+    assert any('busy (test_profiler.py' in stack for stack in stacks)
+    assert not any('other_thread_work' in stack for stack in stacks)
+    assert all(stack.startswith(threading.current_thread().name + ';') for stack in stacks)
+
+
+def test_save_keeps_retention(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiler, 'PROFILES_DIR', str(tmp_path))
+    names = []
+    for i in range(3):
+        sampler = SamplingProfiler('test', f'retention {i}')
+        sampler.samples['MainThread;f (x.py:1)'] = 2
+        names.append(sampler.save())
+        os.utime(os.path.join(profiler.PROFILES_DIR, names[-1]), (i, i))
+
+    profiler.clean_profiles(retention=2)
+
+    saved = {item['name'] for item in profiler.list_profiles()}
+    assert names[0] not in saved
+    assert {names[1], names[2]} <= saved
+    with open(profiler.get_profile_path(names[2]), encoding='utf-8') as f:
+        assert f.read().splitlines()[1] == 'MainThread;f (x.py:1) 2'
+    assert profiler.get_profile_path('../' + names[2]) is None
+
+
+def call_middleware(headers=(), query_string=b''):
+    async def app(scope, receive, send):
+        busy(0.05)
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b'ok'})
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        'type': 'http',
+        'method': 'GET',
+        'path': '/tasks',
+        'headers': list(headers),
+        'query_string': query_string,
+    }
+    asyncio.run(ProfilingMiddleware(app)(scope, receive, send))
+    return dict(sent[0]['headers'])
+
+
+def test_middleware_profiles_requested_request():
+    headers = call_middleware(headers=[(b'x-profile', b'1')])
+
+    name = headers[b'x-profile-id'].decode()
+    assert profiler.get_profile_path(name)
+    assert b'x-profile-id' in call_middleware(query_string=b'profile=1')
+
+
+def test_middleware_skips_requests_without_flag():
+    before = len(profiler.list_profiles())
+
+    assert b'x-profile-id' not in call_middleware(query_string=b'profile=0')
+    assert len(profiler.list_profiles()) == before
@@ -0,0 +1,161 @@
+import time
+
+import pytest
+
+import app.worker as worker
+from app.db import DBTask
+from app.ng_toolbox import NGToolbox, CircuitOpenError, TransientToolboxError
+from app.uploader import TaskUploader
+from app.worker import CollectKadTask, wake_retries
+
+
+class FakeBreaker:
+    def __init__(self, cooldown=0.0):
+        self.cooldown = cooldown
+
+    def remaining_cooldown(self):
+        return self.cooldown
+
+
+@pytest.fixture
+def retries(monkeypatch):
+    """
+    Повторы, запрошенные задачей у Celery.
+    """
+    calls = []
+
+    def retry(self, kwargs=None, countdown=None, **options):
+        calls.append((kwargs, countdown))
+
+    monkeypatch.setattr(CollectKadTask, 'retry', retry)
+    monkeypatch.setattr(worker, 'toolbox_breaker', FakeBreaker())
+    monkeypatch.setattr(worker, 'RETRY_BASE_DELAY', 60)
+    monkeypatch.setattr(worker, 'TRANSIENT_MAX_RETRIES', 2)
+    return calls
+
+
+def add_task(db, **params):
+    task = DBTask(name='cover', cover_file='cover.geojson', **params)
+    db.add(task)
+    db.commit()
+    return task
+
+
+def get_task(db, task_id):
+    db.expire_all()
+    return db.get(DBTask, task_id)
+
+
+def fail_upload(monkeypatch, error):
+    def upload(upload_file):
+        raise error
+
+    monkeypatch.setattr(NGToolbox, 'upload', upload)
+
+
+def test_transient_error_retries_with_backoff(db, monkeypatch, retries):
+    task = add_task(db)
+    fail_upload(monkeypatch, TransientToolboxError('503'))
+
+    CollectKadTask().run(task.id, attempt=1)
+
+    [(kwargs, countdown)] = retries
+    assert kwargs['attempt'] == 2
+    assert 120 * 0.75 <= countdown <= 120 * 1.25
+
+    status = get_task(db, task.id).kpt_status
+    assert status['state'] == 'RETRYING'
+    assert (status['retry'], status['retry_id'], status['breaker']) == (2, kwargs['retry_id'], False)
+    assert status['retry_at'] == pytest.approx(time.time() + countdown, abs=5)
+    # воркер не держит задачу, пока она ожидает повтора
+    assert get_task(db, task.id).heartbeat is None
+
+
+def test_retry_waits_for_open_breaker(db, monkeypatch, retries):
+    task = add_task(db)
+    monkeypatch.setattr(worker, 'toolbox_breaker', FakeBreaker(cooldown=75.0))
+    fail_upload(monkeypatch, TransientToolboxError('timeout'))
+
+    CollectKadTask().run(task.id)
+
+    [(kwargs, countdown)] = retries
+    assert (kwargs['attempt'], countdown) == (1, 75.0)
+    assert get_task(db, task.id).kpt_status['breaker'] is True
+
+
+def test_circuit_open_does_not_use_attempts(db, monkeypatch, retries):
+    task = add_task(db)
+    fail_upload(monkeypatch, CircuitOpenError(30.0))
+
+    CollectKadTask().run(task.id, attempt=1)
+
+    [(kwargs, countdown)] = retries
+    assert (kwargs['attempt'], countdown) == (1, 30.0)
+
+
+def test_retries_exhausted_fail_stage(db, monkeypatch, retries):
+    task = add_task(db)
+    fail_upload(monkeypatch, TransientToolboxError('503'))
+
+    CollectKadTask().run(task.id, attempt=2)
+
+    assert retries == []
+    task = get_task(db, task.id)
+    assert task.state == 'FAILED'
+    assert task.kpt_status['error'] == '503 (повторов: 2)'
+
+
+def test_duplicate_retry_runs_once(db, monkeypatch, retries):
+    task = add_task(db)
+    fail_upload(monkeypatch, TransientToolboxError('503'))
+    CollectKadTask().run(task.id)
+    [(kwargs, _)] = retries
+
+    CollectKadTask().run(task.id, **kwargs)
+    assert len(retries) == 2
+
+    # второе сообщение того же повтора пропускается
+    CollectKadTask().run(task.id, **kwargs)
+    assert len(retries) == 2
+
+
+def test_wake_retries_sends_breaker_waiters(db, monkeypatch, retries):
+    waiting = add_task(db, celery_task='waiting')
+    backoff = add_task(db, celery_task='backoff')
+    monkeypatch.setattr(worker, 'toolbox_breaker', FakeBreaker(cooldown=120.0))
+    fail_upload(monkeypatch, TransientToolboxError('timeout'))
+    CollectKadTask().run(waiting.id)
+    monkeypatch.setattr(worker, 'toolbox_breaker', FakeBreaker())
+    CollectKadTask().run(backoff.id)
+
+    sent = []
+
+    def apply_async(self, args=None, kwargs=None, task_id=None, **options):
+        sent.append((args, kwargs, task_id))
+
+    monkeypatch.setattr(CollectKadTask, 'apply_async', apply_async)
+    wake_retries()
+
+    [(kwargs, _), _] = retries
+    assert sent == [((waiting.id,), {'attempt': 1, 'retry_id': kwargs['retry_id']}, 'waiting')]
+    assert TaskUploader.claim_retry(waiting.id, kwargs['retry_id'])
+
+
+def test_cancel_waiting_retry(db, monkeypatch, retries):
+    task = add_task(db, celery_task='retrying')
+    fail_upload(monkeypatch, TransientToolboxError('503'))
+    CollectKadTask().run(task.id)
+    [(kwargs, _)] = retries
+
+    class Control:
+        def revoke(self, task_id, **options):
+            pass
+
+    class Celery:
+        control = Control()
+
+    assert TaskUploader.request_cancel([task.id], Celery()) == 1
+    assert get_task(db, task.id).state == 'CANCELLED'
+
+    CollectKadTask().run(task.id, **kwargs)
+    assert len(retries) == 1
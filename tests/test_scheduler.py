@@ -0,0 +1,129 @@
+import time
+
+import pytest
+
+import app.scheduler as scheduler
+from app.db import DBJobStat
+from app.scheduler import PollScheduler, extract_finished, extract_progress, job_size
+
+
+@pytest.fixture(autouse=True)
+def no_jitter(monkeypatch):
+    monkeypatch.setattr(scheduler.random, 'uniform', lambda low, high: 0)
+
+
+def make_scheduler(elapsed: float, expected: float | None = None) -> PollScheduler:
+    poller = PollScheduler('kpt', started=time.time() - elapsed)
+    poller.expected = expected
+    return poller
+
+
+def test_extract_progress():
+    assert extract_progress({'progress': 40}) == 40
+    assert extract_progress({'progress': {'percent': '25.5'}}) == 25.5
+    assert extract_progress({'progress': 100}) is None
+    assert extract_progress({}) is None
+
+
+def test_extract_finished():
+    assert extract_finished({'finished': '2024-01-01T00:00:00Z'}) == 1704067200
+    assert extract_finished({'finished_at': 1704067200}) == 1704067200
+    assert extract_finished({'finished': 'вчера'}) is None
+    assert extract_finished({}) is None
+
+
+def test_delay_without_history_grows_linearly(db):
+    poller = make_scheduler(elapsed=1000)
+
+    assert [poller.next_delay({}) for _ in range(3)] == [2, 4, 6]
+
+
+def test_delay_by_progress(db):
+    poller = make_scheduler(elapsed=100)
+
+    # осталось 100 секунд, запрос через половину оставшегося времени
+    assert poller.next_delay({'progress': 50}) == pytest.approx(20, abs=0.1)
+    assert make_scheduler(elapsed=1000).next_delay({'progress': 50}) == pytest.approx(200, abs=1)
+
+
+def test_delay_capped_by_elapsed_time(db):
+    # по истории задача идет 600 секунд, но с отправки прошло 10: задержка не больше доли прошедшего времени
+    poller = make_scheduler(elapsed=10, expected=600)
+
+    assert poller.next_delay({}) == pytest.approx(10 * scheduler.POLL_MAX_LAG, abs=0.1)
+
+
+def test_delay_overdue_backoff(db):
+    poller = make_scheduler(elapsed=1000, expected=100)
+
+    assert [poller.next_delay({}) for _ in range(3)] == [4, 8, 16]
+
+
+def test_delay_limits(db):
+    assert make_scheduler(elapsed=0, expected=0).next_delay({}) == scheduler.POLL_MIN_DELAY
+    assert make_scheduler(elapsed=10**6, expected=10**7).next_delay({}) == scheduler.POLL_MAX_DELAY
+
+
+def test_record_finish_not_before_last_poll(db):
+    poller = make_scheduler(elapsed=500)
+    poller.next_delay({})
+
+    poller.record({'finished': poller.started + 120})
+
+    # сервер сообщил время раньше последнего запроса, при котором задача еще выполнялась
+    stat = db.query(DBJobStat).one()
+    assert stat.duration == pytest.approx(500, abs=1)
+    assert stat.detection_delay == pytest.approx(0, abs=1)
+
+
+def test_record_reported_finish_time(db, monkeypatch):
+    poller = make_scheduler(elapsed=100)
+    poller.next_delay({})
+    now = time.time()
+    monkeypatch.setattr(scheduler.time, 'time', lambda: now + 60)
+
+    poller.record({'finished': now + 20})
+
+    stat = db.query(DBJobStat).one()
+    assert stat.duration == pytest.approx(120, abs=1)
+    assert stat.detection_delay == pytest.approx(40, abs=1)
+
+
+def test_record_excludes_detection_lag(db, monkeypatch):
+    poller = make_scheduler(elapsed=100)
+    poller.next_delay({})
+    now = time.time()
+    monkeypatch.setattr(scheduler.time, 'time', lambda: now + 60)
+
+    poller.record({})
+
+    # задача завершилась где-то между последним запросом и текущим, записывается середина интервала
+    stat = db.query(DBJobStat).one()
+    assert stat.duration == pytest.approx(130, abs=1)
+    assert stat.detection_delay == pytest.approx(30, abs=1)
+
+
+def test_estimate_uses_similar_jobs(db):
+    hour = scheduler.moscow_now().hour
+    for size, duration in [(10, 100), (12, 120), (11, 110), (1000, 5000)]:
+        db.add(DBJobStat(operation='egrn_kvartals_cover', size=size, hour=hour, duration=duration))
+    db.commit()
+
+    assert PollScheduler('kpt', size=10).expected == 110
+    assert PollScheduler('kad').expected is None
+
+
+def test_job_size_from_file_size(tmp_path):
+    cover = tmp_path / 'cover.geojson'
+    cover.write_bytes(b'x' * 2048)
+    kpt = tmp_path / 'kpt.csv'
+    kpt.write_bytes(b'x' * 512)
+
+    class Task:
+        cover_file = str(cover)
+        kpt_file = str(kpt)
+
+    assert job_size('kpt', Task) == 2
+    assert job_size('kad', Task) == 0.5
+    Task.kpt_file = str(tmp_path / 'missing.csv')
+    assert job_size('kad', Task) is None
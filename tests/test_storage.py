@@ -0,0 +1,215 @@
+import io
+import os
+import sys
+import stat
+import time
+import zipfile
+import subprocess
+
+import pytest
+
+from app import storage
+from app.storage import LocalStorage, get_secret, sign, verify
+
+
+@pytest.fixture
+def shared_secret(tmp_path, monkeypatch):
+    path = tmp_path / 'data' / 'storage_secret'
+    monkeypatch.setattr(storage, 'STORAGE_SECRET', None)
+    monkeypatch.setattr(storage, 'STORAGE_SECRET_FILE', str(path))
+    monkeypatch.setattr(storage, '_secret', None)
+    return path
+
+
+def test_sign_verify():
+    expires = int(time.time()) + 60
+    signature = sign('data/result.zip', expires)
+
+    assert verify('data/result.zip', expires, signature)
+    assert not verify('data/other.zip', expires, signature)
+    assert not verify('data/result.zip', expires + 1, signature)
+    assert not verify('data/result.zip', int(time.time()) - 1, sign('data/result.zip', int(time.time()) - 1))
+
+
+def test_sign_covers_params():
+    expires = int(time.time()) + 60
+    signature = sign('data/result.zip', expires, filename='result.zip')
+
+    assert verify('data/result.zip', expires, signature, filename='result.zip')
+    assert not verify('data/result.zip', expires, signature, filename='other.exe')
+    assert not verify('data/result.zip', expires, signature)
+
+
+def test_secret_created_once(shared_secret, monkeypatch):
+    secret = get_secret()
+
+    assert shared_secret.read_text().encode() == secret
+    assert stat.S_IMODE(os.stat(shared_secret).st_mode) == 0o600
+    assert os.listdir(shared_secret.parent) == ['storage_secret']
+
+    monkeypatch.setattr(storage, '_secret', None)
+    assert get_secret() == secret
+
+
+def test_secret_shared_between_processes(shared_secret):
+    expires = int(time.time()) + 60
+    env = {key: value for key, value in os.environ.items() if key != 'STORAGE_SECRET'}
+    env['STORAGE_SECRET_FILE'] = str(shared_secret)
+    code = f"from app.storage import sign; print(sign('data/result.zip', {expires}))"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    signatures = [
+        subprocess.run([sys.executable, '-c', code], cwd=root, env=env, capture_output=True, text=True, check=True)
+        .stdout.strip().splitlines()[-1]
+        for _ in range(2)
+    ]
+
+    assert signatures[0] == signatures[1]
+    assert verify('data/result.zip', expires, signatures[0])
+
+
+def test_local_storage_round_trip():
+    local = LocalStorage()
+    key = 'data/storage_test/nested/result.csv'
+
+    with local.open(key, 'wb') as f:
+        f.write(b'id\n1\n')
+
+    assert local.exists(key)
+    assert local.size(key) == 5
+    with local.open(key) as f:
+        assert f.read() == b'id\n1\n'
+
+    os.makedirs('data/tmp', exist_ok=True)
+    with open('data/tmp/moved.csv', 'wb') as f:
+        f.write(b'x')
+    assert local.put_file('data/tmp/moved.csv', 'data/storage_test/moved.csv') == 'data/storage_test/moved.csv'
+    assert not os.path.exists('data/tmp/moved.csv')
+    assert local.put_file('data/storage_test/moved.csv') == 'data/storage_test/moved.csv'
+
+    local.delete(key)
+    local.delete(key)
+    assert not local.exists(key)
+
+
+def test_local_url_and_files_endpoint():
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    key = 'data/storage_test/link.csv'
+    with LocalStorage().open(key, 'wb') as f:
+        f.write(b'link')
+    client = TestClient(app)
+
+    url = LocalStorage().url(key, filename='report.csv')
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.content == b'link'
+    assert 'report.csv' in response.headers['content-disposition']
+
+    assert client.get(url.replace('report.csv', 'other.exe')).status_code == 403
+    assert client.get(url.replace('link.csv', 'secret.csv')).status_code == 403
+    # кодировка ответа тоже подписывается
+    assert client.get(url + '&encoding=gzip').status_code == 403
+
+
+def test_files_endpoint_sends_gzip_encoding():
+    import gzip
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    key = 'data/storage_test/link.csv.gz'
+    with LocalStorage().open(key, 'wb') as f:
+        f.write(gzip.compress(b'id\n1\n'))
+
+    response = TestClient(app).get(LocalStorage().url(key, filename='report.csv', encoding='gzip'))
+    assert response.status_code == 200
+    assert response.headers['content-encoding'] == 'gzip'
+    assert response.content == b'id\n1\n'
+
+
+def test_stream_archive():
+    from app.uploader import stream_archive
+
+    local = LocalStorage()
+    for name, content in (('a.csv', b'a' * 100000), ('b.zip', b'b')):
+        with local.open(f'data/storage_test/archive/{name}', 'wb') as f:
+            f.write(content)
+    files = [
+        ('data/storage_test/archive/a.csv', 'cover.csv'),
+        ('data/storage_test/missing.csv', 'missing.csv'),
+        ('data/storage_test/archive/b.zip', 'cover.zip'),
+        ('data/storage_test/archive/a.csv', 'cover.csv'),
+    ]
+
+    data = b''.join(stream_archive('task_1', files))
+
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        # файлы называются по задачам, одинаковые имена получают номер
+        assert archive.namelist() == ['task_1/cover.csv', 'task_1/cover.zip', 'task_1/cover(1).csv']
+        assert archive.read('task_1/cover.csv') == b'a' * 100000
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    pytest.importorskip('boto3')
+    from botocore.stub import Stubber
+
+    monkeypatch.setenv('S3_BUCKET', 'bucket')
+    monkeypatch.setenv('S3_ACCESS_KEY', 'key')
+    monkeypatch.setenv('S3_SECRET_KEY', 'secret')
+    monkeypatch.setenv('S3_REGION', 'us-east-1')
+
+    s3_storage = storage.S3Storage()
+    with Stubber(s3_storage.client) as stubber:
+        yield s3_storage, stubber
+        stubber.assert_no_pending_responses()
+
+
+def test_s3_read_write(s3):
+    from botocore.response import StreamingBody
+
+    s3_storage, stubber = s3
+    # параметры загрузки (контрольные суммы) зависят от версии botocore
+    stubber.add_response('put_object', {})
+    stubber.add_response(
+        'get_object',
+        {'Body': StreamingBody(io.BytesIO(b'id\n1\n'), 5)},
+        {'Bucket': 'bucket', 'Key': 'data/results/a.csv'},
+    )
+    stubber.add_response('head_object', {'ContentLength': 5}, {'Bucket': 'bucket', 'Key': 'data/results/a.csv'})
+    stubber.add_response('delete_object', {}, {'Bucket': 'bucket', 'Key': 'data/results/a.csv'})
+
+    with s3_storage.open('data/results/a.csv', 'wb') as f:
+        f.write(b'id\n1\n')
+    with s3_storage.open('data/results/a.csv') as f:
+        assert f.read() == b'id\n1\n'
+    assert s3_storage.size('data/results/a.csv') == 5
+    s3_storage.delete('data/results/a.csv')
+
+
+def test_s3_exists_and_url(s3):
+    s3_storage, stubber = s3
+    stubber.add_response('head_object', {'ContentLength': 1}, {'Bucket': 'bucket', 'Key': 'data/a.csv'})
+    stubber.add_client_error('head_object', '404', http_status_code=404)
+
+    assert s3_storage.exists('data/a.csv')
+    assert not s3_storage.exists('data/b.csv')
+
+    url = s3_storage.url('data/a.csv', filename='отчет.csv')
+    assert url.startswith('https://bucket.s3.amazonaws.com/data/a.csv?')
+    assert 'response-content-disposition=' in url
+
+
+def test_s3_find_path_lists_prefix_once(s3, monkeypatch):
+    import app.uploader as uploader
+
+    s3_storage, stubber = s3
+    stubber.add_response(
+        'list_objects_v2',
+        {'Contents': [{'Key': 'data/uploaded/cover.geojson'}, {'Key': 'data/uploaded/cover(1).geojson'}]},
+        {'Bucket': 'bucket', 'Prefix': 'data/uploaded/cover'},
+    )
+    monkeypatch.setattr(uploader, 'get_storage', lambda: s3_storage)
+
+    assert uploader.TaskUploader.find_path('data/uploaded/cover.geojson') == 'data/uploaded/cover(2).geojson'
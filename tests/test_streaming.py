@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+from app import streaming
+from app.streaming import ValueScanner, iter_geojson_features
+
+
+def feature(number, points=3, name=None):
+    coords = [[float(i), float(number)] for i in range(points)]
+    return {
+        'type': 'Feature',
+        'properties': {'name': name or f'cover {number}'},
+        'geometry': {'type': 'LineString', 'coordinates': coords},
+    }
+
+
+def write_collection(tmp_path, features, crs=None):
+    collection = {'type': 'FeatureCollection', 'features': features}
+    if crs:
+        collection = {'type': 'FeatureCollection', 'crs': {'properties': {'name': crs}}, 'features': features}
+    path = tmp_path / 'cover.geojson'
+    path.write_text(json.dumps(collection, ensure_ascii=False, indent=1), encoding='utf-8')
+    return str(path)
+
+
+def test_scanner_across_chunks():
+    text = json.dumps({'name': 'a "}]{" \\ b', 'items': [{'x': [1, 2]}]}) + ', {"next": 1}'
+    scanner = ValueScanner()
+
+    ends = [scanner.feed(text[i:i + 3]) for i in range(0, len(text), 3)]
+    chunk = next(i for i, end in enumerate(ends) if end is not None)
+
+    assert json.loads(text[:chunk * 3 + ends[chunk]])['items'] == [{'x': [1, 2]}]
+
+
+@pytest.mark.parametrize('read_size', [1, 7, 64, 1024 * 1024])
+def test_features_with_small_reads(tmp_path, monkeypatch, read_size):
+    monkeypatch.setattr(streaming, 'READ_SIZE', read_size)
+    features = [feature(1), feature(2, points=500, name='скобки {[ и \\"кавычки\\"'), feature(3)]
+    path = write_collection(tmp_path, features, crs='EPSG:3857')
+
+    result = list(iter_geojson_features(path))
+
+    assert [item for _, item in result] == features
+    assert {crs for crs, _ in result} == {'EPSG:3857'}
+
+
+def test_large_feature_decoded_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(streaming, 'READ_SIZE', 4096)
+    big = feature(1, points=100_000)
+    path = write_collection(tmp_path, [big, feature(2)])
+    calls = []
+    raw_decode = json.JSONDecoder.raw_decode
+
+    def counting(self, s, idx=0):
+        calls.append(len(s) - idx)
+        return raw_decode(self, s, idx)
+
+    monkeypatch.setattr(json.JSONDecoder, 'raw_decode', counting)
+    result = [item for _, item in iter_geojson_features(path)]
+
+    assert result == [big, feature(2)]
+    # одна неудачная попытка на прочитанном буфере и один разбор объекта целиком
+    assert len([size for size in calls if size > 4096]) <= 1
+
+
+def test_truncated_file(tmp_path):
+    path = tmp_path / 'cover.geojson'
+    path.write_text('{"type": "FeatureCollection", "features": [{"type": "Feature", "geometry": {', encoding='utf-8')
+
+    with pytest.raises(ValueError):
+        list(iter_geojson_features(str(path)))
@@ -0,0 +1,80 @@
+import math
+
+import pytest
+from shapely.geometry import GeometryCollection, LineString, MultiPolygon, Point, box
+
+from app import tiling
+from app.tiling import measure, polygonal, split_cover
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    monkeypatch.setattr(tiling, 'TILE_MAX_AREA', 2500)
+    monkeypatch.setattr(tiling, 'TILE_MAX_VERTICES', 20000)
+    monkeypatch.setattr(tiling, 'TILE_MAX_DEPTH', 6)
+
+
+def test_measure():
+    area, vertices = measure(box(0, 0, 1, 1))
+    assert area == pytest.approx(tiling.KM_PER_DEGREE**2, rel=1e-4)
+    assert vertices == 5
+
+    # на 60° широты градус долготы вдвое короче
+    area, _ = measure(box(0, 59.5, 1, 60.5))
+    assert area == pytest.approx(tiling.KM_PER_DEGREE**2 * math.cos(math.radians(60)), rel=1e-4)
+
+
+def test_polygonal():
+    square = box(0, 0, 1, 1)
+
+    assert polygonal(GeometryCollection([LineString([(0, 0), (1, 1)]), Point(0, 0)])) is None
+    assert polygonal(GeometryCollection([square, LineString([(2, 2), (3, 3)])])).equals(square)
+    assert isinstance(polygonal(GeometryCollection([square, box(2, 2, 3, 3)])), MultiPolygon)
+
+
+def test_no_split():
+    small = box(0, 0, 0.1, 0.1)
+    large = box(0, 0, 2, 2)
+
+    assert split_cover(small, mode='grid') == []
+    assert split_cover(large, mode='') == []
+    assert split_cover(None, mode='grid') == []
+    assert split_cover(GeometryCollection(), mode='grid') == []
+    # маленький охват не проверяет способ разбиения
+    assert split_cover(small, mode='unknown') == []
+
+    with pytest.raises(ValueError):
+        split_cover(large, mode='unknown')
+
+
+@pytest.mark.parametrize('mode', ['grid', 'quadtree'])
+def test_split_covers_geometry(mode):
+    # L-образный охват: часть ячеек сетки пересекается с ним только по границе
+    cover = box(0, 0, 2, 1).union(box(0, 1, 1, 2))
+
+    tiles = split_cover(cover, mode=mode)
+
+    assert len(tiles) > 1
+    assert all(tile.geom_type in ('Polygon', 'MultiPolygon') for tile in tiles)
+    assert all(not tiling.is_oversized(tile) for tile in tiles)
+    assert sum(tile.area for tile in tiles) == pytest.approx(cover.area)
+    assert MultiPolygon([part for tile in tiles for part in getattr(tile, 'geoms', [tile])]).buffer(0).equals(cover)
+
+
+def test_split_by_vertices(monkeypatch):
+    monkeypatch.setattr(tiling, 'TILE_MAX_VERTICES', 100)
+    cover = Point(0, 0).buffer(0.1, quad_segs=64)
+
+    tiles = split_cover(cover, mode='grid')
+
+    assert len(tiles) > 1
+    assert sum(tile.area for tile in tiles) == pytest.approx(cover.area)
+
+
+def test_quadtree_depth_limit(monkeypatch):
+    monkeypatch.setattr(tiling, 'TILE_MAX_DEPTH', 1)
+
+    tiles = split_cover(box(0, 0, 4, 4), mode='quadtree')
+
+    assert len(tiles) == 4
+    assert all(tiling.is_oversized(tile) for tile in tiles)
@@ -0,0 +1,200 @@
+import pytest
+
+import app.worker as worker
+from app.db import DBTask
+from app.ingest import enqueue_cover
+from app.ng_toolbox import NGToolbox, PermanentToolboxError, TransientToolboxError
+from app.tracing import trace, trace_headers, parse_traceparent, load_trace, critical_path, summarize
+from app.uploader import TaskUploader
+from app.worker import CollectKadTask, send_task
+
+
+class Group:
+    id = None
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """
+    Сообщения, отправленные в очередь Celery: (ID задачи, заголовки).
+    """
+    messages = []
+
+    def apply_async(self, args=None, kwargs=None, task_id=None, headers=None, **options):
+        messages.append((args[0], headers))
+
+    monkeypatch.setattr(CollectKadTask, 'apply_async', apply_async)
+    return messages
+
+
+def run_task(task_id, headers):
+    task = CollectKadTask()
+    task.push_request(id=None, headers=headers)
+    try:
+        task.run(task_id)
+    finally:
+        task.pop_request()
+
+
+def span_names(trace_id):
+    return [span['name'] for span in load_trace(trace_id)]
+
+
+def test_traceparent_round_trip():
+    assert trace_headers() == {}
+
+    with trace('request', root=True) as span:
+        headers = trace_headers()
+
+    assert parse_traceparent(headers['traceparent']) == (span.trace_id, span.span_id)
+    assert parse_traceparent(headers['traceparent'].encode()) == (span.trace_id, span.span_id)
+    assert parse_traceparent('00-xyz-1-01') is None
+    assert parse_traceparent(None) is None
+
+    with trace('worker', traceparent=headers['traceparent']) as remote:
+        assert (remote.trace_id, remote.parent_id) == (span.trace_id, span.span_id)
+
+
+def test_spans_outside_trace_are_not_recorded():
+    with trace('db.update') as span:
+        assert span is None
+
+
+def test_nested_spans_are_saved_with_root():
+    with trace('root', root=True) as root:
+        with trace('child', value=1) as child:
+            with trace('grandchild'):
+                pass
+        with pytest.raises(ValueError), trace('failed'):
+            raise ValueError('boom')
+
+    spans = {span['name']: span for span in load_trace(root.trace_id)}
+    assert set(spans) == {'root', 'child', 'grandchild', 'failed'}
+    assert spans['root']['parent_id'] is None
+    assert spans['child']['parent_id'] == root.span_id
+    assert spans['grandchild']['parent_id'] == child.span_id
+    assert spans['child']['attributes'] == {'value': 1}
+    assert spans['failed']['error'] == 'ValueError: boom'
+
+
+def test_joined_trace_does_not_attach_to_current_span():
+    with trace('other', root=True) as other:
+        with trace('worker.send', trace_id='a' * 32) as span:
+            assert (span.trace_id, span.parent_id) == ('a' * 32, None)
+        with trace('same', trace_id=other.trace_id) as same:
+            assert same.parent_id == other.span_id
+
+    assert span_names('a' * 32) == ['worker.send']
+
+
+def test_enqueue_passes_trace_to_worker(db, monkeypatch, sent):
+    with trace('run_tasks', root=True) as request:
+        db_task = enqueue_cover(Group(), 'cover', 'data/uploaded/cover.geojson', [], None)
+
+    [(task_id, headers)] = sent
+    assert task_id == db_task.id
+    assert db_task.trace_id == request.trace_id
+    assert parse_traceparent(headers['traceparent'])[0] == request.trace_id
+
+    def upload(upload_file):
+        raise PermanentToolboxError('400')
+
+    monkeypatch.setattr(NGToolbox, 'upload', upload)
+    run_task(db_task.id, headers)
+
+    spans = {span['name']: span for span in load_trace(request.trace_id)}
+    assert spans['worker.collect_kad']['parent_id'] == spans['ingest.enqueue']['span_id']
+    assert spans['ingest.enqueue']['parent_id'] == request.span_id
+    # записи воркера в задачу входят в трассу
+    assert spans['db.update']['parent_id'] == spans['worker.collect_kad']['span_id']
+
+
+def test_retry_and_resend_continue_trace(db, monkeypatch, sent):
+    task = TaskUploader.create_or_update(model=DBTask, params={'name': 'cover', 'cover_file': 'cover.geojson'})
+    retries = []
+
+    def retry(self, kwargs=None, countdown=None, headers=None, **options):
+        retries.append(headers)
+
+    def upload(upload_file):
+        raise TransientToolboxError('503')
+
+    monkeypatch.setattr(CollectKadTask, 'retry', retry)
+    monkeypatch.setattr(NGToolbox, 'upload', upload)
+    monkeypatch.setattr(worker.toolbox_breaker, 'remaining_cooldown', lambda: 0.0)
+
+    # без контекста в сообщении задача начинает новую трассу
+    run_task(task.id, {})
+    trace_id = TaskUploader.create_or_update(model=DBTask, instance=task.id).trace_id
+    assert trace_id
+
+    [headers] = retries
+    assert parse_traceparent(headers['traceparent'])[0] == trace_id
+    assert span_names(trace_id)[:2] == ['worker.collect_kad', 'db.update']
+
+    # повторная отправка из другой трассы (после замыкания предохранителя) продолжает трассу задачи
+    with trace('other', root=True):
+        send_task(TaskUploader.create_or_update(model=DBTask, instance=task.id))
+
+    [(_, headers)] = sent
+    assert parse_traceparent(headers['traceparent'])[0] == trace_id
+
+
+def test_cancel_writes_are_traced(db):
+    task = TaskUploader.create_or_update(model=DBTask, params={'name': 'cover'})
+
+    class Control:
+        def revoke(self, task_id, **options):
+            pass
+
+    class Celery:
+        control = Control()
+
+    with trace('cancel', root=True) as span:
+        TaskUploader.request_cancel([task.id], Celery())
+        TaskUploader.claim_retry(task.id, 'missing')
+
+    spans = load_trace(span.trace_id)
+    assert [span['name'] for span in spans] == ['cancel', 'db.request_cancel', 'db.claim_retry']
+    assert all(item['parent_id'] == span.span_id for item in spans[1:])
+
+
+def make_span(name, span_id, parent_id, start, end, error=None, **attributes):
+    return {
+        'name': name,
+        'span_id': span_id,
+        'parent_id': parent_id,
+        'start': start,
+        'end': end,
+        'duration': end - start,
+        'attributes': attributes,
+        'error': error,
+    }
+
+
+SPANS = [
+    make_span('run_tasks', 'a', None, 0, 1),
+    make_span('ingest', 'b', 'a', 1, 5),
+    make_span('ingest.enqueue', 'c', 'b', 1, 2),
+    make_span('ingest.enqueue', 'd', 'b', 2, 3),
+    make_span('worker.collect_kad', 'e', 'c', 2, 20, task_id=1),
+    make_span('worker.collect_kad', 'f', 'd', 3, 10, error='Exception: 400', task_id=2),
+    make_span('toolbox.request', 'g', 'e', 3, 19),
+]
+
+
+def test_critical_path_follows_latest_child():
+    path = critical_path(SPANS)
+    assert [item['span_id'] for item in path] == ['a', 'b', 'c', 'e', 'g']
+    assert path[3]['attributes'] == {'task_id': 1}
+
+    # спан, родитель которого не сохранен, считается корнем
+    assert [item['span_id'] for item in critical_path(SPANS[4:])] == ['e', 'g']
+    assert critical_path([]) == []
+
+
+def test_summarize():
+    summary = summarize(SPANS)
+    assert summary['ingest.enqueue'] == {'count': 2, 'duration': 2, 'errors': 0}
+    assert summary['worker.collect_kad'] == {'count': 2, 'duration': 25, 'errors': 1}
+    assert set(summary) == {'run_tasks', 'ingest', 'ingest.enqueue', 'worker.collect_kad', 'toolbox.request'}
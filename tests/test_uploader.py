@@ -0,0 +1,230 @@
+import time
+import threading
+
+from app.db import DBTask, DBTasksGroup
+from app.uploader import TaskUploader, aggregate_status
+
+
+class FakeControl:
+    def __init__(self):
+        self.revoked = []
+
+    def revoke(self, task_id, **kwargs):
+        self.revoked.append(task_id)
+
+
+class FakeCelery:
+    def __init__(self):
+        self.control = FakeControl()
+
+
+def add_task(db, **params):
+    task = DBTask(**params)
+    db.add(task)
+    db.commit()
+    return task
+
+
+def make_parent(db, tiles: list[tuple[dict, dict]]):
+    group = DBTasksGroup(name='group')
+    db.add(group)
+    db.commit()
+
+    parent = add_task(db, name='cover', group_id=group.id)
+    for number, (kpt_status, kad_status) in enumerate(tiles, start=1):
+        add_task(
+            db,
+            name=f'cover_tile{number}',
+            group_id=group.id,
+            parent_id=parent.id,
+            celery_task=f'celery-{parent.id}-{number}',
+            kpt_status=kpt_status,
+            kad_status=kad_status,
+        )
+    return parent
+
+
+def test_aggregate_status():
+    prepared, started, success = {'state': 'PREPARING'}, {'state': 'STARTED'}, {'state': 'SUCCESS'}
+    names = ['a', 'b']
+
+    assert aggregate_status([prepared, prepared], names)['state'] == 'PREPARING'
+    assert aggregate_status([success, prepared], names)['state'] == 'STARTED'
+    assert aggregate_status([started, prepared], names)['state'] == 'STARTED'
+    assert aggregate_status([success, success], names) == {'state': 'SUCCESS', 'tiles': {'total': 2, 'success': 2}}
+
+    failed = aggregate_status([success, {'state': 'FAILED', 'error': 'timeout'}], names)
+    assert failed['state'] == 'FAILED'
+    assert failed['error'] == 'b: timeout'
+
+
+def test_update_parent_single_tile(db):
+    parent = make_parent(db, [({'state': 'SUCCESS'}, {'state': 'STARTED'})])
+
+    updated = TaskUploader.update_parent(parent.id)
+
+    assert updated.kpt_status == {'state': 'SUCCESS', 'tiles': {'total': 1, 'success': 1}}
+    assert updated.kad_status['state'] == 'STARTED'
+    assert (updated.stage, updated.state) == ('kad', 'IN_PROGRESS')
+
+
+def test_update_parent_finished(db):
+    parent = make_parent(
+        db,
+        [
+            ({'state': 'SUCCESS'}, {'state': 'SUCCESS'}),
+            ({'state': 'SUCCESS'}, {'state': 'FAILED', 'error': 'no data'}),
+        ],
+    )
+
+    updated = TaskUploader.update_parent(parent.id)
+
+    assert updated.kad_status['state'] == 'FAILED'
+    assert updated.kad_status['error'] == 'cover_tile2: no data'
+    assert updated.state == 'FAILED'
+    assert updated.finished is not None
+
+
+def test_update_parent_without_tiles(db):
+    task = add_task(db, name='cover')
+
+    assert TaskUploader.update_parent(task.id) is None
+
+
+def set_status(task_id, **statuses):
+    TaskUploader.create_or_update(model=DBTask, instance=task_id, params=statuses)
+
+
+def test_update_parent_concurrent_tiles(db, monkeypatch):
+    import app.uploader as uploader
+
+    parent = make_parent(db, [({'state': 'SUCCESS'}, {'state': 'STARTED'})] * 2)
+    first, second = [child.id for child in TaskUploader.get_children(parent.id)]
+
+    # первый пересчет прочитал тайлы до завершения второго и записывает результат после него
+    computing = threading.Event()
+    aggregate = uploader.aggregate_status
+
+    def slow_aggregate(statuses, names):
+        if threading.current_thread().name == 'first':
+            computing.set()
+            time.sleep(0.3)
+        return aggregate(statuses, names)
+
+    monkeypatch.setattr(uploader, 'aggregate_status', slow_aggregate)
+
+    def finish_first():
+        set_status(first, kad_status={'state': 'SUCCESS'})
+        TaskUploader.update_parent(parent.id)
+
+    thread = threading.Thread(target=finish_first, name='first')
+    thread.start()
+    assert computing.wait(5)
+    set_status(second, kad_status={'state': 'SUCCESS'})
+    TaskUploader.update_parent(parent.id)
+    thread.join(5)
+
+    db.expire_all()
+    assert db.get(DBTask, parent.id).kad_status['state'] == 'SUCCESS'
+
+
+def test_update_parents_recomputes_unfinished(db):
+    parent = make_parent(db, [({'state': 'SUCCESS'}, {'state': 'SUCCESS'})])
+    finished = make_parent(db, [({'state': 'SUCCESS'}, {'state': 'PREPARING'})])
+    set_status(finished.id, kpt_status={'state': 'FAILED'})
+
+    assert TaskUploader.update_parents() == 1
+
+    db.expire_all()
+    assert db.get(DBTask, parent.id).state == 'SUCCESS'
+    assert db.get(DBTask, finished.id).kpt_status == {'state': 'FAILED'}
+
+
+def test_restart_parent_restarts_unfinished_tiles(db):
+    parent = make_parent(
+        db,
+        [
+            ({'state': 'SUCCESS'}, {'state': 'SUCCESS'}),
+            ({'state': 'SUCCESS'}, {'state': 'FAILED', 'error': 'no data'}),
+        ],
+    )
+    done, failed = TaskUploader.get_children(parent.id)
+    celery = FakeCelery()
+
+    restarted = TaskUploader.restart_task(parent.id, celery)
+
+    assert [task.id for task in restarted] == [failed.id]
+    assert celery.control.revoked == [failed.celery_task]
+    assert restarted[0].celery_task != failed.celery_task
+
+    db.expire_all()
+    db_parent = db.get(DBTask, parent.id)
+    assert db_parent.celery_task is None
+    assert db_parent.kad_status == {'state': 'STARTED', 'tiles': {'total': 2, 'success': 1}}
+    assert db.get(DBTask, done.id).celery_task == done.celery_task
+
+
+def test_restart_single_task(db):
+    task = add_task(db, name='cover', celery_task='old', kpt_status={'state': 'FAILED', 'error': 'x'})
+    celery = FakeCelery()
+
+    [restarted] = TaskUploader.restart_task(task.id, celery)
+
+    assert celery.control.revoked == ['old']
+    assert restarted.id == task.id
+    assert restarted.celery_task != 'old'
+    assert restarted.kpt_status == {'state': 'PREPARING'}
+    assert (restarted.state, restarted.error, restarted.finished) == ('PREPARING', None, None)
+
+
+def test_get_working_tasks_orders_started_first(db):
+    waiting = add_task(db, name='waiting', celery_task='waiting')
+    started = add_task(db, name='started', celery_task='started', kpt_status={'state': 'STARTED'})
+    add_task(db, name='done', celery_task='done', kpt_status={'state': 'SUCCESS'}, kad_status={'state': 'SUCCESS'})
+    add_task(db, name='cancelled', celery_task='cancelled', kpt_status={'state': 'CANCELLED'})
+
+    assert [task.id for task in TaskUploader.get_working_tasks()] == [started.id, waiting.id]
+
+
+def retrying(retry_id, retry_at):
+    return {'state': 'RETRYING', 'retry': 1, 'retry_id': retry_id, 'retry_at': retry_at, 'submitted': 1.0}
+
+
+def test_working_tasks_skip_pending_retry(db):
+    pending = add_task(db, name='pending', celery_task='c1', kpt_status=retrying('r1', time.time() + 600))
+    overdue = add_task(db, name='overdue', celery_task='c2', kpt_status=retrying('r2', time.time() - 1))
+    running = add_task(
+        db, name='running', celery_task='c3', kpt_status={'state': 'SUCCESS'}, kad_status={'state': 'STARTED'}
+    )
+
+    ids = {task.id for task in TaskUploader.get_working_tasks()}
+
+    assert pending.id not in ids
+    assert {overdue.id, running.id} <= ids
+
+
+def test_claim_retry_once(db):
+    task = add_task(db, name='task', celery_task='c1', kpt_status=retrying('r1', time.time()))
+
+    assert not TaskUploader.claim_retry(task.id, 'other')
+    assert TaskUploader.claim_retry(task.id, 'r1')
+    assert not TaskUploader.claim_retry(task.id, 'r1')
+
+    db.refresh(task)
+    assert task.kpt_status == {'state': 'RETRYING', 'retry': 1, 'submitted': 1.0}
+
+
+def test_claim_retry_concurrent(db):
+    task = add_task(db, name='task', celery_task='c1', kpt_status=retrying('r1', time.time()))
+    results = []
+
+    def claim():
+        results.append(TaskUploader.claim_retry(task.id, 'r1'))
+
+    threads = [threading.Thread(target=claim) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(results) == [False, False, False, True]